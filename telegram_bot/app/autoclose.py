@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+
+from app import crud
+from app.config import LESSON_AUTO_CLOSE_TIME, LOCAL_TZ
+from app.db import async_session
+from app.digest import seconds_until_next_run
+from app.handlers.common import get_today_date
+from app.handlers.group import close_and_announce
+from app.middlewares import LazySession
+from app.models import DEFAULT_TENANT_ID
+
+logger = logging.getLogger(__name__)
+
+
+async def run_auto_close_scheduler(
+    bot: Bot,
+    tenant_id: str = DEFAULT_TENANT_ID,
+    close_lessons: Callable[[Bot, str], Awaitable[int]] | None = None,
+) -> None:
+    # close_lessons defaults to closing in this process; the sharded supervisor passes one
+    # that hands each lesson to the worker owning its chat.
+    close_lessons = close_lessons or close_open_lessons
+    while True:
+        await asyncio.sleep(seconds_until_next_run(datetime.now(LOCAL_TZ), LESSON_AUTO_CLOSE_TIME))
+        try:
+            await close_lessons(bot, tenant_id)
+        except Exception:
+            logger.exception("Lesson auto-close failed for tenant %s", tenant_id)
+
+
+async def get_open_lessons(tenant_id: str) -> list[tuple[int, int, int]]:
+    # Only today's lessons: older lessons were never closed before /close existed.
+    async with async_session() as session:
+        return await crud.get_open_lessons(session, get_today_date(), tenant_id)
+
+
+async def auto_close_lesson(bot: Bot, group_id: int, lesson_id: int) -> bool:
+    db = LazySession()
+    try:
+        converted = await close_and_announce(bot, db, group_id, lesson_id, None)
+    except Exception:
+        await db.discard()
+        logger.exception("Auto-close of lesson %s failed", lesson_id)
+        return False
+    await db.release()
+    return converted is not None
+
+
+async def close_open_lessons(bot: Bot, tenant_id: str = DEFAULT_TENANT_ID) -> int:
+    lessons = await get_open_lessons(tenant_id)
+    closed = 0
+    for group_id, lesson_id, _ in lessons:
+        if await auto_close_lesson(bot, group_id, lesson_id):
+            closed += 1
+    logger.info("Auto-close (%s): %s of %s open lessons closed", tenant_id, closed, len(lessons))
+    return closed
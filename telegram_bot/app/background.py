@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Coroutine
+
+from app.config import BACKGROUND_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+_tasks: set[asyncio.Task] = set()
+_semaphore: asyncio.Semaphore | None = None
+
+
+def spawn(coro: Coroutine, name: str) -> asyncio.Task:
+    # Tracked so shutdown can drain it; errors are logged instead of vanishing with the task.
+    task = asyncio.create_task(_run(coro, name), name=name)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def _run(coro: Coroutine, name: str) -> None:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(BACKGROUND_CONCURRENCY)
+    async with _semaphore:
+        try:
+            await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Background task %s failed", name)
+
+
+def pending_count() -> int:
+    return len(_tasks)
+
+
+async def drain(timeout: float = 30.0) -> None:
+    if not _tasks:
+        return
+    logger.info("Waiting for %s background tasks", len(_tasks))
+    _, pending = await asyncio.wait(set(_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning("Cancelled %s background tasks on shutdown", len(pending))
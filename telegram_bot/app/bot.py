@@ -1,28 +1,119 @@
 import asyncio
 import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator
 
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from app.config import BOT_TOKEN
-from app.db import init_db
+from app import background, crud, health, tracing
+from app.config import LESSON_AUTO_CLOSE_TIME, WORKERS
+from app.db import async_session, init_db
+from app.autoclose import run_auto_close_scheduler
+from app.digest import run_digest_scheduler
 from app.handlers import group, parent
+from app.middlewares import CallbackDedupeMiddleware, DbSessionMiddleware, TenantMiddleware
+from app.scheduler import SchedulerMiddleware
+from app.sharding import run_supervisor
+from app.tenants import Tenant, load_tenants
+from app.warmup import warm_caches
+
+logger = logging.getLogger(__name__)
+
+
+def build_dispatcher(tenants: list[Tenant] | None = None) -> Dispatcher:
+    # One dispatcher serves every tenant's bot; FSM storage keys already include the bot id.
+    dp = Dispatcher(storage=MemoryStorage())
+    tracing.install(dp)
+    dp.update.outer_middleware(TenantMiddleware(load_tenants() if tenants is None else tenants))
+    dp.update.outer_middleware(SchedulerMiddleware())
+    dp.update.outer_middleware(DbSessionMiddleware())
+    group.router.callback_query.outer_middleware(CallbackDedupeMiddleware())
+
+    dp.include_router(group.router)
+    dp.include_router(parent.router)
+    return dp
+
+
+@contextmanager
+def timed(timings: dict[str, float], name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = (time.perf_counter() - start) * 1000
+
+
+def format_timings(timings: dict[str, float]) -> str:
+    return ", ".join(f"{name} {ms:.0f} ms" for name, ms in timings.items())
+
+
+async def prepare_database(timings: dict[str, float] | None = None) -> None:
+    timings = {} if timings is None else timings
+    with timed(timings, "schema"):
+        if not await init_db():
+            logger.info("Schema is up to date")
+    with timed(timings, "backfills"):
+        async with async_session() as session:
+            await crud.backfill_normalized_names(session)
+            if await crud.daily_stats_need_rebuild(session):
+                await crud.rebuild_daily_stats(session)
+            await crud.backfill_grade_events(session)
+            await crud.ensure_projection_checkpoints(session)
+
+
+def log_first_update(started: float):
+    # Time to first update: from process start until the first update reaches the dispatcher.
+    seen = False
+
+    async def middleware(handler, event, data):
+        nonlocal seen
+        if not seen:
+            seen = True
+            logger.info("First update %s after %.0f ms", event.update_id, (time.perf_counter() - started) * 1000)
+        return await handler(event, data)
+
+    return middleware
 
 
 async def main():
-    if not BOT_TOKEN:
+    started = time.perf_counter()
+    tenants = load_tenants()
+    if not tenants:
         raise RuntimeError("BOT_TOKEN is not set. Please configure .env")
 
     logging.basicConfig(level=logging.INFO)
-    await init_db()
+    timings: dict[str, float] = {}
+    await prepare_database(timings)
 
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    if WORKERS > 1:
+        logger.info("Startup: %s", format_timings(timings))
+        await run_supervisor(WORKERS, tenants)
+        return
 
-    dp.include_router(group.router)
-    dp.include_router(parent.router)
+    bots = {
+        tenant.id: health.instrument_bot(tracing.instrument_bot(Bot(token=tenant.token))) for tenant in tenants
+    }
+    dp = build_dispatcher(tenants)
+    dp.update.outer_middleware(log_first_update(started))
+    with timed(timings, "warm-up"):
+        warmed = await warm_caches(bots)
+    timings["ready"] = (time.perf_counter() - started) * 1000
+    logger.info("Startup: %s; warmed %s", format_timings(timings), warmed)
 
-    await dp.start_polling(bot)
+    scheduler_tasks = [asyncio.create_task(run_digest_scheduler(bot, tenant_id)) for tenant_id, bot in bots.items()]
+    scheduler_tasks.append(asyncio.create_task(health.run_health()))
+    if LESSON_AUTO_CLOSE_TIME:
+        scheduler_tasks += [
+            asyncio.create_task(run_auto_close_scheduler(bot, tenant_id)) for tenant_id, bot in bots.items()
+        ]
+    try:
+        await dp.start_polling(*bots.values())
+    finally:
+        for task in scheduler_tasks:
+            task.cancel()
+        await background.drain()
 
 
 if __name__ == "__main__":
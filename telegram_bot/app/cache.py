@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import time
+from datetime import date
+from typing import Any, Hashable, NamedTuple
+
+
+class GroupRef(NamedTuple):
+    id: int
+    chat_id: int
+    title: str | None
+
+
+class GradeSummary(NamedTuple):
+    lesson_count: int
+    total_score: int
+    done_count: int
+    not_done_count: int
+    absent_count: int
+
+    @property
+    def average(self) -> float | None:
+        return self.total_score / self.done_count if self.done_count else None
+
+
+class TTLCache:
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: dict[Hashable, tuple[float, Any]] = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._items.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._items.pop(key, None)
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._items.pop(key, None)
+        if len(self._items) >= self.max_size:
+            # Dicts keep insertion order, so the first key is the oldest entry.
+            self._items.pop(next(iter(self._items)))
+        self._items[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key: Hashable) -> None:
+        self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+# group_id -> {normalized query: [(student_id, full_name, code), ...]} for inline search.
+roster_search = TTLCache(ttl=30, max_size=512)
+# student_id -> GradeSummary for the parents' grade history; dropped on every grade change of
+# the student. Only used with a single process: a worker never sees another worker's drops.
+grade_summaries = TTLCache(ttl=300, max_size=4096)
+# (bot_id, chat_id) -> ids of users known to be admins there; a miss still asks Telegram.
+# chat_member updates add promoted and drop demoted admins as they happen.
+chat_admins = TTLCache(ttl=300, max_size=4096)
+# (tenant_id, chat_id) -> GroupRef; replaced on title change, dropped on chat migration.
+group_refs: dict[tuple[str, int], GroupRef] = {}
+# (group_id, local lesson date) -> lesson_id; older dates are dropped at local midnight.
+lesson_ids: dict[tuple[int, date], int] = {}
+# Lessons whose PENDING grade rows already exist for the current roster.
+ensured_lessons: set[int] = set()
+# group_id -> {leaderboard window start: rendered pages}; dropped on every grade or roster change.
+leaderboard_pages: dict[int, dict[date | None, list[str]]] = {}
+
+
+def remember_lesson(group_id: int, lesson_date: date, lesson_id: int) -> None:
+    stale = [key for key in lesson_ids if key[1] < lesson_date]
+    for key in stale:
+        ensured_lessons.discard(lesson_ids.pop(key))
+    lesson_ids[(group_id, lesson_date)] = lesson_id
+
+
+def set_chat_admin(bot_id: int, chat_id: int, user_id: int, is_admin: bool) -> None:
+    admins = chat_admins.get((bot_id, chat_id))
+    if admins is None:
+        return
+    if is_admin:
+        admins.add(user_id)
+    else:
+        admins.discard(user_id)
+
+
+def forget_grade_summaries(student_ids) -> None:
+    for student_id in student_ids:
+        grade_summaries.pop(student_id)
+
+
+def forget_leaderboard(group_id: int) -> None:
+    leaderboard_pages.pop(group_id, None)
+
+
+def forget_roster(group_id: int) -> None:
+    # The roster changed, so today's lessons must create PENDING rows again.
+    roster_search.pop(group_id)
+    forget_leaderboard(group_id)
+    for (cached_group_id, _), lesson_id in lesson_ids.items():
+        if cached_group_id == group_id:
+            ensured_lessons.discard(lesson_id)
@@ -1,8 +1,68 @@
 import os
+from zoneinfo import ZoneInfo
+
 from dotenv import load_dotenv
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Super admins of the single-bot setup (comma-separated Telegram user ids).
+ADMIN_TG_USER_IDS = frozenset(
+    int(value) for value in os.getenv("ADMIN_TG_USER_IDS", "6329800356").split(",") if value.strip()
+)
+# Optional JSON file with several schools served by one process: [{"id": ..., "token": ..., "admins": [...]}].
+TENANTS_FILE = os.getenv("TENANTS_FILE")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./bot.db")
+# Connections shared by every tenant's bot in one process.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+# Admin reports and exports read through their own engine: a Postgres replica URL here, or
+# (empty) a read-only connection to DATABASE_URL. Own pool size and per-statement timeout.
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL", "")
+READ_POOL_SIZE = int(os.getenv("READ_POOL_SIZE", "2"))
+READ_STATEMENT_TIMEOUT_MS = int(os.getenv("READ_STATEMENT_TIMEOUT_MS", "5000"))
+# Seconds the startup warm-up may spend fetching group admin lists from Telegram.
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
 TIMEZONE = os.getenv("TIMEZONE", "Asia/Tashkent")
+LOCAL_TZ = ZoneInfo(TIMEZONE)
+# Local time (TIMEZONE) at which parents in digest mode get their daily summary.
+DIGEST_TIME = os.getenv("DIGEST_TIME", "20:00")
+# Local time at which today's open lessons are closed automatically (empty: only /close).
+LESSON_AUTO_CLOSE_TIME = os.getenv("LESSON_AUTO_CLOSE_TIME", "")
+# Status given to students still ungraded when a lesson closes: ABSENT or NOT_DONE.
+LESSON_CLOSE_STATUS = os.getenv("LESSON_CLOSE_STATUS", "ABSENT")
+# Number of worker processes; above 1 the bot runs as a supervisor that shards updates by chat.
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Opt-in: answer grading buttons as soon as the grade is saved; parent DMs and the leaderboard follow
+# in the background, where a failure is only logged.
+FAST_CALLBACK_ACK = os.getenv("FAST_CALLBACK_ACK", "0") == "1"
+BACKGROUND_CONCURRENCY = int(os.getenv("BACKGROUND_CONCURRENCY", "8"))
+# Parent DMs: at most this many sends in flight, this many per second overall, and this
+# many seconds between two messages to the same chat.
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "16"))
+FANOUT_RATE = float(os.getenv("FANOUT_RATE", "25"))
+FANOUT_CHAT_INTERVAL = float(os.getenv("FANOUT_CHAT_INTERVAL", "1.0"))
+# Updates handled at once per process; above it updates queue by priority (grading first).
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "32"))
+# Waiting updates beyond which parent/admin updates are dropped (grading is never dropped).
+SCHEDULER_QUEUE_LIMIT = int(os.getenv("SCHEDULER_QUEUE_LIMIT", "200"))
+# Parent/admin updates one user may have running or queued at the same time.
+SCHEDULER_USER_LIMIT = int(os.getenv("SCHEDULER_USER_LIMIT", "3"))
+# JSONL file for per-update traces (empty: tracing off). A trace is always kept when slower
+# than TRACE_SLOW_MS or failing, otherwise with probability TRACE_SAMPLE_RATE.
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "5"))
+# Event-loop lag (ms) that is logged as a warning, and how long (ms) the loop may be blocked
+# before the blocking code's stack is logged.
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "100"))
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "1000"))
+# Port for /health/live and /health/ready (0: off), and the seconds without a successful
+# getUpdates after which the bot is reported not ready.
+HEALTH_HOST = os.getenv("HEALTH_HOST", "127.0.0.1")
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "0"))
+HEALTH_POLL_STALE_S = float(os.getenv("HEALTH_POLL_STALE_S", "120"))
+# Seconds without a heartbeat from a worker process (WORKERS > 1) after which the bot is reported
+# not live and the systemd watchdog is no longer pinged.
+HEALTH_WORKER_STALE_S = float(os.getenv("HEALTH_WORKER_STALE_S", "15"))
@@ -1,9 +1,16 @@
 import random
 import string
 from datetime import date, datetime
-from sqlalchemy import select, func
+from typing import NamedTuple
+from sqlalchemy import Integer, bindparam, select, func, update, case, delete, exists, literal, null, tuple_, union_all
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import selectinload
 
+from app import cache
+from app.cache import GradeSummary, GroupRef
+from app.config import WORKERS
+from app.db import engine
+
 from app.models import (
     Group,
     GroupState,
@@ -13,25 +20,91 @@ from app.models import (
     Lesson,
     LessonGrade,
     StudentStats,
+    StudentDailyStats,
+    TermSummary,
+    GradeEvent,
+    ProjectionCheckpoint,
     StudentStatus,
     LessonGradeStatus,
     Notification,
+    NotificationStatus,
+    DeliveryMode,
+    DEFAULT_TENANT_ID,
 )
+from app.text import normalize_full_name
+
+GRADE_UPDATE_ATTEMPTS = 5
+# Projections over grade_events that update_grade maintains live (see app/projections.py).
+LIVE_PROJECTIONS = ("student_stats", "daily_stats")
+ARCHIVE_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 2000
+
+
+class LessonClosedError(RuntimeError):
+    pass
+
+
+class SavedGrade(NamedTuple):
+    # What update_grade wrote: enough to render the grade message without reloading the row.
+    id: int
+    student_id: int
+    student_name: str
+    lesson_date: date
+    status: LessonGradeStatus
+    score: int | None
 
 
-async def ensure_group(session, chat_id: int, title: str | None) -> Group:
-    group = await session.scalar(select(Group).where(Group.chat_id == chat_id))
+def _insert(model):
+    # INSERT ... ON CONFLICT needs the dialect-specific construct.
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def ensure_group(session, chat_id: int, title: str | None, tenant_id: str = DEFAULT_TENANT_ID) -> Group:
+    group = await session.scalar(select(Group).where(Group.tenant_id == tenant_id, Group.chat_id == chat_id))
     if group:
         if title and group.title != title:
             group.title = title
+            await session.commit()
         return group
-    group = Group(chat_id=chat_id, title=title)
+    group = Group(tenant_id=tenant_id, chat_id=chat_id, title=title)
     session.add(group)
     await session.commit()
     await session.refresh(group)
     return group
 
 
+async def resolve_group(session, chat_id: int, title: str | None, tenant_id: str = DEFAULT_TENANT_ID) -> GroupRef:
+    cached = cache.group_refs.get((tenant_id, chat_id))
+    if cached and (not title or cached.title == title):
+        return cached
+    group = await ensure_group(session, chat_id, title, tenant_id)
+    ref = GroupRef(id=group.id, chat_id=group.chat_id, title=group.title)
+    cache.group_refs[(tenant_id, chat_id)] = ref
+    return ref
+
+
+async def get_group_refs(session) -> list[tuple[str, GroupRef]]:
+    result = await session.execute(select(Group.tenant_id, Group.id, Group.chat_id, Group.title))
+    return [
+        (tenant_id, GroupRef(id=group_id, chat_id=chat_id, title=title))
+        for tenant_id, group_id, chat_id, title in result.all()
+    ]
+
+
+async def migrate_group_chat(session, old_chat_id: int, new_chat_id: int, tenant_id: str = DEFAULT_TENANT_ID) -> None:
+    cache.group_refs.pop((tenant_id, old_chat_id), None)
+    cache.group_refs.pop((tenant_id, new_chat_id), None)
+    exists = await session.scalar(select(Group.id).where(Group.tenant_id == tenant_id, Group.chat_id == new_chat_id))
+    if exists:
+        return
+    await session.execute(
+        update(Group).where(Group.tenant_id == tenant_id, Group.chat_id == old_chat_id).values(chat_id=new_chat_id)
+    )
+    await session.commit()
+
+
 async def get_or_create_group_state(session, group_id: int) -> GroupState:
     state = await session.get(GroupState, group_id)
     if state:
@@ -43,6 +116,15 @@ async def get_or_create_group_state(session, group_id: int) -> GroupState:
     return state
 
 
+async def set_leaderboard_message_id(session, group_id: int, message_id: int) -> None:
+    await session.execute(
+        update(GroupState)
+        .where(GroupState.group_id == group_id)
+        .values(leaderboard_message_id=message_id, updated_at=datetime.utcnow())
+    )
+    await session.commit()
+
+
 async def generate_unique_code(session, length: int = 4) -> str:
     for _ in range(20):
         code = "".join(random.choices(string.digits, k=length))
@@ -52,8 +134,19 @@ async def generate_unique_code(session, length: int = 4) -> str:
     return await generate_unique_code(session, length + 1)
 
 
-async def get_student_by_code(session, code: str) -> Student | None:
-    return await session.scalar(select(Student).where(Student.code == code))
+# Hot-path statements are built once with bindparam() placeholders: SQLAlchemy then reuses
+# their memoized cache key and compiled SQL instead of rebuilding both on every call.
+_STUDENT_BY_CODE = select(Student).where(Student.code == bindparam("code"))
+_TENANT_STUDENT_BY_CODE = _STUDENT_BY_CODE.join(Group, Group.id == Student.group_id).where(
+    Group.tenant_id == bindparam("tenant_id")
+)
+
+
+async def get_student_by_code(session, code: str, tenant_id: str | None = None) -> Student | None:
+    # Codes are unique across tenants; parents may only link children of their own school.
+    if tenant_id is None:
+        return await session.scalar(_STUDENT_BY_CODE, {"code": code})
+    return await session.scalar(_TENANT_STUDENT_BY_CODE, {"code": code, "tenant_id": tenant_id})
 
 
 async def get_student_by_id(session, student_id: int) -> Student | None:
@@ -79,6 +172,7 @@ async def create_or_update_student(
 
     if student:
         student.full_name = full_name
+        student.normalized_name = normalize_full_name(full_name)
         if tg_username and not student.tg_username:
             student.tg_username = tg_username
         if tg_user_id and not student.tg_user_id:
@@ -93,6 +187,7 @@ async def create_or_update_student(
         tg_user_id=tg_user_id,
         tg_username=tg_username,
         full_name=full_name,
+        normalized_name=normalize_full_name(full_name),
         code=code,
         status=StudentStatus.ACTIVE,
     )
@@ -108,11 +203,65 @@ async def create_or_update_student(
     return student
 
 
-async def get_active_students(session, group_id: int) -> list[Student]:
+# Roster pickers only show "name (#code)", so they read these three columns instead of ORM objects.
+_ACTIVE_STUDENT_ROWS = select(Student.id, Student.full_name, Student.code).where(
+    Student.group_id == bindparam("group_id"), Student.status == StudentStatus.ACTIVE
+)
+_ACTIVE_STUDENT_ROWS_BY_NAME = _ACTIVE_STUDENT_ROWS.order_by(Student.normalized_name.asc()).limit(bindparam("limit"))
+_ACTIVE_STUDENT_ROWS_BY_PREFIX = _ACTIVE_STUDENT_ROWS_BY_NAME.where(
+    Student.normalized_name >= bindparam("prefix"),
+    Student.normalized_name < bindparam("prefix_end"),
+)
+# normalized_name holds only a-z and spaces, so the pattern needs no LIKE escaping.
+_ACTIVE_STUDENT_ROWS_BY_WORD = _ACTIVE_STUDENT_ROWS_BY_NAME.where(
+    Student.normalized_name.like(bindparam("pattern")),
+    Student.id.not_in(bindparam("exclude_ids", expanding=True)),
+)
+
+
+async def get_active_student_rows(session, group_id: int) -> list:
+    result = await session.execute(_ACTIVE_STUDENT_ROWS, {"group_id": group_id})
+    return list(result.all())
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+async def search_active_students(session, group_id: int, query: str, limit: int = 20) -> list:
+    # Range scan on (group_id, normalized_name) instead of LIKE so the index is used on SQLite too.
+    prefix = normalize_full_name(query)
+    params = {"group_id": group_id, "limit": limit}
+    if prefix:
+        params.update(prefix=prefix, prefix_end=_prefix_upper_bound(prefix))
+        result = await session.execute(_ACTIVE_STUDENT_ROWS_BY_PREFIX, params)
+    else:
+        result = await session.execute(_ACTIVE_STUDENT_ROWS_BY_NAME, params)
+    return list(result.all())
+
+
+async def search_active_students_by_word(
+    session, group_id: int, query: str, exclude_ids: set[int], limit: int = 20
+) -> list:
+    # Matches a later word of the name (e.g. the surname); not indexable, so callers try the prefix first.
+    prefix = normalize_full_name(query)
+    if not prefix:
+        return []
     result = await session.execute(
-        select(Student).where(Student.group_id == group_id, Student.status == StudentStatus.ACTIVE)
+        _ACTIVE_STUDENT_ROWS_BY_WORD,
+        {"group_id": group_id, "limit": limit, "pattern": f"% {prefix}%", "exclude_ids": list(exclude_ids)},
     )
-    return list(result.scalars().all())
+    return list(result.all())
+
+
+async def backfill_normalized_names(session) -> int:
+    result = await session.execute(select(Student).where(Student.normalized_name == ""))
+    students = list(result.scalars().all())
+    for student in students:
+        student.normalized_name = normalize_full_name(student.full_name)
+    if students:
+        await session.commit()
+    return len(students)
 
 
 async def get_or_create_lesson(session, group_id: int, lesson_date: date) -> Lesson:
@@ -121,49 +270,92 @@ async def get_or_create_lesson(session, group_id: int, lesson_date: date) -> Les
     )
     if lesson:
         return lesson
-    lesson = Lesson(group_id=group_id, lesson_date=lesson_date)
-    session.add(lesson)
+    # Concurrent graders may race to create today's lesson; the loser just reads it back.
+    await session.execute(
+        _insert(Lesson)
+        .values(group_id=group_id, lesson_date=lesson_date)
+        .on_conflict_do_nothing(index_elements=["group_id", "lesson_date"])
+    )
     await session.commit()
-    await session.refresh(lesson)
-    return lesson
+    return await session.scalar(
+        select(Lesson).where(Lesson.group_id == group_id, Lesson.lesson_date == lesson_date)
+    )
 
 
-async def ensure_lesson_grades(session, lesson_id: int, students: list[Student]) -> None:
-    existing = await session.execute(
-        select(LessonGrade.student_id).where(LessonGrade.lesson_id == lesson_id)
-    )
-    existing_ids = set(existing.scalars().all())
-    for student in students:
-        if student.id in existing_ids:
-            continue
-        session.add(
-            LessonGrade(
-                lesson_id=lesson_id,
-                student_id=student.id,
-                status=LessonGradeStatus.PENDING,
-                score=None,
-                updated_at=datetime.utcnow(),
-            )
+async def resolve_lesson_id(session, group_id: int, lesson_date: date) -> int:
+    lesson_id = cache.lesson_ids.get((group_id, lesson_date))
+    if lesson_id is None:
+        lesson = await get_or_create_lesson(session, group_id, lesson_date)
+        lesson_id = lesson.id
+        cache.remember_lesson(group_id, lesson_date, lesson_id)
+    return lesson_id
+
+
+async def find_lesson_id(session, group_id: int, lesson_date: date) -> int | None:
+    # Like resolve_lesson_id, but never creates the lesson.
+    lesson_id = cache.lesson_ids.get((group_id, lesson_date))
+    if lesson_id is None:
+        lesson_id = await session.scalar(
+            select(Lesson.id).where(Lesson.group_id == group_id, Lesson.lesson_date == lesson_date)
         )
+        if lesson_id is not None:
+            cache.remember_lesson(group_id, lesson_date, lesson_id)
+    return lesson_id
+
+
+_LESSON_STUDENT_IDS = select(LessonGrade.student_id).where(LessonGrade.lesson_id == bindparam("lesson_id"))
+_INSERT_GRADE_IF_MISSING = _insert(LessonGrade).on_conflict_do_nothing(index_elements=["lesson_id", "student_id"])
+
+
+async def ensure_lesson_grades(session, lesson_id: int, student_ids: list[int]) -> None:
+    existing = await session.execute(_LESSON_STUDENT_IDS, {"lesson_id": lesson_id})
+    existing_ids = set(existing.scalars().all())
+    now = datetime.utcnow()
+    missing = [
+        {
+            "lesson_id": lesson_id,
+            "student_id": student_id,
+            "status": LessonGradeStatus.PENDING,
+            "score": None,
+            "updated_at": now,
+        }
+        for student_id in student_ids
+        if student_id not in existing_ids
+    ]
+    if not missing:
+        return
+    await session.execute(_INSERT_GRADE_IF_MISSING, missing)
     await session.commit()
 
 
-async def create_or_update_parent(session, tg_user_id: int, full_name: str, phone: str) -> Parent:
-    parent = await session.scalar(select(Parent).where(Parent.tg_user_id == tg_user_id))
+async def create_or_update_parent(
+    session, tg_user_id: int, full_name: str, phone: str, tenant_id: str = DEFAULT_TENANT_ID
+) -> Parent:
+    parent = await get_parent_by_tg_user_id(session, tg_user_id, tenant_id)
     if parent:
         parent.full_name = full_name
         parent.phone = phone
         await session.commit()
         return parent
-    parent = Parent(tg_user_id=tg_user_id, full_name=full_name, phone=phone)
+    parent = Parent(tenant_id=tenant_id, tg_user_id=tg_user_id, full_name=full_name, phone=phone)
     session.add(parent)
     await session.commit()
     await session.refresh(parent)
     return parent
 
 
-async def get_parent_by_tg_user_id(session, tg_user_id: int) -> Parent | None:
-    return await session.scalar(select(Parent).where(Parent.tg_user_id == tg_user_id))
+_PARENT_BY_TG_USER_ID = select(Parent).where(
+    Parent.tenant_id == bindparam("tenant_id"), Parent.tg_user_id == bindparam("tg_user_id")
+)
+
+
+async def get_parent_by_tg_user_id(session, tg_user_id: int, tenant_id: str = DEFAULT_TENANT_ID) -> Parent | None:
+    return await session.scalar(_PARENT_BY_TG_USER_ID, {"tenant_id": tenant_id, "tg_user_id": tg_user_id})
+
+
+async def set_parent_delivery_mode(session, parent_id: int, mode: DeliveryMode) -> None:
+    await session.execute(update(Parent).where(Parent.id == parent_id).values(delivery_mode=mode))
+    await session.commit()
 
 
 async def link_parent_student(session, parent_id: int, student_id: int) -> bool:
@@ -179,12 +371,15 @@ async def link_parent_student(session, parent_id: int, student_id: int) -> bool:
     return True
 
 
+_PARENTS_FOR_STUDENT = (
+    select(Parent)
+    .join(ParentStudent, Parent.id == ParentStudent.parent_id)
+    .where(ParentStudent.student_id == bindparam("student_id"))
+)
+
+
 async def get_parents_for_student(session, student_id: int) -> list[Parent]:
-    result = await session.execute(
-        select(Parent)
-        .join(ParentStudent, Parent.id == ParentStudent.parent_id)
-        .where(ParentStudent.student_id == student_id)
-    )
+    result = await session.execute(_PARENTS_FOR_STUDENT, {"student_id": student_id})
     return list(result.scalars().all())
 
 
@@ -197,7 +392,17 @@ async def get_students_for_parent(session, parent_id: int) -> list[Student]:
     return list(result.scalars().all())
 
 
-async def get_groups_overview(session) -> list[tuple[str, int, int]]:
+# Admin reports: callers read through db.read_session(), never the grading engine.
+_PARENT_STUDENT_LINK = select(literal(1)).where(
+    ParentStudent.parent_id == bindparam("parent_id"), ParentStudent.student_id == bindparam("student_id")
+)
+
+
+async def is_student_linked(session, parent_id: int, student_id: int) -> bool:
+    return bool(await session.scalar(_PARENT_STUDENT_LINK, {"parent_id": parent_id, "student_id": student_id}))
+
+
+async def get_groups_overview(session, tenant_id: str = DEFAULT_TENANT_ID) -> list[tuple[str, int, int]]:
     result = await session.execute(
         select(
             Group.title,
@@ -205,21 +410,65 @@ async def get_groups_overview(session) -> list[tuple[str, int, int]]:
             func.count(Student.id).label("student_count"),
         )
         .outerjoin(Student, Student.group_id == Group.id)
+        .where(Group.tenant_id == tenant_id)
         .group_by(Group.id)
         .order_by(func.coalesce(Group.title, "").asc(), Group.chat_id.asc())
     )
     return list(result.all())
 
 
-async def get_all_students_with_group(session) -> list[tuple[str, str, str]]:
+async def get_all_students_with_group(session, tenant_id: str = DEFAULT_TENANT_ID) -> list[tuple[str, str, str]]:
     result = await session.execute(
         select(Student.full_name, Student.code, Group.title)
         .join(Group, Group.id == Student.group_id)
+        .where(Group.tenant_id == tenant_id)
         .order_by(func.coalesce(Group.title, "").asc(), Student.full_name.asc())
     )
     return list(result.all())
 
 
+_GRADE_STATE = (
+    select(LessonGrade.id, LessonGrade.status, LessonGrade.score, Student.full_name)
+    .join(Student, Student.id == LessonGrade.student_id)
+    .where(LessonGrade.lesson_id == bindparam("lesson_id"), LessonGrade.student_id == bindparam("student_id"))
+)
+# The ORM cannot evaluate bindparam() criteria against loaded objects; update_grade
+# returns what it wrote instead of an ORM row, so session synchronization is skipped.
+_SET_GRADE_IF_UNCHANGED = (
+    update(LessonGrade)
+    .where(
+        LessonGrade.id == bindparam("grade_id"),
+        LessonGrade.status == bindparam("old_status"),
+        LessonGrade.score.is_not_distinct_from(bindparam("old_score")),
+    )
+    .values(
+        status=bindparam("new_status"),
+        score=bindparam("new_score"),
+        graded_by_tg_user_id=bindparam("graded_by"),
+        updated_at=bindparam("now"),
+    )
+    .returning(LessonGrade.id)
+    .execution_options(synchronize_session=False)
+)
+
+
+# FOR SHARE on Postgres (SQLite ignores it): close_lesson's UPDATE of the lesson row waits for
+# this grade's transaction, and a grade arriving during a close waits and then sees closed_at.
+_LESSON_STATE = (
+    select(Lesson.group_id, Lesson.lesson_date, Lesson.closed_at)
+    .where(Lesson.id == bindparam("lesson_id"))
+    .with_for_update(read=True)
+)
+_INSERT_GRADE_EVENT = GradeEvent.__table__.insert().returning(GradeEvent.__table__.c.id)
+# The live write has applied this event to every projection; catch-up starts after it.
+_ADVANCE_PROJECTION_CHECKPOINTS = (
+    update(ProjectionCheckpoint)
+    .where(ProjectionCheckpoint.name.in_(LIVE_PROJECTIONS), ProjectionCheckpoint.last_event_id < bindparam("event_id"))
+    .values(last_event_id=bindparam("event_id"), updated_at=bindparam("now"))
+    .execution_options(synchronize_session=False)
+)
+
+
 async def update_grade(
     session,
     lesson_id: int,
@@ -227,59 +476,781 @@ async def update_grade(
     status: LessonGradeStatus,
     score: int | None,
     graded_by_tg_user_id: int | None,
-) -> LessonGrade:
-    grade = await session.scalar(
-        select(LessonGrade).where(
-            LessonGrade.lesson_id == lesson_id, LessonGrade.student_id == student_id
-        )
+) -> SavedGrade:
+    # Writing first takes the SQLite write lock up front, so concurrent graders queue
+    # instead of failing on a read->write lock upgrade.
+    await session.execute(
+        _INSERT_GRADE_IF_MISSING,
+        {
+            "lesson_id": lesson_id,
+            "student_id": student_id,
+            "status": LessonGradeStatus.PENDING,
+            "score": None,
+            "updated_at": datetime.utcnow(),
+        },
     )
-    if not grade:
-        grade = LessonGrade(lesson_id=lesson_id, student_id=student_id)
-        session.add(grade)
-        await session.commit()
-        await session.refresh(grade)
 
-    old_status = grade.status
-    grade.status = status
-    grade.score = score
-    grade.graded_by_tg_user_id = graded_by_tg_user_id
-    grade.updated_at = datetime.utcnow()
+    # Read under the SQLite write lock taken above, or the lesson row lock on Postgres, so a
+    # concurrent close lands entirely before or after this grade.
+    group_id, lesson_date, closed_at = (await session.execute(_LESSON_STATE, {"lesson_id": lesson_id})).one()
+    if closed_at is not None:
+        await session.rollback()
+        raise LessonClosedError(f"Lesson {lesson_id} is closed")
+
+    # Conditional UPDATE: it only applies if the row still holds the status/score we read,
+    # so the old status returned here is exactly the one this write replaced.
+    for _ in range(GRADE_UPDATE_ATTEMPTS):
+        grade_id, old_status, old_score, student_name = (
+            await session.execute(_GRADE_STATE, {"lesson_id": lesson_id, "student_id": student_id})
+        ).one()
+        updated_id = await session.scalar(
+            _SET_GRADE_IF_UNCHANGED,
+            {
+                "grade_id": grade_id,
+                "old_status": old_status,
+                "old_score": old_score,
+                "new_status": status,
+                "new_score": score,
+                "graded_by": graded_by_tg_user_id,
+                "now": datetime.utcnow(),
+            },
+        )
+        if updated_id is not None:
+            break
+    else:
+        await session.rollback()
+        raise RuntimeError(f"Grade for student {student_id} in lesson {lesson_id} keeps changing concurrently")
+
+    if (old_status, old_score) != (status, score):
+        # The event, the counters and the checkpoints commit together with the grade.
+        now = datetime.utcnow()
+        event_id = await session.scalar(
+            _INSERT_GRADE_EVENT,
+            {
+                "lesson_grade_id": grade_id,
+                "student_id": student_id,
+                "group_id": group_id,
+                "lesson_date": lesson_date,
+                "old_status": old_status,
+                "old_score": old_score,
+                "new_status": status,
+                "new_score": score,
+                "actor_tg_user_id": graded_by_tg_user_id,
+                "created_at": now,
+            },
+        )
+        await update_not_done_stats(session, student_id, old_status, status)
+        await update_daily_stats(session, student_id, group_id, lesson_date, old_status, old_score, status, score)
+        await session.execute(_ADVANCE_PROJECTION_CHECKPOINTS, {"event_id": event_id, "now": now})
     await session.commit()
+    cache.forget_grade_summaries([student_id])
+    return SavedGrade(grade_id, student_id, student_name, lesson_date, status, score)
 
-    await update_not_done_stats(session, student_id, old_status, status)
-    return grade
+
+def not_done_delta(old_status: LessonGradeStatus | None, new_status: LessonGradeStatus) -> int:
+    if old_status == LessonGradeStatus.NOT_DONE and new_status != LessonGradeStatus.NOT_DONE:
+        return -1
+    if old_status != LessonGradeStatus.NOT_DONE and new_status == LessonGradeStatus.NOT_DONE:
+        return 1
+    return 0
+
+
+_INSERT_STATS_IF_MISSING = _insert(StudentStats).on_conflict_do_nothing(index_elements=["student_id"])
+_NEW_NOT_DONE_COUNT = StudentStats.not_done_count + bindparam("delta", type_=Integer)
+_ADD_NOT_DONE = (
+    update(StudentStats)
+    .where(StudentStats.student_id == bindparam("stats_student_id"))
+    .values(not_done_count=case((_NEW_NOT_DONE_COUNT < 0, 0), else_=_NEW_NOT_DONE_COUNT), updated_at=bindparam("now"))
+    .execution_options(synchronize_session=False)
+)
 
 
 async def update_not_done_stats(
     session, student_id: int, old_status: LessonGradeStatus | None, new_status: LessonGradeStatus
 ) -> None:
-    stats = await session.get(StudentStats, student_id)
-    if not stats:
-        stats = StudentStats(student_id=student_id, not_done_count=0)
-        session.add(stats)
-        await session.commit()
+    await apply_not_done_deltas(session, {student_id: not_done_delta(old_status, new_status)})
 
-    if old_status == LessonGradeStatus.NOT_DONE and new_status != LessonGradeStatus.NOT_DONE:
-        stats.not_done_count = max(0, stats.not_done_count - 1)
-        stats.updated_at = datetime.utcnow()
+
+async def apply_not_done_deltas(session, deltas: dict[int, int]) -> None:
+    # Runs inside the caller's transaction; the counter is changed in SQL, never read-modify-write.
+    rows = [(student_id, delta) for student_id, delta in deltas.items() if delta]
+    if not rows:
+        return
+    now = datetime.utcnow()
+    conn = await session.connection()
+    await conn.execute(
+        _INSERT_STATS_IF_MISSING,
+        [{"student_id": student_id, "not_done_count": 0, "updated_at": now} for student_id, _ in rows],
+    )
+    await conn.execute(
+        _ADD_NOT_DONE, [{"stats_student_id": student_id, "delta": delta, "now": now} for student_id, delta in rows]
+    )
+
+
+async def reset_not_done_stats(session) -> None:
+    # Back to what the archived terms contributed; the ledger replay adds the current term.
+    await session.execute(update(StudentStats).values(not_done_count=0, updated_at=datetime.utcnow()))
+    archived = await session.execute(
+        select(TermSummary.student_id, func.sum(TermSummary.not_done_count)).group_by(TermSummary.student_id)
+    )
+    await apply_not_done_deltas(session, dict(archived.all()))
+
+
+def grade_contribution(status: LessonGradeStatus | None, score: int | None) -> dict[str, int]:
+    return {
+        "total_score": (score or 0) if status == LessonGradeStatus.DONE else 0,
+        "done_count": int(status == LessonGradeStatus.DONE),
+        "not_done_count": int(status == LessonGradeStatus.NOT_DONE),
+        "absent_count": int(status == LessonGradeStatus.ABSENT),
+    }
+
+
+DAILY_STATS_FIELDS = ("total_score", "done_count", "not_done_count", "absent_count")
+_INSERT_DAILY_STATS_IF_MISSING = _insert(StudentDailyStats).on_conflict_do_nothing(index_elements=["student_id", "day"])
+# All four counters are always incremented (unchanged ones by 0) so a single statement covers every grade change.
+_ADD_DAILY_STATS = (
+    update(StudentDailyStats)
+    .where(StudentDailyStats.student_id == bindparam("stats_student_id"), StudentDailyStats.day == bindparam("stats_day"))
+    .values(
+        {
+            field: getattr(StudentDailyStats, field) + bindparam(f"delta_{field}", type_=Integer)
+            for field in DAILY_STATS_FIELDS
+        }
+    )
+    .execution_options(synchronize_session=False)
+)
+
+
+async def update_daily_stats(
+    session,
+    student_id: int,
+    group_id: int,
+    lesson_date: date,
+    old_status: LessonGradeStatus | None,
+    old_score: int | None,
+    new_status: LessonGradeStatus,
+    new_score: int | None,
+) -> None:
+    old = grade_contribution(old_status, old_score)
+    new = grade_contribution(new_status, new_score)
+    await apply_daily_deltas(
+        session, {(student_id, lesson_date, group_id): {field: new[field] - old[field] for field in DAILY_STATS_FIELDS}}
+    )
+
+
+async def apply_daily_deltas(session, deltas: dict[tuple[int, date, int], dict[str, int]]) -> None:
+    # deltas: (student_id, day, group_id) -> change per DAILY_STATS_FIELDS counter.
+    rows = [(key, changes) for key, changes in deltas.items() if any(changes.values())]
+    if not rows:
+        return
+    conn = await session.connection()
+    await conn.execute(
+        _INSERT_DAILY_STATS_IF_MISSING,
+        [
+            {"student_id": student_id, "day": day, "group_id": group_id, **dict.fromkeys(DAILY_STATS_FIELDS, 0)}
+            for (student_id, day, group_id), _ in rows
+        ],
+    )
+    await conn.execute(
+        _ADD_DAILY_STATS,
+        [
+            {
+                "stats_student_id": student_id,
+                "stats_day": day,
+                **{f"delta_{field}": changes[field] for field in DAILY_STATS_FIELDS},
+            }
+            for (student_id, day, _), changes in rows
+        ],
+    )
+
+
+def _count_status(status: LessonGradeStatus):
+    return func.sum(case((LessonGrade.status == status, 1), else_=0))
+
+
+def _sum_done_score():
+    return func.sum(case((LessonGrade.status == LessonGradeStatus.DONE, func.coalesce(LessonGrade.score, 0)), else_=0))
+
+
+async def rebuild_daily_stats(session) -> int:
+    # Offline rebuild of the rollups from lesson_grades (python -m app.tools.rebuild_rollups).
+    aggregated = (
+        select(
+            LessonGrade.student_id,
+            Lesson.lesson_date,
+            Lesson.group_id,
+            _sum_done_score(),
+            _count_status(LessonGradeStatus.DONE),
+            _count_status(LessonGradeStatus.NOT_DONE),
+            _count_status(LessonGradeStatus.ABSENT),
+        )
+        .join(Lesson, Lesson.id == LessonGrade.lesson_id)
+        .where(LessonGrade.status != LessonGradeStatus.PENDING)
+        .group_by(LessonGrade.student_id, Lesson.lesson_date, Lesson.group_id)
+    )
+    await session.execute(delete(StudentDailyStats))
+    await session.execute(
+        StudentDailyStats.__table__.insert().from_select(
+            ["student_id", "day", "group_id", "total_score", "done_count", "not_done_count", "absent_count"],
+            aggregated,
+        )
+    )
+    await session.commit()
+    return await session.scalar(select(func.count()).select_from(StudentDailyStats))
+
+
+_CLOSE_LESSON = (
+    update(Lesson)
+    .where(Lesson.id == bindparam("close_lesson_id"), Lesson.closed_at.is_(None))
+    .values(closed_at=bindparam("now"))
+    .returning(Lesson.group_id, Lesson.lesson_date)
+    .execution_options(synchronize_session=False)
+)
+_CLOSE_PENDING_GRADES = (
+    update(LessonGrade)
+    .where(LessonGrade.lesson_id == bindparam("close_lesson_id"), LessonGrade.status == LessonGradeStatus.PENDING)
+    .values(
+        status=bindparam("new_status"),
+        score=None,
+        graded_by_tg_user_id=bindparam("actor"),
+        updated_at=bindparam("now"),
+    )
+    .returning(LessonGrade.id, LessonGrade.student_id)
+    .execution_options(synchronize_session=False)
+)
+# Already-notified grades keep their rows; only grades without one for a linked parent are queued.
+_ENQUEUE_LESSON_NOTIFICATIONS = (
+    _insert(Notification.__table__)
+    .from_select(
+        ["lesson_grade_id", "parent_id", "status"],
+        select(
+            LessonGrade.id,
+            ParentStudent.parent_id,
+            literal(NotificationStatus.PENDING, Notification.status.type),
+        )
+        .join(ParentStudent, ParentStudent.student_id == LessonGrade.student_id)
+        .where(
+            LessonGrade.lesson_id == bindparam("close_lesson_id", type_=Integer),
+            LessonGrade.status != LessonGradeStatus.PENDING,
+        ),
+    )
+    .on_conflict_do_nothing(index_elements=["lesson_grade_id", "parent_id"])
+)
+_LESSON_INSTANT_DELIVERIES = (
+    select(Notification.id, Parent.tg_user_id, Student.full_name, LessonGrade.status, LessonGrade.score)
+    .join(Parent, Parent.id == Notification.parent_id)
+    .join(LessonGrade, LessonGrade.id == Notification.lesson_grade_id)
+    .join(Student, Student.id == LessonGrade.student_id)
+    .where(
+        LessonGrade.lesson_id == bindparam("lesson_id"),
+        Notification.status == NotificationStatus.PENDING,
+        Parent.delivery_mode == DeliveryMode.INSTANT,
+    )
+    .order_by(Parent.tg_user_id, Student.full_name)
+)
+
+
+async def is_lesson_closed(session, lesson_id: int) -> bool:
+    return await session.scalar(select(Lesson.closed_at).where(Lesson.id == lesson_id)) is not None
+
+
+async def close_lesson(
+    session, lesson_id: int, status: LessonGradeStatus, closed_by_tg_user_id: int | None
+) -> int | None:
+    # One transaction: mark the lesson final, turn every PENDING grade into `status` with one
+    # UPDATE, write a ledger event for exactly the rows that UPDATE returned, apply the counters
+    # in one batch and queue the lesson's parent notifications. Returns how many grades were
+    # converted, or None if the lesson was already closed.
+    now = datetime.utcnow()
+    closed = (await session.execute(_CLOSE_LESSON, {"close_lesson_id": lesson_id, "now": now})).one_or_none()
+    if closed is None:
+        await session.rollback()
+        return None
+    group_id, lesson_date = closed
+
+    params = {"close_lesson_id": lesson_id, "new_status": status, "actor": closed_by_tg_user_id, "now": now}
+    converted = (await session.execute(_CLOSE_PENDING_GRADES, params)).all()
+    student_ids = [student_id for _, student_id in converted]
+    if converted:
+        events = [
+            {
+                "lesson_grade_id": grade_id,
+                "student_id": student_id,
+                "group_id": group_id,
+                "lesson_date": lesson_date,
+                "old_status": LessonGradeStatus.PENDING,
+                "old_score": None,
+                "new_status": status,
+                "new_score": None,
+                "actor_tg_user_id": closed_by_tg_user_id,
+                "created_at": now,
+            }
+            for grade_id, student_id in sorted(converted)
+        ]
+        event_ids = (await session.scalars(_INSERT_GRADE_EVENT, events)).all()
+        await apply_not_done_deltas(
+            session, {student_id: not_done_delta(LessonGradeStatus.PENDING, status) for student_id in student_ids}
+        )
+        contribution = grade_contribution(status, None)
+        await apply_daily_deltas(
+            session, {(student_id, lesson_date, group_id): contribution for student_id in student_ids}
+        )
+        await session.execute(_ADVANCE_PROJECTION_CHECKPOINTS, {"event_id": max(event_ids), "now": now})
+    await session.execute(_ENQUEUE_LESSON_NOTIFICATIONS, {"close_lesson_id": lesson_id})
+    await session.commit()
+    cache.forget_grade_summaries(student_ids)
+    return len(student_ids)
+
+
+async def get_open_lessons(
+    session, lesson_date: date, tenant_id: str = DEFAULT_TENANT_ID
+) -> list[tuple[int, int, int]]:
+    # (group_id, lesson_id, group chat_id); the chat id picks the worker in sharded mode.
+    result = await session.execute(
+        select(Lesson.group_id, Lesson.id, Group.chat_id)
+        .join(Group, Group.id == Lesson.group_id)
+        .where(Lesson.lesson_date == lesson_date, Lesson.closed_at.is_(None), Group.tenant_id == tenant_id)
+    )
+    return [tuple(row) for row in result.all()]
+
+
+async def get_lessons_on(session, lesson_date: date) -> list[tuple[int, int, bool]]:
+    # (group_id, lesson_id, every active student already has a grade row) for all tenants.
+    ungraded_student = (
+        select(Student.id)
+        .where(
+            Student.group_id == Lesson.group_id,
+            Student.status == StudentStatus.ACTIVE,
+            ~exists().where(LessonGrade.lesson_id == Lesson.id, LessonGrade.student_id == Student.id),
+        )
+        .exists()
+    )
+    result = await session.execute(
+        select(Lesson.group_id, Lesson.id, ~ungraded_student).where(Lesson.lesson_date == lesson_date)
+    )
+    return [(group_id, lesson_id, bool(ensured)) for group_id, lesson_id, ensured in result.all()]
+
+
+async def get_lesson_summary(session, lesson_id: int) -> dict[LessonGradeStatus, tuple[int, int]]:
+    # status -> (grade count, score sum)
+    result = await session.execute(
+        select(LessonGrade.status, func.count(), func.coalesce(func.sum(LessonGrade.score), 0))
+        .where(LessonGrade.lesson_id == lesson_id)
+        .group_by(LessonGrade.status)
+    )
+    return {status: (count, score_sum) for status, count, score_sum in result.all()}
+
+
+async def get_lesson_instant_deliveries(session, lesson_id: int) -> list[tuple]:
+    # (notification_id, chat_id, student_name, status, score) of queued rows for instant-mode parents.
+    result = await session.execute(_LESSON_INSTANT_DELIVERIES, {"lesson_id": lesson_id})
+    return list(result.all())
+
+
+async def archive_term(session, term: str, until: date, batch_size: int = ARCHIVE_BATCH_SIZE) -> dict[str, int]:
+    # Closes a term (python -m app.tools.archive_term): lessons before `until` are folded into
+    # term_summaries, then their detail rows are deleted in short transactions so the bot
+    # keeps grading meanwhile. Re-running the same term resumes an interrupted deletion.
+    # grade_events stay: the ledger is append-only, and projections skip archived dates.
+    counts = {"summaries": 0, "rollups": 0}
+    archived = await session.scalar(
+        select(TermSummary.ends_on).where(TermSummary.term == term).limit(1)
+    )
+    if archived is not None and archived != until:
+        raise ValueError(f"Term {term!r} is already archived until {archived}")
+
+    if archived is None:
+        aggregated = (
+            select(
+                LessonGrade.student_id,
+                Lesson.group_id,
+                literal(term),
+                literal(until),
+                func.sum(case((LessonGrade.status != LessonGradeStatus.PENDING, 1), else_=0)),
+                _sum_done_score(),
+                _count_status(LessonGradeStatus.DONE),
+                _count_status(LessonGradeStatus.NOT_DONE),
+                _count_status(LessonGradeStatus.ABSENT),
+            )
+            .join(Lesson, Lesson.id == LessonGrade.lesson_id)
+            .where(Lesson.lesson_date < until)
+            .group_by(LessonGrade.student_id, Lesson.group_id)
+        )
+        result = await session.execute(
+            TermSummary.__table__.insert().from_select(
+                [
+                    "student_id",
+                    "group_id",
+                    "term",
+                    "ends_on",
+                    "lesson_count",
+                    "total_score",
+                    "done_count",
+                    "not_done_count",
+                    "absent_count",
+                ],
+                aggregated,
+            )
+        )
+        counts["summaries"] = result.rowcount
+        # The rollups go in the same transaction, so the all-time leaderboard never counts a day twice.
+        result = await session.execute(delete(StudentDailyStats).where(StudentDailyStats.day < until))
+        counts["rollups"] = result.rowcount
         await session.commit()
-    elif old_status != LessonGradeStatus.NOT_DONE and new_status == LessonGradeStatus.NOT_DONE:
-        stats.not_done_count += 1
-        stats.updated_at = datetime.utcnow()
+
+    old_lessons = select(Lesson.id).where(Lesson.lesson_date < until)
+    old_grades = select(LessonGrade.id).where(LessonGrade.lesson_id.in_(old_lessons))
+    counts["notifications"] = await _delete_in_batches(
+        session, Notification, Notification.lesson_grade_id.in_(old_grades), batch_size
+    )
+    counts["grades"] = await _delete_in_batches(session, LessonGrade, LessonGrade.lesson_id.in_(old_lessons), batch_size)
+    counts["lessons"] = await _delete_in_batches(session, Lesson, Lesson.lesson_date < until, batch_size)
+    return counts
+
+
+async def _delete_in_batches(session, model, condition, batch_size: int) -> int:
+    deleted = 0
+    while True:
+        ids = list(await session.scalars(select(model.id).where(condition).limit(batch_size)))
+        if not ids:
+            return deleted
+        await session.execute(delete(model).where(model.id.in_(ids)))
         await session.commit()
+        deleted += len(ids)
 
 
-async def get_lesson_grade_with_relations(session, lesson_grade_id: int) -> LessonGrade | None:
-    return await session.scalar(
-        select(LessonGrade)
-        .options(
-            selectinload(LessonGrade.student),
-            selectinload(LessonGrade.lesson).selectinload(Lesson.group),
+async def get_term_summaries_for_student(session, student_id: int) -> list[TermSummary]:
+    result = await session.execute(
+        select(TermSummary).where(TermSummary.student_id == student_id).order_by(TermSummary.ends_on.asc())
+    )
+    return list(result.scalars().all())
+
+
+async def get_group_ids_by_chat(session, tenant_id: str = DEFAULT_TENANT_ID) -> dict[int, int]:
+    result = await session.execute(select(Group.chat_id, Group.id).where(Group.tenant_id == tenant_id))
+    return dict(result.all())
+
+
+async def get_students_by_code(session, group_ids) -> dict[str, tuple[int, int]]:
+    # code -> (student_id, group_id)
+    result = await session.execute(
+        select(Student.code, Student.id, Student.group_id).where(Student.group_id.in_(list(group_ids)))
+    )
+    return {code: (student_id, group_id) for code, student_id, group_id in result.all()}
+
+
+async def get_lesson_ids_for_groups(session, group_ids) -> dict[tuple[int, date], int]:
+    result = await session.execute(
+        select(Lesson.group_id, Lesson.lesson_date, Lesson.id).where(Lesson.group_id.in_(list(group_ids)))
+    )
+    return {(group_id, lesson_date): lesson_id for group_id, lesson_date, lesson_id in result.all()}
+
+
+_INSERT_LESSON_IF_MISSING = _insert(Lesson).on_conflict_do_nothing(index_elements=["group_id", "lesson_date"])
+_IMPORTED_GRADE_STATE = select(
+    LessonGrade.id, LessonGrade.lesson_id, LessonGrade.student_id, LessonGrade.status, LessonGrade.score
+)
+
+
+def _upsert_imported_grades():
+    statement = _insert(LessonGrade)
+    return statement.on_conflict_do_update(
+        index_elements=["lesson_id", "student_id"],
+        set_={
+            "status": statement.excluded.status,
+            "score": statement.excluded.score,
+            "graded_by_tg_user_id": None,
+            "updated_at": statement.excluded.updated_at,
+        },
+    )
+
+
+_UPSERT_IMPORTED_GRADES = _upsert_imported_grades()
+_INSERT_IMPORTED_EVENTS = GradeEvent.__table__.insert().returning(*GradeEvent.__table__.c)
+
+
+async def import_grade_batch(
+    session, rows: dict[tuple[int, date, int], tuple[LessonGradeStatus, int | None]], lesson_ids: dict
+) -> list:
+    # Offline import of past grades (python -m app.tools.import_grades), one transaction per batch.
+    # rows: (group_id, lesson_date, student_id) -> (status, score); lesson_ids is the caller's
+    # (group_id, lesson_date) -> lesson_id map and is filled in here. Imported lessons are closed,
+    # nothing is queued for parents, and every change is written to the ledger. Returns the new
+    # events uncommitted: the caller folds them into the counters in the same transaction.
+    now = datetime.utcnow()
+    conn = await session.connection()
+    new_lessons = {(group_id, lesson_date) for group_id, lesson_date, _ in rows} - lesson_ids.keys()
+    if new_lessons:
+        await conn.execute(
+            _INSERT_LESSON_IF_MISSING,
+            [{"group_id": group_id, "lesson_date": day, "closed_at": now} for group_id, day in new_lessons],
+        )
+        created = await conn.execute(
+            select(Lesson.group_id, Lesson.lesson_date, Lesson.id).where(
+                Lesson.group_id.in_({group_id for group_id, _ in new_lessons}),
+                Lesson.lesson_date.in_({day for _, day in new_lessons}),
+            )
+        )
+        lesson_ids.update({(group_id, day): lesson_id for group_id, day, lesson_id in created.all()})
+
+    grades = {
+        (lesson_ids[(group_id, day)], student_id): (group_id, day, status, score)
+        for (group_id, day, student_id), (status, score) in rows.items()
+    }
+    state_query = _IMPORTED_GRADE_STATE.where(
+        LessonGrade.lesson_id.in_({lesson_id for lesson_id, _ in grades}),
+        LessonGrade.student_id.in_({student_id for _, student_id in grades}),
+    )
+    old = {
+        (lesson_id, student_id): (status, score)
+        for _, lesson_id, student_id, status, score in (await conn.execute(state_query)).all()
+    }
+    changed = {
+        key: value for key, value in grades.items() if old.get(key, (LessonGradeStatus.PENDING, None)) != value[2:]
+    }
+    if not changed:
+        return []
+
+    await conn.execute(
+        _UPSERT_IMPORTED_GRADES,
+        [
+            {"lesson_id": lesson_id, "student_id": student_id, "status": status, "score": score, "updated_at": now}
+            for (lesson_id, student_id), (_, _, status, score) in changed.items()
+        ],
+    )
+    grade_ids = {
+        (lesson_id, student_id): grade_id
+        for grade_id, lesson_id, student_id, _, _ in (await conn.execute(state_query)).all()
+    }
+    events = []
+    for key, (group_id, day, status, score) in changed.items():
+        old_status, old_score = old.get(key, (LessonGradeStatus.PENDING, None))
+        events.append(
+            {
+                "lesson_grade_id": grade_ids[key],
+                "student_id": key[1],
+                "group_id": group_id,
+                "lesson_date": day,
+                "old_status": old_status,
+                "old_score": old_score,
+                "new_status": status,
+                "new_score": score,
+                "actor_tg_user_id": None,
+                "created_at": now,
+            }
+        )
+    return (await conn.execute(_INSERT_IMPORTED_EVENTS, events)).all()
+
+
+async def backfill_grade_events(session) -> int:
+    # Grades saved before the ledger existed get one synthetic PENDING -> current event each,
+    # so replaying the ledger reproduces the counters they already contributed to.
+    if await session.scalar(select(literal(1)).select_from(GradeEvent).limit(1)):
+        return 0
+    result = await session.execute(
+        GradeEvent.__table__.insert().from_select(
+            [
+                "lesson_grade_id",
+                "student_id",
+                "group_id",
+                "lesson_date",
+                "old_status",
+                "old_score",
+                "new_status",
+                "new_score",
+                "actor_tg_user_id",
+                "created_at",
+            ],
+            select(
+                LessonGrade.id,
+                LessonGrade.student_id,
+                Lesson.group_id,
+                Lesson.lesson_date,
+                literal(LessonGradeStatus.PENDING, GradeEvent.old_status.type),
+                null(),
+                LessonGrade.status,
+                LessonGrade.score,
+                LessonGrade.graded_by_tg_user_id,
+                LessonGrade.updated_at,
+            )
+            .join(Lesson, Lesson.id == LessonGrade.lesson_id)
+            .where(LessonGrade.status != LessonGradeStatus.PENDING)
+            .order_by(LessonGrade.updated_at, LessonGrade.id),
+        )
+    )
+    await session.commit()
+    return result.rowcount
+
+
+async def ensure_projection_checkpoints(session) -> None:
+    # A new checkpoint starts at the end of the ledger: the live tables already include all of it.
+    last_event_id = await session.scalar(select(func.coalesce(func.max(GradeEvent.id), 0)))
+    await session.execute(
+        _insert(ProjectionCheckpoint).on_conflict_do_nothing(index_elements=["name"]),
+        [{"name": name, "last_event_id": last_event_id, "updated_at": datetime.utcnow()} for name in LIVE_PROJECTIONS],
+    )
+    await session.commit()
+
+
+async def advance_projection_checkpoints(session, event_id: int) -> None:
+    # For events folded into the live projections outside update_grade and close_lesson.
+    await session.execute(_ADVANCE_PROJECTION_CHECKPOINTS, {"event_id": event_id, "now": datetime.utcnow()})
+
+
+async def get_projection_checkpoint(session, name: str) -> int:
+    last_event_id = await session.scalar(
+        select(ProjectionCheckpoint.last_event_id).where(ProjectionCheckpoint.name == name)
+    )
+    return last_event_id or 0
+
+
+async def set_projection_checkpoint(session, name: str, last_event_id: int) -> None:
+    await session.execute(
+        _insert(ProjectionCheckpoint)
+        .values(name=name, last_event_id=last_event_id, updated_at=datetime.utcnow())
+        .on_conflict_do_update(
+            index_elements=["name"], set_={"last_event_id": last_event_id, "updated_at": datetime.utcnow()}
         )
-        .where(LessonGrade.id == lesson_grade_id)
     )
 
 
+_GRADE_EVENTS_AFTER = (
+    select(GradeEvent)
+    .where(GradeEvent.id > bindparam("after_id"), GradeEvent.lesson_date >= bindparam("since"))
+    .order_by(GradeEvent.id.asc())
+    .limit(bindparam("limit"))
+)
+
+
+async def get_archived_until(session) -> date | None:
+    # First day after the last archived term; older days live only in term_summaries.
+    return await session.scalar(select(func.max(TermSummary.ends_on)))
+
+
+async def get_grade_events_after(session, after_id: int, limit: int, since: date | None = None) -> list[GradeEvent]:
+    result = await session.execute(
+        _GRADE_EVENTS_AFTER, {"after_id": after_id, "since": since or date.min, "limit": limit}
+    )
+    return list(result.scalars().all())
+
+
+async def get_grade_events_for_student(session, student_id: int, limit: int = 50) -> list[GradeEvent]:
+    result = await session.execute(
+        select(GradeEvent).where(GradeEvent.student_id == student_id).order_by(GradeEvent.id.desc()).limit(limit)
+    )
+    return list(result.scalars().all())
+
+
+async def daily_stats_need_rebuild(session) -> bool:
+    has_rollups = await session.scalar(select(literal(1)).select_from(StudentDailyStats).limit(1))
+    if has_rollups:
+        return False
+    has_grades = await session.scalar(
+        select(literal(1)).select_from(LessonGrade).where(LessonGrade.status != LessonGradeStatus.PENDING).limit(1)
+    )
+    return bool(has_grades)
+
+
+_GRADE_WITH_RELATIONS = (
+    select(LessonGrade)
+    .options(
+        selectinload(LessonGrade.student),
+        selectinload(LessonGrade.lesson).selectinload(Lesson.group),
+    )
+    .where(LessonGrade.id == bindparam("lesson_grade_id"))
+)
+
+
+_HISTORY_ROWS = (
+    select(Lesson.lesson_date, Lesson.id, Group.title, LessonGrade.status, LessonGrade.score)
+    .join(Lesson, Lesson.id == LessonGrade.lesson_id)
+    .join(Group, Group.id == Lesson.group_id)
+    .where(
+        LessonGrade.student_id == bindparam("history_student_id"),
+        LessonGrade.status != LessonGradeStatus.PENDING,
+    )
+    .limit(bindparam("limit"))
+)
+_HISTORY_KEY = tuple_(Lesson.lesson_date, Lesson.id)
+_HISTORY_CURSOR = tuple_(bindparam("cursor_date"), bindparam("cursor_lesson_id"))
+_HISTORY_OLDER = _HISTORY_ROWS.where(_HISTORY_KEY < _HISTORY_CURSOR).order_by(
+    Lesson.lesson_date.desc(), Lesson.id.desc()
+)
+_HISTORY_NEWER = _HISTORY_ROWS.where(_HISTORY_KEY > _HISTORY_CURSOR).order_by(Lesson.lesson_date, Lesson.id)
+_HISTORY_LATEST = _HISTORY_ROWS.order_by(Lesson.lesson_date.desc(), Lesson.id.desc())
+
+
+async def get_grade_history_page(
+    session,
+    student_id: int,
+    limit: int,
+    older_than: tuple[date, int] | None = None,
+    newer_than: tuple[date, int] | None = None,
+) -> tuple[list[tuple[date, int, str | None, LessonGradeStatus, int | None]], bool]:
+    # Keyset page over the student's graded lessons, newest first; the cursor is a (lesson_date, lesson_id)
+    # of the current page, since a student moved between groups can have two lessons on one day.
+    # Returns (lesson_date, lesson_id, group_title, status, score) rows and whether another page exists
+    # past them in the direction of travel.
+    params = {"history_student_id": student_id, "limit": limit + 1}
+    cursor = newer_than or older_than
+    if cursor is not None:
+        params.update(cursor_date=cursor[0], cursor_lesson_id=cursor[1])
+    if newer_than is not None:
+        result = await session.execute(_HISTORY_NEWER, params)
+    elif older_than is not None:
+        result = await session.execute(_HISTORY_OLDER, params)
+    else:
+        result = await session.execute(_HISTORY_LATEST, params)
+    rows = [tuple(row) for row in result.all()]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if newer_than is not None:
+        rows.reverse()
+    return rows, has_more
+
+
+_SUMMARY_PARTS = union_all(
+    select(
+        StudentDailyStats.done_count + StudentDailyStats.not_done_count + StudentDailyStats.absent_count,
+        StudentDailyStats.total_score,
+        StudentDailyStats.done_count,
+        StudentDailyStats.absent_count,
+    ).where(StudentDailyStats.student_id == bindparam("summary_student_id")),
+    select(TermSummary.lesson_count, TermSummary.total_score, TermSummary.done_count, TermSummary.absent_count).where(
+        TermSummary.student_id == bindparam("summary_student_id")
+    ),
+).subquery()
+# Current term from the rollups plus archived terms; the not-done count comes from student_stats.
+_GRADE_SUMMARY = select(
+    *(func.coalesce(func.sum(column), 0) for column in _SUMMARY_PARTS.c),
+    select(StudentStats.not_done_count)
+    .where(StudentStats.student_id == bindparam("summary_student_id"))
+    .scalar_subquery(),
+)
+
+
+# With WORKERS > 1 the grade is written by the group chat's worker while the parent's chat is
+# served by another one, which would keep a stale summary; the query runs every time instead.
+_CACHE_GRADE_SUMMARIES = WORKERS == 1
+
+
+async def get_grade_summary(session, student_id: int) -> GradeSummary:
+    cached = cache.grade_summaries.get(student_id) if _CACHE_GRADE_SUMMARIES else None
+    if cached is not None:
+        return cached
+    lessons, total_score, done, absent, not_done = (
+        await session.execute(_GRADE_SUMMARY, {"summary_student_id": student_id})
+    ).one()
+    summary = GradeSummary(lessons, total_score, done, not_done or 0, absent)
+    if _CACHE_GRADE_SUMMARIES:
+        cache.grade_summaries.set(student_id, summary)
+    return summary
+
+
+async def get_lesson_grade_with_relations(session, lesson_grade_id: int) -> LessonGrade | None:
+    return await session.scalar(_GRADE_WITH_RELATIONS, {"lesson_grade_id": lesson_grade_id})
+
+
 async def get_notifications_for_parent(session, parent_id: int, student_id: int) -> list[LessonGrade]:
     result = await session.execute(
         select(LessonGrade)
@@ -294,44 +1265,66 @@ async def get_notifications_for_parent(session, parent_id: int, student_id: int)
     return list(result.scalars().all())
 
 
-async def get_group_leaderboard_rows(session, group_id: int) -> list[dict]:
-    students = await get_active_students(session, group_id)
-    if not students:
-        return []
-
-    rows: dict[int, dict] = {}
-    for student in students:
-        rows[student.id] = {
-            "student_id": student.id,
-            "full_name": student.full_name,
-            "total_score": 0,
-            "done_count": 0,
-            "not_done_count": 0,
-            "absent_count": 0,
-        }
-
-    grades_result = await session.execute(
-        select(LessonGrade.student_id, LessonGrade.status, LessonGrade.score)
-        .join(Lesson, Lesson.id == LessonGrade.lesson_id)
-        .where(Lesson.group_id == group_id)
+async def get_group_leaderboard_rows(session, group_id: int, since: date | None = None) -> list[dict]:
+    parts = select(
+        StudentDailyStats.student_id,
+        StudentDailyStats.total_score,
+        StudentDailyStats.done_count,
+        StudentDailyStats.not_done_count,
+        StudentDailyStats.absent_count,
+    ).where(StudentDailyStats.group_id == group_id)
+    if since is not None:
+        parts = parts.where(StudentDailyStats.day >= since)
+    else:
+        # All-time totals: archived terms plus the current term's rollups.
+        parts = parts.union_all(
+            select(
+                TermSummary.student_id,
+                TermSummary.total_score,
+                TermSummary.done_count,
+                TermSummary.not_done_count,
+                TermSummary.absent_count,
+            ).where(TermSummary.group_id == group_id)
+        )
+    parts = parts.subquery()
+    totals = (
+        select(
+            parts.c.student_id,
+            func.sum(parts.c.total_score).label("total_score"),
+            func.sum(parts.c.done_count).label("done_count"),
+            func.sum(parts.c.not_done_count).label("not_done_count"),
+            func.sum(parts.c.absent_count).label("absent_count"),
+        )
+        .group_by(parts.c.student_id)
+        .subquery()
     )
 
-    for student_id, status, score in grades_result.all():
-        if student_id not in rows:
-            continue
-        if status == LessonGradeStatus.DONE:
-            rows[student_id]["done_count"] += 1
-            rows[student_id]["total_score"] += score or 0
-        elif status == LessonGradeStatus.NOT_DONE:
-            rows[student_id]["not_done_count"] += 1
-        elif status == LessonGradeStatus.ABSENT:
-            rows[student_id]["absent_count"] += 1
+    result = await session.execute(
+        select(
+            Student.id,
+            Student.full_name,
+            func.coalesce(totals.c.total_score, 0),
+            func.coalesce(totals.c.done_count, 0),
+            func.coalesce(totals.c.not_done_count, 0),
+            func.coalesce(totals.c.absent_count, 0),
+        )
+        .outerjoin(totals, totals.c.student_id == Student.id)
+        .where(Student.group_id == group_id, Student.status == StudentStatus.ACTIVE)
+    )
 
     result_rows = []
-    for row in rows.values():
-        done_count = row["done_count"]
-        row["avg_score"] = round(row["total_score"] / done_count, 2) if done_count else 0.0
-        result_rows.append(row)
+    for student_id, full_name, total_score, done_count, not_done_count, absent_count in result.all():
+        result_rows.append(
+            {
+                "student_id": student_id,
+                "full_name": full_name,
+                "total_score": total_score,
+                "done_count": done_count,
+                "not_done_count": not_done_count,
+                "absent_count": absent_count,
+                "avg_score": round(total_score / done_count, 2) if done_count else 0.0,
+            }
+        )
 
     result_rows.sort(
         key=lambda r: (
@@ -344,17 +1337,130 @@ async def get_group_leaderboard_rows(session, group_id: int) -> list[dict]:
     return result_rows
 
 
-async def get_notification(session, lesson_grade_id: int, parent_id: int) -> Notification | None:
-    return await session.scalar(
-        select(Notification).where(
-            Notification.lesson_grade_id == lesson_grade_id, Notification.parent_id == parent_id
+# Core table insert: the ORM bulk-insert path does not accept INSERT ... SELECT with parameters.
+_ENQUEUE_GRADE_NOTIFICATIONS = (
+    _insert(Notification.__table__)
+    .from_select(
+        ["lesson_grade_id", "parent_id", "status"],
+        select(
+            bindparam("lesson_grade_id", type_=Integer),
+            ParentStudent.parent_id,
+            literal(NotificationStatus.PENDING, Notification.status.type),
+        ).where(ParentStudent.student_id == bindparam("student_id")),
+    )
+    .on_conflict_do_update(
+        index_elements=["lesson_grade_id", "parent_id"],
+        set_={"status": NotificationStatus.PENDING, "sent_at": None, "error": None},
+    )
+)
+# A parent who just linked the child: rows they already have (sent or not) are left alone.
+_ENQUEUE_PARENT_NOTIFICATIONS = _insert(Notification.__table__).on_conflict_do_nothing(
+    index_elements=["lesson_grade_id", "parent_id"]
+)
+_INSTANT_DELIVERY_TARGETS = (
+    select(Notification.id, Parent.tg_user_id, Notification.lesson_grade_id)
+    .join(Parent, Parent.id == Notification.parent_id)
+    .where(
+        Notification.lesson_grade_id.in_(bindparam("lesson_grade_ids", expanding=True)),
+        Notification.status == NotificationStatus.PENDING,
+        Parent.delivery_mode == DeliveryMode.INSTANT,
+    )
+    .order_by(Notification.id)
+)
+_PARENT_DELIVERY_TARGETS = _INSTANT_DELIVERY_TARGETS.where(Notification.parent_id == bindparam("parent_id"))
+
+
+async def enqueue_grade_notifications(
+    session, lesson_grade_ids: list[int], student_id: int, parent_id: int | None = None
+) -> list[tuple[int, int, int]]:
+    # The one write path into the outbox for graded lessons. Queues the grades for every linked
+    # parent; a regrade re-queues rows that were already sent, so parents hear about the new
+    # value. With parent_id only that parent's missing rows are queued. Returns (notification_id,
+    # chat_id, lesson_grade_id) for instant-mode parents; digest-mode rows wait for the digest.
+    if not lesson_grade_ids:
+        return []
+    conn = await session.connection()
+    if parent_id is None:
+        await conn.execute(
+            _ENQUEUE_GRADE_NOTIFICATIONS,
+            [{"lesson_grade_id": grade_id, "student_id": student_id} for grade_id in lesson_grade_ids],
+        )
+        result = await session.execute(_INSTANT_DELIVERY_TARGETS, {"lesson_grade_ids": lesson_grade_ids})
+    else:
+        await conn.execute(
+            _ENQUEUE_PARENT_NOTIFICATIONS,
+            [
+                {"lesson_grade_id": grade_id, "parent_id": parent_id, "status": NotificationStatus.PENDING}
+                for grade_id in lesson_grade_ids
+            ],
+        )
+        result = await session.execute(
+            _PARENT_DELIVERY_TARGETS, {"lesson_grade_ids": lesson_grade_ids, "parent_id": parent_id}
+        )
+    targets = [tuple(row) for row in result.all()]
+    await session.commit()
+    return targets
+
+
+async def get_outbox_depth(session) -> dict[str, int]:
+    # Unsent notifications per delivery mode; digest rows are expected to wait until DIGEST_TIME.
+    result = await session.execute(
+        select(Parent.delivery_mode, func.count())
+        .select_from(Notification)
+        .join(Parent, Parent.id == Notification.parent_id)
+        .where(Notification.status == NotificationStatus.PENDING)
+        .group_by(Parent.delivery_mode)
+    )
+    depth = {mode.value.lower(): 0 for mode in DeliveryMode}
+    for mode, count in result.all():
+        depth[mode.value.lower()] = count
+    return depth
+
+
+async def get_pending_digest_rows(session, tenant_id: str = DEFAULT_TENANT_ID) -> list[tuple]:
+    # One grouped query over every unsent grade of digest-mode parents, ordered for per-parent messages.
+    result = await session.execute(
+        select(
+            Notification.id,
+            Parent.id,
+            Parent.tg_user_id,
+            Student.full_name,
+            Group.title,
+            Lesson.lesson_date,
+            LessonGrade.status,
+            LessonGrade.score,
         )
+        .join(Parent, Parent.id == Notification.parent_id)
+        .join(LessonGrade, LessonGrade.id == Notification.lesson_grade_id)
+        .join(Student, Student.id == LessonGrade.student_id)
+        .join(Lesson, Lesson.id == LessonGrade.lesson_id)
+        .join(Group, Group.id == Lesson.group_id)
+        .where(
+            Notification.status == NotificationStatus.PENDING,
+            Parent.delivery_mode == DeliveryMode.DIGEST,
+            Parent.tenant_id == tenant_id,
+        )
+        .order_by(Parent.id.asc(), Student.full_name.asc(), Lesson.lesson_date.asc())
     )
+    return list(result.all())
 
 
-async def create_notification(session, lesson_grade_id: int, parent_id: int) -> Notification:
-    notification = Notification(lesson_grade_id=lesson_grade_id, parent_id=parent_id)
-    session.add(notification)
+async def mark_deliveries(session, sent_ids: list[int], failed: list[tuple[int, str]]) -> None:
+    # One UPDATE for all delivered rows and one executemany for the failures (each with its own error).
+    if not sent_ids and not failed:
+        return
+    if sent_ids:
+        await session.execute(
+            update(Notification)
+            .where(Notification.id.in_(sent_ids))
+            .values(status=NotificationStatus.SENT, sent_at=datetime.utcnow(), error=None)
+        )
+    if failed:
+        await session.execute(
+            update(Notification),
+            [
+                {"id": notification_id, "status": NotificationStatus.FAILED, "sent_at": None, "error": error[:255]}
+                for notification_id, error in failed
+            ],
+        )
     await session.commit()
-    await session.refresh(notification)
-    return notification
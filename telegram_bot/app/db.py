@@ -1,12 +1,163 @@
+import hashlib
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, String, Table, delete, event, insert, inspect, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from app.config import DATABASE_URL
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+from app.config import DATABASE_URL, DB_POOL_SIZE, READ_DATABASE_URL, READ_POOL_SIZE, READ_STATEMENT_TIMEOUT_MS
 
 Base = declarative_base()
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+
+def _is_sqlite_file(url) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def _pool_options(url) -> dict:
+    # In-memory SQLite uses a StaticPool, which takes no pool size.
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and not _is_sqlite_file(url):
+        return {}
+    return {"pool_size": DB_POOL_SIZE}
+
+
+# One engine (and connection pool) for every tenant's bot in the process.
+engine = create_async_engine(DATABASE_URL, echo=False, future=True, **_pool_options(DATABASE_URL))
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
-async def init_db() -> None:
+# SQLite VM instructions between two statement-timeout checks on read connections.
+PROGRESS_HANDLER_STEPS = 10000
+
+
+def _create_read_engine():
+    # Reports never share the grading pool. Without READ_DATABASE_URL a SQLite file is opened
+    # read-only (it can never take the write lock; with WAL it doesn't block writers either)
+    # and Postgres gets a separate read-only pool on the same server.
+    url = make_url(READ_DATABASE_URL or DATABASE_URL)
+    if url.get_backend_name() == "sqlite":
+        if not _is_sqlite_file(url):
+            return engine
+        if not READ_DATABASE_URL and not url.database.startswith("file:"):
+            url = url.set(database=f"file:{url.database}", query={**url.query, "mode": "ro", "uri": "true"})
+        read_engine = create_async_engine(url, future=True, pool_size=READ_POOL_SIZE, max_overflow=0)
+        event.listen(read_engine.sync_engine, "connect", _install_statement_timeout)
+        event.listen(read_engine.sync_engine, "before_cursor_execute", _start_statement_clock)
+        return read_engine
+
+    timeout = str(READ_STATEMENT_TIMEOUT_MS)
+    if url.get_driver_name() == "asyncpg":
+        connect_args = {"server_settings": {"statement_timeout": timeout, "default_transaction_read_only": "on"}}
+    else:
+        connect_args = {"options": f"-c statement_timeout={timeout} -c default_transaction_read_only=on"}
+    return create_async_engine(url, future=True, pool_size=READ_POOL_SIZE, max_overflow=0, connect_args=connect_args)
+
+
+def _install_statement_timeout(dbapi_connection, connection_record) -> None:
+    # SQLite has no statement timeout; a progress handler aborts the statement ("interrupted")
+    # once it runs past its deadline.
+    deadline = connection_record.info["statement_deadline"] = [0.0]
+
+    def check() -> int:
+        return int(bool(deadline[0]) and time.monotonic() > deadline[0])
+
+    dbapi_connection.await_(
+        dbapi_connection.driver_connection.set_progress_handler(check, PROGRESS_HANDLER_STEPS)
+    )
+
+
+def _start_statement_clock(conn, cursor, statement, parameters, context, executemany) -> None:
+    deadline = conn.info.get("statement_deadline")
+    if deadline is not None:
+        deadline[0] = time.monotonic() + READ_STATEMENT_TIMEOUT_MS / 1000
+
+
+read_engine = _create_read_engine()
+# For admin reports and exports only: may lag behind (replica) and cannot write.
+read_session = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+# One row: the fingerprint of the models the schema was last created/migrated for.
+schema_version = Table(
+    "schema_version",
+    Base.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("fingerprint", String(64), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def schema_fingerprint(dialect) -> str:
+    # Hash of the DDL the models compile to, so any column, type or index change shows up.
+    digest = hashlib.sha256()
+    for table in Base.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return digest.hexdigest()
+
+
+async def _stored_fingerprint() -> str | None:
+    async with engine.connect() as conn:
+        try:
+            return await conn.scalar(select(schema_version.c.fingerprint).where(schema_version.c.id == 1))
+        except DBAPIError:
+            # A database created before schema_version existed (or an empty one).
+            return None
+
+
+async def init_db() -> bool:
+    # Reflecting every table on each start is the slow part of booting; it only runs when
+    # the models changed since the stored fingerprint. Returns whether it ran.
+    fingerprint = schema_fingerprint(engine.dialect)
+    if await _stored_fingerprint() == fingerprint:
+        return False
+    if _is_sqlite_file(engine.url):
+        # WAL lets the read-only report connections read while grading writes; persistent per file.
+        async with engine.connect() as conn:
+            await conn.exec_driver_sql("PRAGMA journal_mode=WAL")
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.execute(delete(schema_version))
+        await conn.execute(
+            insert(schema_version).values(id=1, fingerprint=fingerprint, applied_at=datetime.utcnow())
+        )
+    return True
+
+
+def _add_missing_columns(sync_conn) -> None:
+    # create_all never alters existing tables, so columns added to models later
+    # (with a default) are added here, together with their indexes and any new index.
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        added = [column for column in table.columns if column.name not in existing]
+        for column in added:
+            column_ddl = CreateColumn(column).compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+        added_names = {column.name for column in added}
+        existing_indexes = {index["name"]: index for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            current = existing_indexes.get(index.name)
+            if current is not None and bool(current["unique"]) != bool(index.unique):
+                # e.g. parents.tg_user_id: unique per tenant now, no longer globally.
+                index.drop(sync_conn)
+                index.create(sync_conn)
+            elif current is None or added_names & {column.name for column in index.columns}:
+                index.create(sync_conn, checkfirst=True)
+
+
+async def vacuum_analyze() -> None:
+    # VACUUM cannot run inside a transaction block.
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if conn.dialect.name == "sqlite":
+            await conn.execute(text("VACUUM"))
+            await conn.execute(text("ANALYZE"))
+        else:
+            await conn.execute(text("VACUUM ANALYZE"))
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from datetime import datetime, time, timedelta
+from itertools import groupby
+
+from aiogram import Bot
+
+from app import crud
+from app.config import DIGEST_TIME, LOCAL_TZ
+from app.db import async_session
+from app.fanout import Delivery, fan_out
+from app.models import DEFAULT_TENANT_ID
+from app.text import format_digest_message, split_text
+
+logger = logging.getLogger(__name__)
+
+
+def seconds_until_next_run(now: datetime, at: str = DIGEST_TIME) -> float:
+    hour, minute = (int(part) for part in at.split(":"))
+    run_at = datetime.combine(now.date(), time(hour, minute), tzinfo=now.tzinfo)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return (run_at - now).total_seconds()
+
+
+async def run_digest_scheduler(bot: Bot, tenant_id: str = DEFAULT_TENANT_ID) -> None:
+    while True:
+        await asyncio.sleep(seconds_until_next_run(datetime.now(LOCAL_TZ)))
+        try:
+            await send_daily_digests(bot, tenant_id)
+        except Exception:
+            logger.exception("Daily digest run failed for tenant %s", tenant_id)
+
+
+async def send_daily_digests(bot: Bot, tenant_id: str = DEFAULT_TENANT_ID) -> int:
+    # The outbox is read from the primary: a lagging replica could hand back rows already sent.
+    async with async_session() as session:
+        rows = await crud.get_pending_digest_rows(session, tenant_id)
+    if not rows:
+        return 0
+
+    day = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d")
+    deliveries = []
+    for (_, parent_tg_id), parent_rows in groupby(rows, key=lambda row: (row[1], row[2])):
+        parent_rows = list(parent_rows)
+        text = format_digest_message(
+            day,
+            [
+                (student_name, group_title, str(lesson_date), status, score)
+                for _, _, _, student_name, group_title, lesson_date, status, score in parent_rows
+            ],
+        )
+        deliveries.append(Delivery([row[0] for row in parent_rows], parent_tg_id, split_text(text)))
+
+    result = await fan_out(bot, deliveries)
+
+    async with async_session() as session:
+        await crud.mark_deliveries(session, result.sent_ids, result.failed)
+    logger.info(
+        "Daily digest (%s): %s grades sent, %s grades failed", tenant_id, len(result.sent_ids), len(result.failed)
+    )
+    return len(result.sent_ids)
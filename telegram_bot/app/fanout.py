@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from itertools import groupby
+from typing import NamedTuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.config import FANOUT_CHAT_INTERVAL, FANOUT_CONCURRENCY, FANOUT_RATE
+
+logger = logging.getLogger(__name__)
+
+RETRY_AFTER_ATTEMPTS = 3
+
+
+class Delivery(NamedTuple):
+    # texts go to chat_id in order; notification_ids are marked SENT only if all of them went out.
+    notification_ids: list[int]
+    chat_id: int
+    texts: list[str]
+
+
+class FanOutResult(NamedTuple):
+    sent_ids: list[int]
+    failed: list[tuple[int, str]]
+
+
+class _RateLimiter:
+    # Spaces sends evenly at `rate` per second across every fan-out of one bot in this process.
+    def __init__(self, rate: float):
+        self._interval = 1 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+
+    async def wait(self) -> None:
+        if not self._interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+_semaphore: asyncio.Semaphore | None = None
+# bot id -> limiter; every tenant's bot has its own Bot API quota.
+_limiters: dict[int, _RateLimiter] = {}
+
+
+async def fan_out(bot: Bot, deliveries: list[Delivery]) -> FanOutResult:
+    # Chats are served concurrently (bounded by FANOUT_CONCURRENCY); messages of one chat stay
+    # sequential and in order. Results are collected for a single write-back by the caller.
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    result = FanOutResult([], [])
+    by_chat = groupby(sorted(deliveries, key=lambda delivery: delivery.chat_id), key=lambda delivery: delivery.chat_id)
+    await asyncio.gather(*(_deliver_chat(bot, list(chat_deliveries), result) for _, chat_deliveries in by_chat))
+    return result
+
+
+async def _deliver_chat(bot: Bot, deliveries: list[Delivery], result: FanOutResult) -> None:
+    first = True
+    for delivery in deliveries:
+        try:
+            for text in delivery.texts:
+                if not first and FANOUT_CHAT_INTERVAL:
+                    await asyncio.sleep(FANOUT_CHAT_INTERVAL)
+                first = False
+                await _send(bot, delivery.chat_id, text)
+        except Exception as exc:
+            result.failed.extend((notification_id, str(exc)) for notification_id in delivery.notification_ids)
+        else:
+            result.sent_ids.extend(delivery.notification_ids)
+
+
+async def _send(bot: Bot, chat_id: int, text: str) -> None:
+    limiter = _limiters.get(bot.id)
+    if limiter is None:
+        limiter = _limiters[bot.id] = _RateLimiter(FANOUT_RATE)
+    for attempt in range(RETRY_AFTER_ATTEMPTS):
+        await limiter.wait()
+        try:
+            async with _semaphore:
+                await bot.send_message(chat_id, text)
+            return
+        except TelegramRetryAfter as exc:
+            if attempt == RETRY_AFTER_ATTEMPTS - 1:
+                raise
+            logger.warning("Flood control for chat %s, retrying in %ss", chat_id, exc.retry_after)
+            await asyncio.sleep(exc.retry_after)
@@ -1,24 +1,49 @@
 from __future__ import annotations
 
+import asyncio
 from datetime import datetime
-from zoneinfo import ZoneInfo
+from typing import Hashable
+from weakref import WeakValueDictionary
 
 from aiogram import Bot
 from aiogram.enums import ChatMemberStatus
 
-from app.config import TIMEZONE
+from app import cache
+from app.config import LOCAL_TZ
+
+
+ADMIN_STATUSES = {ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR}
+
+_chat_locks: WeakValueDictionary[Hashable, asyncio.Lock] = WeakValueDictionary()
+
+
+def chat_lock(key: Hashable) -> asyncio.Lock:
+    # Locks disappear once no coroutine holds a reference, so idle chats cost nothing.
+    lock = _chat_locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _chat_locks[key] = lock
+    return lock
 
 
 def get_today_date():
-    tz = ZoneInfo(TIMEZONE)
-    return datetime.now(tz=tz).date()
+    return datetime.now(tz=LOCAL_TZ).date()
 
 
 async def is_admin(bot: Bot, chat_id: int, user_id: int) -> bool:
     if user_id is None:
         return False
+    admins = cache.chat_admins.get((bot.id, chat_id))
+    if admins is not None and user_id in admins:
+        return True
     member = await bot.get_chat_member(chat_id, user_id)
-    return member.status in {ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR}
+    if member.status not in ADMIN_STATUSES:
+        return False
+    if admins is None:
+        cache.chat_admins.set((bot.id, chat_id), {user_id})
+    else:
+        admins.add(user_id)
+    return True
 
 
 def is_anonymous_admin_message(chat_id: int, sender_chat_id: int | None) -> bool:
@@ -1,24 +1,65 @@
 from __future__ import annotations
 
-from datetime import datetime
+import logging
+import re
+from datetime import date, datetime, timedelta
+from itertools import groupby
 from html import escape
-from zoneinfo import ZoneInfo
 
 from aiogram import Router, Bot, F
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
-
-from app.config import TIMEZONE
-from app.db import async_session
-from app.handlers.common import get_today_date, is_admin, is_anonymous_admin_message
-from app import crud
-from app.keyboards import students_keyboard, status_keyboard, score_keyboard
-from app.models import Group, LessonGradeStatus, NotificationStatus
-from app.text import format_grade_message
+from aiogram.types import (
+    Message,
+    CallbackQuery,
+    ChatMemberUpdated,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
+
+from app.config import FAST_CALLBACK_ACK, LESSON_CLOSE_STATUS, LOCAL_TZ
+from app.handlers.common import ADMIN_STATUSES, chat_lock, get_today_date, is_admin, is_anonymous_admin_message
+from app import background, crud
+from app.middlewares import LazySession
+from app.tenants import Tenant
+from app import cache
+from app.cache import TTLCache
+from app.fanout import Delivery, fan_out
+from app.keyboards import leaderboard_keyboard, students_keyboard, status_keyboard, score_keyboard
+from app.models import Group, Lesson, LessonGradeStatus
+from app.text import format_grade_message, format_lesson_summary, normalize_full_name, split_text
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
+INLINE_RESULTS_LIMIT = 20
+INLINE_QUERY_RE = re.compile(r"^c(-?\d+)\s*(.*)$", re.DOTALL)
+INLINE_PICK_RE = re.compile(r"^Baholash: .* \(#(\d+)\)$")
+
+LEADERBOARD_WINDOWS = {
+    "week": "Bu hafta",
+    "month": "Bu oy",
+    "all": "Umumiy",
+}
+# The pinned board shows only the top of the table; the rest is paged via inline buttons.
+LEADERBOARD_TOP_N = 10
+LEADERBOARD_PAGE_SIZE = 25
+LEADERBOARD_NAME_LIMIT = 40
+# Telegram rejects messages over 4096 characters.
+LEADERBOARD_TEXT_LIMIT = 3500
+
+# Ungraded students get this status when the lesson closes.
+LESSON_CLOSE_STATUS_VALUE = LessonGradeStatus(LESSON_CLOSE_STATUS)
+if LESSON_CLOSE_STATUS_VALUE not in {LessonGradeStatus.NOT_DONE, LessonGradeStatus.ABSENT}:
+    raise ValueError("LESSON_CLOSE_STATUS must be NOT_DONE or ABSENT")
+
+LESSON_CLOSED_TEXT = "Bugungi dars yopilgan, baholarni o‘zgartirib bo‘lmaydi."
+
+# (tenant_id, admin tg id) -> chat_id of their last /grade, so a bare "@bot ism" still knows the group.
+_last_grade_chat = TTLCache(ttl=6 * 3600, max_size=4096)
+
 
 def _clean_username(username: str | None) -> str | None:
     if not username:
@@ -26,8 +67,28 @@ def _clean_username(username: str | None) -> str | None:
     return username.lstrip("@").strip() or None
 
 
+@router.message(F.migrate_to_chat_id)
+async def migrate_group(message: Message, db: LazySession, tenant: Tenant):
+    # Group -> supergroup upgrade changes chat_id; keep the same Group row and its history.
+    session = await db.get()
+    await crud.migrate_group_chat(session, message.chat.id, message.migrate_to_chat_id, tenant.id)
+
+
+@router.message(F.new_chat_title)
+async def rename_group(message: Message, db: LazySession, tenant: Tenant):
+    session = await db.get()
+    await crud.resolve_group(session, message.chat.id, message.new_chat_title, tenant.id)
+
+
+@router.chat_member()
+async def track_admin_change(event: ChatMemberUpdated, bot: Bot):
+    # A demoted admin must not keep grading until the cached admin list expires.
+    member = event.new_chat_member
+    cache.set_chat_admin(bot.id, event.chat.id, member.user.id, member.status in ADMIN_STATUSES)
+
+
 @router.message(Command("add"))
-async def add_student(message: Message, bot: Bot):
+async def add_student(message: Message, bot: Bot, db: LazySession, tenant: Tenant):
     if message.chat.type not in {"group", "supergroup"}:
         return
 
@@ -79,15 +140,17 @@ async def add_student(message: Message, bot: Bot):
         await message.reply("Ism Familiya bo‘sh bo‘lishi mumkin emas.")
         return
 
-    async with async_session() as session:
-        group = await crud.ensure_group(session, message.chat.id, message.chat.title)
-        student = await crud.create_or_update_student(
-            session=session,
-            group_id=group.id,
-            tg_user_id=tg_user_id,
-            tg_username=tg_username,
-            full_name=full_name,
-        )
+    session = await db.get()
+    group = await crud.resolve_group(session, message.chat.id, message.chat.title, tenant.id)
+    student = await crud.create_or_update_student(
+        session=session,
+        group_id=group.id,
+        tg_user_id=tg_user_id,
+        tg_username=tg_username,
+        full_name=full_name,
+    )
+    await db.release()
+    cache.forget_roster(group.id)
 
     await message.reply(
         f"O‘quvchi qo‘shildi: {student.full_name}. Kodi: #{student.code}\n"
@@ -96,7 +159,7 @@ async def add_student(message: Message, bot: Bot):
 
 
 @router.message(Command("grade"))
-async def grade_students(message: Message, bot: Bot):
+async def grade_students(message: Message, bot: Bot, db: LazySession, tenant: Tenant):
     if message.chat.type not in {"group", "supergroup"}:
         return
 
@@ -112,23 +175,148 @@ async def grade_students(message: Message, bot: Bot):
         await message.reply("Bu buyruq faqat adminlar uchun.")
         return
 
-    async with async_session() as session:
-        group = await crud.ensure_group(session, message.chat.id, message.chat.title)
-        students = await crud.get_active_students(session, group.id)
+    name_query = ""
+    if message.text:
+        parts = message.text.split(maxsplit=1)
+        name_query = parts[1].strip() if len(parts) > 1 else ""
+
+    async with chat_lock(message.chat.id):
+        session = await db.get()
+        group = await crud.resolve_group(session, message.chat.id, message.chat.title, tenant.id)
+        students = await crud.get_active_student_rows(session, group.id)
         if not students:
             await message.reply("Guruhda o‘quvchilar yo‘q.")
             return
 
-        lesson_date = get_today_date()
-        lesson = await crud.get_or_create_lesson(session, group.id, lesson_date)
-        await crud.ensure_lesson_grades(session, lesson.id, students)
+        lesson_id = await crud.resolve_lesson_id(session, group.id, get_today_date())
+        if await crud.is_lesson_closed(session, lesson_id):
+            await message.reply(LESSON_CLOSED_TEXT)
+            return
+        await crud.ensure_lesson_grades(session, lesson_id, [s.id for s in students])
+        cache.ensured_lessons.add(lesson_id)
+
+    if name_query:
+        students = await crud.search_active_students(session, group.id, name_query)
+        if not students:
+            await message.reply("Bu ism bilan o‘quvchi topilmadi.")
+            return
+    await db.release()
+
+    if message.from_user:
+        _last_grade_chat.set((tenant.id, message.from_user.id), message.chat.id)
 
     students_list = [(s.id, f"{s.full_name} (#{s.code})") for s in students]
-    await message.reply("Baholash uchun o‘quvchini tanlang:", reply_markup=students_keyboard(students_list))
+    await message.reply(
+        "Baholash uchun o‘quvchini tanlang:",
+        reply_markup=students_keyboard(students_list, search_query=f"c{message.chat.id} "),
+    )
+
+
+@router.inline_query()
+async def search_students_inline(inline_query: InlineQuery, bot: Bot, db: LazySession, tenant: Tenant):
+    if inline_query.chat_type not in {"group", "supergroup"}:
+        await inline_query.answer([], cache_time=5, is_personal=True)
+        return
+
+    match = INLINE_QUERY_RE.match(inline_query.query.strip())
+    if match:
+        chat_id = int(match.group(1))
+        name_query = match.group(2).strip()
+    else:
+        chat_id = _last_grade_chat.get((tenant.id, inline_query.from_user.id))
+        name_query = inline_query.query.strip()
+    if chat_id is None:
+        await inline_query.answer([], cache_time=5, is_personal=True)
+        return
+
+    try:
+        allowed = await is_admin(bot, chat_id, inline_query.from_user.id)
+    except TelegramBadRequest:
+        allowed = False
+    if not allowed:
+        await inline_query.answer([], cache_time=5, is_personal=True)
+        return
+
+    session = await db.get()
+    group = await crud.resolve_group(session, chat_id, None, tenant.id)
+    rows = await _search_roster(session, group.id, name_query)
+    await db.release()
+
+    results = [
+        InlineQueryResultArticle(
+            id=str(student_id),
+            title=full_name,
+            description=f"#{code}",
+            input_message_content=InputTextMessageContent(message_text=f"Baholash: {full_name} (#{code})"),
+        )
+        for student_id, full_name, code in rows
+    ]
+    await inline_query.answer(results, cache_time=5, is_personal=True)
+
+
+async def _search_roster(session, group_id: int, name_query: str) -> list[tuple[int, str, str]]:
+    key = normalize_full_name(name_query)
+    cached = cache.roster_search.get(group_id)
+    if cached is not None and key in cached:
+        return cached[key]
+
+    # Name-prefix matches rank first (indexed), then matches on a later word such as the surname.
+    students = await crud.search_active_students(session, group_id, key, limit=INLINE_RESULTS_LIMIT)
+    if key and len(students) < INLINE_RESULTS_LIMIT:
+        students += await crud.search_active_students_by_word(
+            session,
+            group_id,
+            key,
+            exclude_ids={s.id for s in students},
+            limit=INLINE_RESULTS_LIMIT - len(students),
+        )
+    rows = [(s.id, s.full_name, s.code) for s in students]
+
+    if cached is None:
+        cached = {}
+        cache.roster_search.set(group_id, cached)
+    cached[key] = rows
+    return rows
+
+
+@router.message(F.via_bot, F.text.regexp(INLINE_PICK_RE))
+async def pick_student_inline(message: Message, bot: Bot, db: LazySession, tenant: Tenant):
+    if message.chat.type not in {"group", "supergroup"} or message.via_bot.id != bot.id:
+        return
+
+    # Anyone can send an inline result into the group; only admins get the status buttons.
+    is_allowed = is_anonymous_admin_message(
+        chat_id=message.chat.id,
+        sender_chat_id=message.sender_chat.id if message.sender_chat else None,
+    )
+    if not is_allowed:
+        user_id = message.from_user.id if message.from_user else None
+        is_allowed = await is_admin(bot, message.chat.id, user_id)
+    if not is_allowed:
+        await message.reply("Faqat adminlar baholay oladi.")
+        return
+
+    code = INLINE_PICK_RE.match(message.text).group(1)
+    session = await db.get()
+    group = await crud.resolve_group(session, message.chat.id, message.chat.title, tenant.id)
+    student = await crud.get_student_by_code(session, code, tenant.id)
+    await db.release()
+    if not student or student.group_id != group.id:
+        await message.reply("O'quvchi topilmadi.")
+        return
+
+    await message.answer(
+        f"Tanlandi: {student.full_name}\nHolatni tanlang:",
+        reply_markup=status_keyboard(student.id),
+    )
+    try:
+        await message.delete()
+    except TelegramBadRequest:
+        pass
 
 
 @router.callback_query(F.data.startswith("grade_student:"))
-async def pick_student(callback: CallbackQuery, bot: Bot):
+async def pick_student(callback: CallbackQuery, bot: Bot, db: LazySession):
     if not callback.message or callback.message.chat.type not in {"group", "supergroup"}:
         await callback.answer()
         return
@@ -139,8 +327,9 @@ async def pick_student(callback: CallbackQuery, bot: Bot):
         return
 
     student_id = int(callback.data.split(":")[1])
-    async with async_session() as session:
-        student = await crud.get_student_by_id(session, student_id)
+    session = await db.get()
+    student = await crud.get_student_by_id(session, student_id)
+    await db.release()
     if not student:
         await callback.answer("O'quvchi topilmadi.", show_alert=True)
         return
@@ -153,7 +342,7 @@ async def pick_student(callback: CallbackQuery, bot: Bot):
 
 
 @router.callback_query(F.data.startswith("grade_status:"))
-async def pick_status(callback: CallbackQuery, bot: Bot):
+async def pick_status(callback: CallbackQuery, bot: Bot, db: LazySession, tenant: Tenant):
     if not callback.message or callback.message.chat.type not in {"group", "supergroup"}:
         await callback.answer()
         return
@@ -172,11 +361,11 @@ async def pick_status(callback: CallbackQuery, bot: Bot):
         await callback.answer()
         return
 
-    await _set_grade(callback, bot, student_id, status, None)
+    await _set_grade(callback, bot, db, tenant, student_id, status, None)
 
 
 @router.callback_query(F.data.startswith("grade_score:"))
-async def pick_score(callback: CallbackQuery, bot: Bot):
+async def pick_score(callback: CallbackQuery, bot: Bot, db: LazySession, tenant: Tenant):
     if not callback.message or callback.message.chat.type not in {"group", "supergroup"}:
         await callback.answer()
         return
@@ -190,148 +379,351 @@ async def pick_score(callback: CallbackQuery, bot: Bot):
     student_id = int(parts[1])
     score = int(parts[2])
 
-    await _set_grade(callback, bot, student_id, LessonGradeStatus.DONE, score)
+    await _set_grade(callback, bot, db, tenant, student_id, LessonGradeStatus.DONE, score)
 
 
-async def _set_grade(callback: CallbackQuery, bot: Bot, student_id: int, status: LessonGradeStatus, score: int | None):
+async def _set_grade(
+    callback: CallbackQuery,
+    bot: Bot,
+    db: LazySession,
+    tenant: Tenant,
+    student_id: int,
+    status: LessonGradeStatus,
+    score: int | None,
+):
     if not callback.message:
         await callback.answer("Xatolik: xabar topilmadi.", show_alert=True)
         return
 
-    async with async_session() as session:
-        group = await crud.ensure_group(session, callback.message.chat.id, callback.message.chat.title)
-        lesson_date = get_today_date()
-        lesson = await crud.get_or_create_lesson(session, group.id, lesson_date)
-        students = await crud.get_active_students(session, group.id)
-        await crud.ensure_lesson_grades(session, lesson.id, students)
-
-        grade = await crud.update_grade(
-            session=session,
-            lesson_id=lesson.id,
-            student_id=student_id,
-            status=status,
-            score=score,
-            graded_by_tg_user_id=callback.from_user.id if callback.from_user else None,
-        )
+    async with chat_lock(callback.message.chat.id):
+        session = await db.get()
+        group = await crud.resolve_group(session, callback.message.chat.id, callback.message.chat.title, tenant.id)
+        lesson_id = await crud.resolve_lesson_id(session, group.id, get_today_date())
+        if lesson_id not in cache.ensured_lessons:
+            students = await crud.get_active_student_rows(session, group.id)
+            await crud.ensure_lesson_grades(session, lesson_id, [s.id for s in students])
+            cache.ensured_lessons.add(lesson_id)
 
-        grade = await crud.get_lesson_grade_with_relations(session, grade.id)
-        if not grade:
-            await callback.answer("Xatolik: baho topilmadi.", show_alert=True)
+        try:
+            grade = await crud.update_grade(
+                session=session,
+                lesson_id=lesson_id,
+                student_id=student_id,
+                status=status,
+                score=score,
+                graded_by_tg_user_id=callback.from_user.id if callback.from_user else None,
+            )
+        except crud.LessonClosedError:
+            await db.release()
+            await callback.answer(LESSON_CLOSED_TEXT, show_alert=True)
             return
+        cache.forget_leaderboard(group.id)
+    await db.release()
 
-        await _send_notifications(bot, session, grade)
-        await _sync_leaderboard_message(bot, session, group.id)
+    message_text = format_grade_message(
+        group_title=group.title or "Guruh",
+        student_name=grade.student_name,
+        lesson_date=str(grade.lesson_date),
+        status=grade.status,
+        score=grade.score,
+    )
 
-        message_text = format_grade_message(
-            group_title=group.title or "Guruh",
-            student_name=grade.student.full_name,
-            lesson_date=str(grade.lesson.lesson_date),
-            status=grade.status,
-            score=grade.score,
+    if FAST_CALLBACK_ACK:
+        # The grade is committed; stop the teacher's spinner now and do the slow part in the background.
+        await callback.answer("Baholandi")
+        background.spawn(
+            _finish_grade(bot, LazySession(), grade, group.id, callback.message, message_text),
+            name=f"grade-followup-{grade.id}",
         )
+        return
+
+    await _finish_grade(bot, db, grade, group.id, callback.message, message_text)
+    await callback.answer("Baholandi")
+
 
-    await callback.message.answer(f"Baholandi.\n\n{message_text}")
+async def _finish_grade(
+    bot: Bot, db: LazySession, grade: crud.SavedGrade, group_id: int, grade_message: Message, message_text: str
+):
     try:
-        await callback.message.delete()
+        await _send_notifications(bot, db, grade, message_text)
+        await _sync_leaderboard_message(bot, db, group_id)
+    finally:
+        await db.release()
+
+    await grade_message.answer(f"Baholandi.\n\n{message_text}")
+    try:
+        await grade_message.delete()
     except TelegramBadRequest:
         pass
-    await callback.answer("Baholandi")
 
 
-def _build_leaderboard_text(group_title: str, rows: list[dict]) -> str:
-    now_text = datetime.now(ZoneInfo(TIMEZONE)).strftime("%Y-%m-%d %H:%M")
-    lines = [f"<b>Leaderboard - {escape(group_title)}</b>", ""]
-    if not rows:
-        lines.append("Hozircha baho yo'q.")
-    else:
-        for idx, row in enumerate(rows, start=1):
-            lines.append(f"{idx}. <b>{escape(row['full_name'])}</b>")
-            lines.append(
-                f"Jami: {row['total_score']} | O'rtacha: {row['avg_score']:.2f} | "
-                f"Bajarmadi: {row['not_done_count']} | Kelmadi: {row['absent_count']}"
+@router.message(Command("close"))
+async def close_lesson(message: Message, bot: Bot, db: LazySession, tenant: Tenant):
+    if message.chat.type not in {"group", "supergroup"}:
+        return
+
+    is_allowed = is_anonymous_admin_message(
+        chat_id=message.chat.id,
+        sender_chat_id=message.sender_chat.id if message.sender_chat else None,
+    )
+    user_id = message.from_user.id if message.from_user else None
+    if not is_allowed:
+        is_allowed = await is_admin(bot, message.chat.id, user_id)
+
+    if not is_allowed:
+        await message.reply("Bu buyruq faqat adminlar uchun.")
+        return
+
+    session = await db.get()
+    group = await crud.resolve_group(session, message.chat.id, message.chat.title, tenant.id)
+    lesson_id = await crud.find_lesson_id(session, group.id, get_today_date())
+    if lesson_id is None:
+        await db.release()
+        await message.reply("Bugun dars yo‘q: yopiladigan dars topilmadi.")
+        return
+    if await close_and_announce(bot, db, group.id, lesson_id, user_id) is None:
+        await message.reply("Bugungi dars allaqachon yopilgan.")
+
+
+async def close_and_announce(
+    bot: Bot, db: LazySession, group_id: int, lesson_id: int, closed_by_tg_user_id: int | None
+) -> int | None:
+    # Shared by /close and the auto-close: the lesson's final state is written in one
+    # transaction, then the group gets one summary, parents one batched fan-out and the
+    # pinned leaderboard one refresh. Returns None if the lesson was already closed.
+    session = await db.get()
+    group = await session.get(Group, group_id)
+    async with chat_lock(group.chat_id):
+        students = await crud.get_active_student_rows(session, group_id)
+        await crud.ensure_lesson_grades(session, lesson_id, [s.id for s in students])
+        converted = await crud.close_lesson(session, lesson_id, LESSON_CLOSE_STATUS_VALUE, closed_by_tg_user_id)
+        if converted is None:
+            await db.release()
+            return None
+        cache.forget_leaderboard(group_id)
+
+    lesson = await session.get(Lesson, lesson_id)
+    group_title = group.title or "Guruh"
+    lesson_date = str(lesson.lesson_date)
+    summary = await crud.get_lesson_summary(session, lesson_id)
+    rows = await crud.get_lesson_instant_deliveries(session, lesson_id)
+    chat_id = group.chat_id
+    await db.release()
+
+    # The lesson is already closed: a failed summary must not keep parents' grades PENDING.
+    try:
+        await bot.send_message(
+            chat_id, format_lesson_summary(group_title, lesson_date, summary, converted, LESSON_CLOSE_STATUS_VALUE)
+        )
+    except TelegramAPIError as exc:
+        logger.warning("Summary of lesson %s was not sent to chat %s: %s", lesson_id, chat_id, exc)
+
+    if rows:
+        deliveries = []
+        for parent_chat_id, parent_rows in groupby(rows, key=lambda row: row[1]):
+            parent_rows = list(parent_rows)
+            text = "\n\n".join(
+                format_grade_message(group_title, student_name, lesson_date, status, score)
+                for _, _, student_name, status, score in parent_rows
             )
-            lines.append("")
-    lines.append(f"Yangilandi: {now_text}")
-    return "\n".join(lines)
+            deliveries.append(Delivery([row[0] for row in parent_rows], parent_chat_id, split_text(text)))
+        result = await fan_out(bot, deliveries)
+        session = await db.get()
+        await crud.mark_deliveries(session, result.sent_ids, result.failed)
+        await db.release()
+
+    await _sync_leaderboard_message(bot, db, group_id)
+    return converted
 
 
-async def _sync_leaderboard_message(bot: Bot, session, group_id: int) -> None:
+@router.message(Command("leaderboard"))
+async def show_leaderboard(message: Message, db: LazySession, tenant: Tenant):
+    if message.chat.type not in {"group", "supergroup"}:
+        return
+
+    parts = (message.text or "").split(maxsplit=1)
+    window = parts[1].strip().lower() if len(parts) > 1 else "all"
+    if window not in LEADERBOARD_WINDOWS:
+        await message.reply("Foydalanish: /leaderboard week|month|all")
+        return
+
+    session = await db.get()
+    group = await crud.resolve_group(session, message.chat.id, message.chat.title, tenant.id)
+    pages = await _get_leaderboard_pages(db, group.id, group.title, window)
+    await db.release()
+
+    await message.reply(
+        pages[0],
+        parse_mode="HTML",
+        disable_web_page_preview=True,
+        reply_markup=leaderboard_keyboard(window, 0, len(pages)),
+    )
+
+
+@router.callback_query(F.data.startswith("lb:"))
+async def leaderboard_page(callback: CallbackQuery, db: LazySession, tenant: Tenant):
+    _, window, page_text = callback.data.split(":")
+    if not callback.message or window not in LEADERBOARD_WINDOWS:
+        await callback.answer()
+        return
+
+    await callback.answer()
+    session = await db.get()
+    group = await crud.resolve_group(session, callback.message.chat.id, callback.message.chat.title, tenant.id)
+    pages = await _get_leaderboard_pages(db, group.id, group.title, window)
+    await db.release()
+
+    page = min(max(int(page_text), 0), len(pages) - 1)
+    try:
+        await callback.message.edit_text(
+            pages[page],
+            parse_mode="HTML",
+            disable_web_page_preview=True,
+            reply_markup=leaderboard_keyboard(window, page, len(pages)),
+        )
+    except TelegramBadRequest:
+        pass
+
+
+def _leaderboard_window_start(window: str, today: date) -> date | None:
+    if window == "week":
+        return today - timedelta(days=today.weekday())
+    if window == "month":
+        return today.replace(day=1)
+    return None
+
+
+async def _get_leaderboard_pages(db: LazySession, group_id: int, group_title: str | None, window: str) -> list[str]:
+    since = _leaderboard_window_start(window, get_today_date())
+    # Taken before the query: if a grade invalidates the group meanwhile, the result lands
+    # in the dropped dict instead of being cached as current.
+    group_pages = cache.leaderboard_pages.setdefault(group_id, {})
+    pages = group_pages.get(since)
+    if pages is None:
+        session = await db.get()
+        rows = await crud.get_group_leaderboard_rows(session, group_id, since=since)
+        pages = group_pages[since] = _build_leaderboard_pages(group_title or "Guruh", rows, LEADERBOARD_WINDOWS[window])
+    return pages
+
+
+def _leaderboard_line(idx: int, row: dict) -> str:
+    name = row["full_name"]
+    if len(name) > LEADERBOARD_NAME_LIMIT:
+        name = name[: LEADERBOARD_NAME_LIMIT - 1] + "…"
+    return (
+        f"{idx}. <b>{escape(name)}</b> — Jami: {row['total_score']} | O'rtacha: {row['avg_score']:.2f} | "
+        f"Bajarmadi: {row['not_done_count']} | Kelmadi: {row['absent_count']}"
+    )
+
+
+def _build_leaderboard_pages(group_title: str, rows: list[dict], window_label: str) -> list[str]:
+    # rows come sorted from get_group_leaderboard_rows; the first page is the short top-N board.
+    now_text = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M")
+    header = f"<b>Leaderboard - {escape(group_title)} ({escape(window_label)})</b>"
+    if not rows:
+        return [f"{header}\n\nHozircha baho yo'q.\n\nYangilandi: {now_text}"]
+
+    chunks: list[list[str]] = []
+    current: list[str] = []
+    current_len = 0
+    for idx, row in enumerate(rows, start=1):
+        line = _leaderboard_line(idx, row)
+        limit = LEADERBOARD_PAGE_SIZE if chunks else LEADERBOARD_TOP_N
+        if current and (len(current) >= limit or current_len + len(line) + 1 > LEADERBOARD_TEXT_LIMIT):
+            chunks.append(current)
+            current = []
+            current_len = 0
+        current.append(line)
+        current_len += len(line) + 1
+    chunks.append(current)
+
+    pages = []
+    for number, chunk in enumerate(chunks, start=1):
+        footer = f"Yangilandi: {now_text}"
+        if len(chunks) > 1:
+            footer = f"Sahifa {number}/{len(chunks)} | {footer}"
+        pages.append("\n".join([header, "", *chunk, "", footer]))
+    return pages
+
+
+async def _sync_leaderboard_message(bot: Bot, db: LazySession, group_id: int) -> None:
+    # Serialized per group so a slower, older render can never overwrite a newer board.
+    async with chat_lock(("leaderboard", group_id)):
+        await _render_leaderboard_message(bot, db, group_id)
+
+
+async def _render_leaderboard_message(bot: Bot, db: LazySession, group_id: int) -> None:
+    session = await db.get()
     group = await session.get(Group, group_id)
     if not group:
         return
 
-    rows = await crud.get_group_leaderboard_rows(session, group_id)
-    text = _build_leaderboard_text(group.title or "Guruh", rows)
+    chat_id = group.chat_id
+    pages = await _get_leaderboard_pages(db, group_id, group.title, "all")
+    text = pages[0]
+    reply_markup = leaderboard_keyboard("all", 0, len(pages))
     state = await crud.get_or_create_group_state(session, group_id)
-
     message_id = state.leaderboard_message_id
+    await db.release()
+
     sent_new = False
     if message_id:
         try:
             await bot.edit_message_text(
                 text=text,
-                chat_id=group.chat_id,
+                chat_id=chat_id,
                 message_id=message_id,
                 parse_mode="HTML",
                 disable_web_page_preview=True,
+                reply_markup=reply_markup,
             )
         except TelegramBadRequest as exc:
             if "message is not modified" in str(exc).lower():
                 sent_new = False
             else:
                 sent = await bot.send_message(
-                    group.chat_id,
+                    chat_id,
                     text,
                     parse_mode="HTML",
                     disable_web_page_preview=True,
+                    reply_markup=reply_markup,
                 )
                 message_id = sent.message_id
                 sent_new = True
     else:
         sent = await bot.send_message(
-            group.chat_id,
+            chat_id,
             text,
             parse_mode="HTML",
             disable_web_page_preview=True,
+            reply_markup=reply_markup,
         )
         message_id = sent.message_id
         sent_new = True
 
     if sent_new:
-        state.leaderboard_message_id = message_id
-        state.updated_at = datetime.utcnow()
-        await session.commit()
+        session = await db.get()
+        await crud.set_leaderboard_message_id(session, group_id, message_id)
+        await db.release()
 
     try:
-        await bot.pin_chat_message(group.chat_id, message_id, disable_notification=True)
+        await bot.pin_chat_message(chat_id, message_id, disable_notification=True)
     except (TelegramBadRequest, TelegramForbiddenError):
         pass
 
 
-async def _send_notifications(bot: Bot, session, grade):
-    parents = await crud.get_parents_for_student(session, grade.student_id)
-    if not parents:
+async def _send_notifications(bot: Bot, db: LazySession, grade: crud.SavedGrade, message_text: str):
+    # Parents get the same text as the group's "Baholandi" message.
+    session = await db.get()
+    targets = await crud.enqueue_grade_notifications(session, [grade.id], grade.student_id)
+    await db.release()
+    if not targets:
         return
 
-    group_title = grade.lesson.group.title or "Guruh"
-    message_text = format_grade_message(
-        group_title=group_title,
-        student_name=grade.student.full_name,
-        lesson_date=str(grade.lesson.lesson_date),
-        status=grade.status,
-        score=grade.score,
+    result = await fan_out(
+        bot, [Delivery([notification_id], chat_id, [message_text]) for notification_id, chat_id, _ in targets]
     )
 
-    for parent in parents:
-        notification = await crud.get_notification(session, grade.id, parent.id)
-        if not notification:
-            notification = await crud.create_notification(session, grade.id, parent.id)
-        try:
-            await bot.send_message(parent.tg_user_id, message_text)
-            notification.status = NotificationStatus.SENT
-            notification.sent_at = datetime.utcnow()
-            notification.error = None
-        except Exception as exc:
-            notification.status = NotificationStatus.FAILED
-            notification.error = str(exc)[:255]
-        await session.commit()
+    session = await db.get()
+    await crud.mark_deliveries(session, result.sent_ids, result.failed)
+    await db.release()
@@ -1,67 +1,39 @@
 from __future__ import annotations
 
-import re
-from datetime import datetime
+import logging
+
+from datetime import date
 
 from aiogram import Router, Bot, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, ReplyKeyboardRemove
+from aiogram.types import CallbackQuery, Message, ReplyKeyboardRemove
+from sqlalchemy.exc import DBAPIError
 
-from app.db import async_session
 from app import crud
-from app.models import LessonGradeStatus, NotificationStatus, Student
-from app.text import format_grade_message
-from app.keyboards import parent_menu_keyboard
+from app.db import read_session
+from app.fanout import Delivery, fan_out
+from app.middlewares import LazySession
+from app.tenants import Tenant
+from app.models import DeliveryMode, LessonGradeStatus, Student
+from app.text import format_grade_history, format_grade_message, format_term_summaries, normalize_name, split_text
+from app.config import DIGEST_TIME
+from app.keyboards import delivery_mode_keyboard, history_children_keyboard, history_keyboard, parent_menu_keyboard
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
 BTN_LINK_CHILD = "Bolani bog'lash"
 BTN_CHILDREN = "Bog'langan bolalarim"
 BTN_ADMIN_PANEL = "Admin panel"
-ADMIN_TG_USER_ID = 6329800356
-
-CYR_TO_LAT = {
-    "а": "a",
-    "б": "b",
-    "в": "v",
-    "г": "g",
-    "ғ": "g",
-    "д": "d",
-    "е": "e",
-    "ё": "yo",
-    "ж": "j",
-    "з": "z",
-    "и": "i",
-    "й": "y",
-    "к": "k",
-    "қ": "q",
-    "л": "l",
-    "м": "m",
-    "н": "n",
-    "о": "o",
-    "п": "p",
-    "р": "r",
-    "с": "s",
-    "т": "t",
-    "у": "u",
-    "ф": "f",
-    "х": "x",
-    "ҳ": "h",
-    "ц": "s",
-    "ч": "ch",
-    "ш": "sh",
-    "щ": "sh",
-    "ъ": "",
-    "ь": "",
-    "э": "e",
-    "ю": "yu",
-    "я": "ya",
-    "ў": "o",
-    "ы": "i",
-}
+BTN_DELIVERY = "Xabarnoma sozlamalari"
+BTN_HISTORY = "Baholar tarixi"
 
+# Lessons per grade history page.
+HISTORY_PAGE_SIZE = 10
 
 class ParentRegistration(StatesGroup):
     waiting_name = State()
@@ -79,48 +51,30 @@ def _parse_code(text: str) -> str | None:
     return raw
 
 
-def _normalize_name(value: str) -> str:
-    text = value.strip().lower()
-    for ch in ("'", "’", "`", "ʻ", "ʼ"):
-        text = text.replace(ch, "'")
-
-    # Cyrillic -> Latin normalization for Uzbek/Russian-style names.
-    text = "".join(CYR_TO_LAT.get(ch, ch) for ch in text)
-
-    # Normalize Uzbek apostrophe variants in Latin script.
-    text = text.replace("o'", "o").replace("g'", "g")
-    text = text.replace("yo", "yo").replace("yu", "yu").replace("ya", "ya")
-
-    return re.sub(r"[^a-z]", "", text)
-
-
 def _first_token(value: str) -> str:
     parts = value.strip().split()
     return parts[0] if parts else ""
 
 
-def _is_super_admin(user_id: int | None) -> bool:
-    return user_id == ADMIN_TG_USER_ID
-
-
-def _menu_markup(user_id: int | None, has_parent: bool):
-    return parent_menu_keyboard(is_admin=_is_super_admin(user_id), include_parent=has_parent)
+def _menu_markup(tenant: Tenant, user_id: int | None, has_parent: bool):
+    return parent_menu_keyboard(is_admin=tenant.is_admin(user_id), include_parent=has_parent)
 
 
 @router.message(Command("start"))
-async def start(message: Message, state: FSMContext):
+async def start(message: Message, state: FSMContext, db: LazySession, tenant: Tenant):
     if message.chat.type != "private":
         return
 
     user_id = message.from_user.id if message.from_user else None
-    async with async_session() as session:
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    await db.release()
 
-    if _is_super_admin(user_id):
+    if tenant.is_admin(user_id):
         await state.clear()
         await message.answer(
             "Admin bo'limi ochiq. Menyudan kerakli tugmani tanlang.",
-            reply_markup=_menu_markup(user_id, has_parent=bool(parent)),
+            reply_markup=_menu_markup(tenant, user_id, has_parent=bool(parent)),
         )
         return
 
@@ -128,7 +82,7 @@ async def start(message: Message, state: FSMContext):
         await state.clear()
         await message.answer(
             "Assalomu alaykum. Menyudan kerakli tugmani tanlang.",
-            reply_markup=_menu_markup(user_id, has_parent=True),
+            reply_markup=_menu_markup(tenant, user_id, has_parent=True),
         )
         return
 
@@ -155,7 +109,7 @@ async def handle_parent_name(message: Message, state: FSMContext):
 
 
 @router.message(ParentRegistration.waiting_phone)
-async def handle_parent_phone(message: Message, state: FSMContext):
+async def handle_parent_phone(message: Message, state: FSMContext, db: LazySession, tenant: Tenant):
     if not message.text:
         await message.answer("Telefon raqamni matn ko'rinishida kiriting:")
         return
@@ -168,25 +122,27 @@ async def handle_parent_phone(message: Message, state: FSMContext):
     full_name = data.get("full_name")
     user_id = message.from_user.id if message.from_user else None
 
-    async with async_session() as session:
-        await crud.create_or_update_parent(session, user_id, full_name, phone)
+    session = await db.get()
+    await crud.create_or_update_parent(session, user_id, full_name, phone, tenant.id)
+    await db.release()
 
     await state.clear()
     await message.answer(
         "Rahmat. Endi menyudan bolani bog'lash tugmasini tanlang.",
-        reply_markup=_menu_markup(user_id, has_parent=True),
+        reply_markup=_menu_markup(tenant, user_id, has_parent=True),
     )
 
 
 @router.message(F.text == BTN_LINK_CHILD)
 @router.message(Command("link"))
-async def start_link_child(message: Message, state: FSMContext):
+async def start_link_child(message: Message, state: FSMContext, db: LazySession, tenant: Tenant):
     if message.chat.type != "private":
         return
 
     user_id = message.from_user.id if message.from_user else None
-    async with async_session() as session:
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    await db.release()
     if not parent:
         await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
         return
@@ -199,7 +155,7 @@ async def start_link_child(message: Message, state: FSMContext):
 
 
 @router.message(ParentRegistration.waiting_code)
-async def handle_child_code(message: Message, state: FSMContext):
+async def handle_child_code(message: Message, state: FSMContext, db: LazySession, tenant: Tenant):
     if not message.text:
         await message.answer("Kodni matn ko'rinishida kiriting. Masalan: #1234")
         return
@@ -209,17 +165,18 @@ async def handle_child_code(message: Message, state: FSMContext):
         return
 
     user_id = message.from_user.id if message.from_user else None
-    async with async_session() as session:
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
-        if not parent:
-            await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
-            await state.clear()
-            return
-
-        student = await crud.get_student_by_code(session, code)
-        if not student:
-            await message.answer("Bu kod bilan o‘quvchi topilmadi.")
-            return
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    if not parent:
+        await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
+        await state.clear()
+        return
+
+    student = await crud.get_student_by_code(session, code, tenant.id)
+    if not student:
+        await message.answer("Bu kod bilan o‘quvchi topilmadi.")
+        return
+    await db.release()
 
     await state.update_data(link_student_id=student.id)
     await state.set_state(ParentRegistration.waiting_child_name)
@@ -227,7 +184,7 @@ async def handle_child_code(message: Message, state: FSMContext):
 
 
 @router.message(ParentRegistration.waiting_child_name)
-async def handle_child_name_check(message: Message, state: FSMContext, bot: Bot):
+async def handle_child_name_check(message: Message, state: FSMContext, bot: Bot, db: LazySession, tenant: Tenant):
     if not message.text:
         await message.answer("Ism-familiyani matn ko'rinishida kiriting:")
         return
@@ -240,81 +197,222 @@ async def handle_child_name_check(message: Message, state: FSMContext, bot: Bot)
         await state.clear()
         await message.answer(
             "Jarayon qayta boshlandi. Menyudan tugmani tanlang.",
-            reply_markup=_menu_markup(user_id, has_parent=True),
+            reply_markup=_menu_markup(tenant, user_id, has_parent=True),
         )
         return
 
-    async with async_session() as session:
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
-        if not parent:
-            await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
-            await state.clear()
-            return
-
-        student = await session.get(Student, student_id)
-        if not student:
-            await message.answer("O'quvchi topilmadi. Qayta urinib ko'ring.")
-            await state.clear()
-            await message.answer("Menyudan tugmani tanlang.", reply_markup=_menu_markup(user_id, has_parent=True))
-            return
-
-        input_first_name = _normalize_name(_first_token(parent_input_name))
-        student_first_name = _normalize_name(_first_token(student.full_name))
-        if not input_first_name or input_first_name != student_first_name:
-            await message.answer("Ism mos kelmadi. Qayta kiriting.")
-            return
-
-        created = await crud.link_parent_student(session, parent.id, student.id)
-        if created:
-            await message.answer(f"Bog'landi: {student.full_name}")
-        else:
-            await message.answer(f"Bu o'quvchi allaqachon bog'langan: {student.full_name}")
-
-        grades = await crud.get_notifications_for_parent(session, parent.id, student.id)
-        if grades:
-            await _send_pending_grades(bot, session, parent.id, parent.tg_user_id, grades)
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    if not parent:
+        await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
+        await state.clear()
+        return
+
+    student = await session.get(Student, student_id)
+    if not student:
+        await message.answer("O'quvchi topilmadi. Qayta urinib ko'ring.")
+        await state.clear()
+        await message.answer("Menyudan tugmani tanlang.", reply_markup=_menu_markup(tenant, user_id, has_parent=True))
+        return
+
+    input_first_name = normalize_name(_first_token(parent_input_name))
+    student_first_name = _first_token(student.normalized_name)
+    if not input_first_name or input_first_name != student_first_name:
+        await message.answer("Ism mos kelmadi. Qayta kiriting.")
+        return
+
+    created = await crud.link_parent_student(session, parent.id, student.id)
+    grades = await crud.get_notifications_for_parent(session, parent.id, student.id)
+    summaries = await crud.get_term_summaries_for_student(session, student.id)
+    await db.release()
+
+    if created:
+        await message.answer(f"Bog'landi: {student.full_name}")
+    else:
+        await message.answer(f"Bu o'quvchi allaqachon bog'langan: {student.full_name}")
+
+    if summaries:
+        await message.answer(format_term_summaries(student.full_name, summaries))
+    if grades:
+        await _send_pending_grades(bot, db, parent.id, student.id, grades)
 
     await state.clear()
-    await message.answer("Menyudan tugmani tanlang.", reply_markup=_menu_markup(user_id, has_parent=True))
+    await message.answer("Menyudan tugmani tanlang.", reply_markup=_menu_markup(tenant, user_id, has_parent=True))
 
 
 @router.message(F.text == BTN_CHILDREN)
 @router.message(Command("children"))
-async def list_children(message: Message):
+async def list_children(message: Message, db: LazySession, tenant: Tenant):
     if message.chat.type != "private":
         return
 
     user_id = message.from_user.id if message.from_user else None
-    async with async_session() as session:
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
-        if not parent:
-            await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
-            return
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    if not parent:
+        await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
+        return
 
-        students = await crud.get_students_for_parent(session, parent.id)
-        if not students:
-            await message.answer("Hozircha bog'langan bolalar yo'q.", reply_markup=_menu_markup(user_id, has_parent=True))
-            return
+    students = await crud.get_students_for_parent(session, parent.id)
+    await db.release()
+    if not students:
+        await message.answer("Hozircha bog'langan bolalar yo'q.", reply_markup=_menu_markup(tenant, user_id, has_parent=True))
+        return
+
+    lines = [f"- {s.full_name} (#{s.code})" for s in students]
+    await message.answer("Bog'langan bolalar:\n" + "\n".join(lines), reply_markup=_menu_markup(tenant, user_id, has_parent=True))
+
+
+async def _history_page(
+    session,
+    student: Student,
+    older_than: tuple[date, int] | None = None,
+    newer_than: tuple[date, int] | None = None,
+):
+    summary = await crud.get_grade_summary(session, student.id)
+    rows, has_more = await crud.get_grade_history_page(
+        session, student.id, HISTORY_PAGE_SIZE, older_than=older_than, newer_than=newer_than
+    )
+    # Paging newer means older lessons exist (we came from them), and the other way round.
+    has_newer = has_more if newer_than is not None else older_than is not None
+    has_older = has_more if newer_than is None else True
+    markup = None
+    if rows:
+        markup = history_keyboard(
+            student.id,
+            rows[0][:2] if has_newer else None,
+            rows[-1][:2] if has_older else None,
+        )
+    return format_grade_history(student.full_name, summary, rows), markup
 
-        lines = [f"- {s.full_name} (#{s.code})" for s in students]
-        await message.answer("Bog'langan bolalar:\n" + "\n".join(lines), reply_markup=_menu_markup(user_id, has_parent=True))
+
+@router.message(F.text == BTN_HISTORY)
+@router.message(Command("history"))
+async def grade_history(message: Message, db: LazySession, tenant: Tenant):
+    if message.chat.type != "private":
+        return
+
+    user_id = message.from_user.id if message.from_user else None
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    if not parent:
+        await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
+        return
+
+    students = await crud.get_students_for_parent(session, parent.id)
+    if not students:
+        await db.release()
+        await message.answer("Hozircha bog'langan bolalar yo'q.", reply_markup=_menu_markup(tenant, user_id, has_parent=True))
+        return
+    if len(students) > 1:
+        await db.release()
+        await message.answer(
+            "Qaysi farzandingizning baholari?",
+            reply_markup=history_children_keyboard([(s.id, s.full_name) for s in students]),
+        )
+        return
+
+    text, markup = await _history_page(session, students[0])
+    await db.release()
+    await message.answer(text, reply_markup=markup)
+
+
+@router.callback_query(F.data.startswith("hist:"))
+async def grade_history_page(callback: CallbackQuery, db: LazySession, tenant: Tenant):
+    # hist:<student_id> opens the latest page, hist:<student_id>:older|newer:<date>:<lesson_id> pages
+    # from a cursor.
+    parts = callback.data.split(":")
+    student_id = int(parts[1])
+    cursors = {}
+    if len(parts) == 5 and parts[2] in {"older", "newer"}:
+        cursors[f"{parts[2]}_than"] = (date.fromisoformat(parts[3]), int(parts[4]))
+
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, callback.from_user.id, tenant.id)
+    if not parent or not await crud.is_student_linked(session, parent.id, student_id):
+        await db.release()
+        await callback.answer("Bu o'quvchi sizga bog'lanmagan.", show_alert=True)
+        return
+    student = await crud.get_student_by_id(session, student_id)
+    text, markup = await _history_page(session, student, **cursors)
+    await db.release()
+
+    await callback.answer()
+    if callback.message:
+        try:
+            await callback.message.edit_text(text, reply_markup=markup)
+        except TelegramBadRequest:
+            pass
+
+
+@router.message(F.text == BTN_DELIVERY)
+@router.message(Command("digest"))
+async def delivery_settings(message: Message, db: LazySession, tenant: Tenant):
+    if message.chat.type != "private":
+        return
+
+    user_id = message.from_user.id if message.from_user else None
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    await db.release()
+    if not parent:
+        await message.answer("Avval /start orqali ro‘yxatdan o‘ting.")
+        return
+
+    await message.answer(
+        f"Baholar qanday yuborilsin?\nHozirgi: {_delivery_mode_text(parent.delivery_mode)}",
+        reply_markup=delivery_mode_keyboard(parent.delivery_mode, DIGEST_TIME),
+    )
+
+
+@router.callback_query(F.data.startswith("delivery:"))
+async def pick_delivery_mode(callback: CallbackQuery, db: LazySession, tenant: Tenant):
+    mode = DeliveryMode(callback.data.split(":")[1])
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, callback.from_user.id, tenant.id)
+    if not parent:
+        await callback.answer("Avval /start orqali ro‘yxatdan o‘ting.", show_alert=True)
+        return
+    await crud.set_parent_delivery_mode(session, parent.id, mode)
+    await db.release()
+
+    if callback.message:
+        await callback.message.edit_text(
+            f"Saqlandi: {_delivery_mode_text(mode)}",
+            reply_markup=delivery_mode_keyboard(mode, DIGEST_TIME),
+        )
+    await callback.answer("Saqlandi")
+
+
+def _delivery_mode_text(mode: DeliveryMode) -> str:
+    if mode == DeliveryMode.DIGEST:
+        return f"kuniga bir marta, {DIGEST_TIME} da"
+    return "har bir baho darhol"
 
 
 @router.message(F.text == BTN_ADMIN_PANEL)
 @router.message(Command("admin"))
-async def admin_panel(message: Message):
+async def admin_panel(message: Message, db: LazySession, tenant: Tenant):
     if message.chat.type != "private":
         return
 
     user_id = message.from_user.id if message.from_user else None
-    if not _is_super_admin(user_id):
+    if not tenant.is_admin(user_id):
         await message.answer("Bu bo'lim faqat admin uchun.")
         return
 
-    async with async_session() as session:
-        groups = await crud.get_groups_overview(session)
-        students = await crud.get_all_students_with_group(session)
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
+    try:
+        async with read_session() as reports:
+            groups = await crud.get_groups_overview(reports, tenant.id)
+            students = await crud.get_all_students_with_group(reports, tenant.id)
+    except DBAPIError:
+        logger.exception("Admin report failed")
+        await message.answer("Hisobotni hozir tayyorlab bo'lmadi, birozdan keyin urinib ko'ring.")
+        return
+
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    await db.release()
 
     total_groups = len(groups)
     total_students = len(students)
@@ -323,7 +421,7 @@ async def admin_panel(message: Message):
         f"Jami guruhlar: {total_groups}\n"
         f"Jami o'quvchilar: {total_students}"
     )
-    await message.answer(header, reply_markup=_menu_markup(user_id, has_parent=bool(parent)))
+    await message.answer(header, reply_markup=_menu_markup(tenant, user_id, has_parent=bool(parent)))
 
     group_lines = ["Guruhlar:"]
     if not groups:
@@ -345,51 +443,46 @@ async def admin_panel(message: Message):
 
 
 @router.message(Command("cancel"))
-async def cancel(message: Message, state: FSMContext):
+async def cancel(message: Message, state: FSMContext, db: LazySession, tenant: Tenant):
     await state.clear()
     user_id = message.from_user.id if message.from_user else None
-    async with async_session() as session:
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
-    await message.answer("Bekor qilindi.", reply_markup=_menu_markup(user_id, has_parent=bool(parent)))
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    await db.release()
+    await message.answer("Bekor qilindi.", reply_markup=_menu_markup(tenant, user_id, has_parent=bool(parent)))
 
 
 @router.message(F.chat.type == "private")
-async def parent_menu_fallback(message: Message):
+async def parent_menu_fallback(message: Message, db: LazySession, tenant: Tenant):
     user_id = message.from_user.id if message.from_user else None
-    async with async_session() as session:
-        parent = await crud.get_parent_by_tg_user_id(session, user_id)
-    if parent or _is_super_admin(user_id):
+    session = await db.get()
+    parent = await crud.get_parent_by_tg_user_id(session, user_id, tenant.id)
+    await db.release()
+    if parent or tenant.is_admin(user_id):
         await message.answer(
             "Menyudan tugmani tanlang.",
-            reply_markup=_menu_markup(user_id, has_parent=bool(parent)),
+            reply_markup=_menu_markup(tenant, user_id, has_parent=bool(parent)),
         )
 
 
 async def _send_long_text(message: Message, text: str, chunk_size: int = 3500):
-    current = []
-    current_len = 0
-    for line in text.splitlines():
-        line_len = len(line) + 1
-        if current_len + line_len > chunk_size and current:
-            await message.answer("\n".join(current))
-            current = [line]
-            current_len = line_len
-        else:
-            current.append(line)
-            current_len += line_len
-    if current:
-        await message.answer("\n".join(current))
-
-
-async def _send_pending_grades(bot: Bot, session, parent_id: int, parent_tg_id: int, grades):
-    for grade in grades:
-        if grade.status == LessonGradeStatus.PENDING:
-            continue
-        notification = await crud.get_notification(session, grade.id, parent_id)
-        if notification:
-            continue
-        notification = await crud.create_notification(session, grade.id, parent_id)
+    for chunk in split_text(text, chunk_size):
+        await message.answer(chunk)
+
+
+async def _send_pending_grades(bot: Bot, db: LazySession, parent_id: int, student_id: int, grades):
+    # Catch-up after linking: grades the parent was never sent. Digest-mode parents get them
+    # in the next digest; instant-mode parents now.
+    graded = {grade.id: grade for grade in grades if grade.status != LessonGradeStatus.PENDING}
+    session = await db.get()
+    targets = await crud.enqueue_grade_notifications(session, list(graded), student_id, parent_id=parent_id)
+    await db.release()
+    if not targets:
+        return
 
+    deliveries = []
+    for notification_id, chat_id, lesson_grade_id in targets:
+        grade = graded[lesson_grade_id]
         group_title = grade.lesson.group.title if grade.lesson and grade.lesson.group else "Guruh"
         message_text = format_grade_message(
             group_title=group_title,
@@ -398,12 +491,9 @@ async def _send_pending_grades(bot: Bot, session, parent_id: int, parent_tg_id:
             status=grade.status,
             score=grade.score,
         )
-        try:
-            await bot.send_message(parent_tg_id, message_text)
-            notification.status = NotificationStatus.SENT
-            notification.sent_at = datetime.utcnow()
-            notification.error = None
-        except Exception as exc:
-            notification.status = NotificationStatus.FAILED
-            notification.error = str(exc)[:255]
-        await session.commit()
+        deliveries.append(Delivery([notification_id], chat_id, [message_text]))
+    result = await fan_out(bot, deliveries)
+
+    session = await db.get()
+    await crud.mark_deliveries(session, result.sent_ids, result.failed)
+    await db.release()
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from typing import Callable
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import GetUpdates
+from aiohttp import web
+
+from app import crud
+from app.config import (
+    HEALTH_HOST,
+    HEALTH_POLL_STALE_S,
+    HEALTH_PORT,
+    HEALTH_WORKER_STALE_S,
+    LOOP_LAG_WARN_MS,
+    LOOP_STALL_MS,
+)
+from app.db import async_session
+from app.scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two loop-lag samples, and between two "event loop lag" log lines.
+LAG_SAMPLE_INTERVAL = 0.5
+METRICS_LOG_INTERVAL = 60.0
+# Upper bounds (ms) of the lag histogram buckets; the last bucket counts everything above.
+LAG_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Seconds the readiness check waits for the database.
+DB_CHECK_TIMEOUT = 2.0
+
+
+class LoopLagMonitor:
+    # A task that sleeps LAG_SAMPLE_INTERVAL and records how late it wakes up. A lag above
+    # warn_ms is logged; a thread watches the same heartbeat and, while the loop is blocked
+    # for stall_ms, logs the loop thread's stack, i.e. the code that is blocking it.
+    def __init__(self, warn_ms: float, stall_ms: float):
+        self.warn_ms = warn_ms
+        self.stall_ms = stall_ms
+        self.histogram = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.samples = 0
+        self.max_lag_ms = 0.0
+        self.last_lag_ms = 0.0
+        self.stalls = 0
+        self.last_tick: float | None = None
+        self._loop_thread_id: int | None = None
+        self._dumped = False
+        self._last_report = time.monotonic()
+
+    def record(self, lag_ms: float) -> None:
+        self.histogram[bisect_left(LAG_BUCKETS_MS, lag_ms)] += 1
+        self.samples += 1
+        self.last_lag_ms = lag_ms
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+
+    def stale_for(self) -> float:
+        # Seconds since the sampler last ran beyond its normal sleep.
+        if self.last_tick is None:
+            return 0.0
+        return max(0.0, time.monotonic() - self.last_tick - LAG_SAMPLE_INTERVAL)
+
+    def snapshot(self) -> dict:
+        buckets = [f"<={bound}ms" for bound in LAG_BUCKETS_MS] + [f">{LAG_BUCKETS_MS[-1]}ms"]
+        return {
+            "samples": self.samples,
+            "last_ms": round(self.last_lag_ms, 1),
+            "max_ms": round(self.max_lag_ms, 1),
+            "stalls": self.stalls,
+            "histogram": {bucket: count for bucket, count in zip(buckets, self.histogram) if count},
+        }
+
+    async def run(self, on_tick=None) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        stop = threading.Event()
+        watcher = threading.Thread(target=self._watch, args=(stop,), name="loop-lag-watch", daemon=True)
+        watcher.start()
+        try:
+            while True:
+                expected = time.monotonic() + LAG_SAMPLE_INTERVAL
+                await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+                now = time.monotonic()
+                lag_ms = max(0.0, (now - expected) * 1000)
+                self.last_tick = now
+                self._dumped = False
+                self.record(lag_ms)
+                if lag_ms >= self.warn_ms:
+                    logger.warning("Event loop lagged %.0f ms", lag_ms)
+                if on_tick is not None:
+                    on_tick()
+                if now - self._last_report >= METRICS_LOG_INTERVAL:
+                    self._last_report = now
+                    logger.info("Event loop lag: %s", self.snapshot())
+        finally:
+            stop.set()
+
+    def _watch(self, stop: threading.Event) -> None:
+        while not stop.wait(self.stall_ms / 1000 / 4):
+            blocked_ms = self.stale_for() * 1000
+            if blocked_ms < self.stall_ms or self._dumped:
+                continue
+            self._dumped = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+            logger.error("Event loop blocked for %.0f ms, loop thread stack:\n%s", blocked_ms, stack)
+
+
+class PollTracker(BaseRequestMiddleware):
+    # Bot session middleware: remembers when each bot's getUpdates last succeeded.
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last_poll: dict[int, float] = {}
+        self.bots: set[int] = set()
+
+    async def __call__(self, make_request, bot: Bot, method):
+        result = await make_request(bot, method)
+        if isinstance(method, GetUpdates):
+            self.last_poll[bot.id] = time.monotonic()
+        return result
+
+    def oldest_poll_age(self) -> float:
+        # A bot that never polled counts from process start.
+        now = time.monotonic()
+        return max((now - self.last_poll.get(bot_id, self.started) for bot_id in self.bots), default=0.0)
+
+
+class WorkerHeartbeats:
+    # Supervisor side of sharded mode: every worker's lag sampler sends (index, lag_ms) over a
+    # queue on each tick. A worker whose heartbeats stop is blocked or dead.
+    def __init__(self):
+        self.started = time.monotonic()
+        self.workers = 0
+        self.last_beat: dict[int, float] = {}
+        self.lag_ms: dict[int, float] = {}
+
+    def listen(self, queue, workers: int) -> None:
+        # A thread, like the stall watcher: it keeps counting while the supervisor's loop is busy.
+        self.started = time.monotonic()
+        self.workers = workers
+        threading.Thread(target=self._read, args=(queue,), name="worker-heartbeats", daemon=True).start()
+
+    def _read(self, queue) -> None:
+        while True:
+            beat = queue.get()
+            if beat is None:
+                return
+            index, lag_ms = beat
+            self.last_beat[index] = time.monotonic()
+            self.lag_ms[index] = lag_ms
+
+    def beat_age(self, index: int) -> float:
+        # A worker that never reported counts from the supervisor's start.
+        return time.monotonic() - self.last_beat.get(index, self.started)
+
+    def stale(self) -> list[int]:
+        return [index for index in range(self.workers) if self.beat_age(index) > HEALTH_WORKER_STALE_S]
+
+    def snapshot(self) -> dict:
+        return {
+            str(index): {"beat_age_s": round(self.beat_age(index), 1), "lag_ms": round(self.lag_ms.get(index, 0.0), 1)}
+            for index in range(self.workers)
+        }
+
+
+monitor = LoopLagMonitor(LOOP_LAG_WARN_MS, LOOP_STALL_MS)
+polls = PollTracker()
+workers = WorkerHeartbeats()
+
+
+def instrument_bot(bot: Bot) -> Bot:
+    # Only for bots that poll (the single process, or the supervisor).
+    polls.bots.add(bot.id)
+    bot.session.middleware(polls)
+    return bot
+
+
+def sd_notify(state: str) -> None:
+    # systemd's notify protocol (Type=notify, WatchdogSec): one datagram to $NOTIFY_SOCKET.
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode(), address)
+    except OSError as exc:
+        logger.debug("sd_notify failed: %s", exc)
+
+
+def is_live() -> bool:
+    # A stale sampler means the monitor task died; a stale worker is blocked or gone.
+    return monitor.stale_for() * 1000 < LOOP_STALL_MS and not workers.stale()
+
+
+def _watchdog_tick() -> None:
+    # systemd restarts the service once the pings stop, so a stalled worker withholds them too.
+    if is_live():
+        sd_notify("WATCHDOG=1")
+
+
+async def live(request: web.Request) -> web.Response:
+    # Answering at all means this loop runs.
+    ok = is_live()
+    body = {"ok": ok, "loop_lag": monitor.snapshot()}
+    if workers.workers:
+        body["workers"] = workers.snapshot()
+    return web.json_response(body, status=200 if ok else 503)
+
+
+async def ready(request: web.Request) -> web.Response:
+    checks: dict = {}
+    try:
+        async with async_session() as session:
+            checks["outbox"] = await asyncio.wait_for(crud.get_outbox_depth(session), DB_CHECK_TIMEOUT)
+        checks["database"] = "ok"
+    except Exception as exc:
+        checks["database"] = f"{type(exc).__name__}: {exc}"[:200]
+    poll_age = polls.oldest_poll_age()
+    checks["poll_age_s"] = round(poll_age, 1)
+    checks["scheduler"] = scheduler.snapshot()
+    ok = checks["database"] == "ok" and poll_age < HEALTH_POLL_STALE_S
+    return web.json_response({"ok": ok, **checks}, status=200 if ok else 503)
+
+
+async def run_health(serve: bool = True, on_tick: Callable[[], None] | None = None) -> None:
+    # Runs until cancelled. Worker processes pass serve=False and an on_tick that reports their
+    # lag to the supervisor: only the polling process answers HTTP checks and talks to systemd.
+    runner = None
+    if serve and HEALTH_PORT:
+        app = web.Application()
+        app.router.add_get("/health/live", live)
+        app.router.add_get("/health/ready", ready)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, HEALTH_HOST, HEALTH_PORT).start()
+        logger.info("Health endpoints on http://%s:%s/health/{live,ready}", HEALTH_HOST, HEALTH_PORT)
+    if serve:
+        sd_notify("READY=1")
+        on_tick = _watchdog_tick
+    try:
+        await monitor.run(on_tick=on_tick)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
@@ -1,17 +1,22 @@
+from datetime import date
+
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ReplyKeyboardMarkup,
     KeyboardButton,
 )
-from app.models import LessonGradeStatus
+from app.models import DeliveryMode, LessonGradeStatus
 
 
-def students_keyboard(students: list[tuple[int, str]]) -> InlineKeyboardMarkup:
-    buttons = [
+def students_keyboard(students: list[tuple[int, str]], search_query: str | None = None) -> InlineKeyboardMarkup:
+    buttons = []
+    if search_query is not None:
+        buttons.append([InlineKeyboardButton(text="🔎 Qidirish", switch_inline_query_current_chat=search_query)])
+    buttons.extend(
         [InlineKeyboardButton(text=name, callback_data=f"grade_student:{student_id}")]
         for student_id, name in students
-    ]
+    )
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
@@ -31,12 +36,65 @@ def score_keyboard(student_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def leaderboard_keyboard(window: str, page: int, page_count: int) -> InlineKeyboardMarkup | None:
+    if page_count <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️ Oldingi", callback_data=f"lb:{window}:{page - 1}"))
+    if page < page_count - 1:
+        buttons.append(InlineKeyboardButton(text="Ko'proq ▶️", callback_data=f"lb:{window}:{page + 1}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
+def history_children_keyboard(students: list[tuple[int, str]]) -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(text=name, callback_data=f"hist:{student_id}")] for student_id, name in students]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def history_keyboard(
+    student_id: int, newer_than: tuple[date, int] | None, older_than: tuple[date, int] | None
+) -> InlineKeyboardMarkup | None:
+    # Keyset cursors: the (lesson_date, lesson_id) of the first and last lesson shown on the current page.
+    buttons = []
+    if newer_than:
+        day, lesson_id = newer_than
+        callback_data = f"hist:{student_id}:newer:{day.isoformat()}:{lesson_id}"
+        buttons.append(InlineKeyboardButton(text="◀️ Yangiroq", callback_data=callback_data))
+    if older_than:
+        day, lesson_id = older_than
+        callback_data = f"hist:{student_id}:older:{day.isoformat()}:{lesson_id}"
+        buttons.append(InlineKeyboardButton(text="Eskiroq ▶️", callback_data=callback_data))
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
 def parent_menu_keyboard(is_admin: bool = False, include_parent: bool = True) -> ReplyKeyboardMarkup:
     rows = []
     if include_parent:
         rows.append([KeyboardButton(text="Bolani bog'lash")])
         rows.append([KeyboardButton(text="Bog'langan bolalarim")])
+        rows.append([KeyboardButton(text="Baholar tarixi")])
+        rows.append([KeyboardButton(text="Xabarnoma sozlamalari")])
     if is_admin:
         rows.append([KeyboardButton(text="Admin panel")])
 
     return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, is_persistent=True)
+
+
+def delivery_mode_keyboard(current: DeliveryMode, digest_time: str) -> InlineKeyboardMarkup:
+    labels = {
+        DeliveryMode.INSTANT: "Darhol",
+        DeliveryMode.DIGEST: f"Kunlik hisobot ({digest_time})",
+    }
+    buttons = [
+        [
+            InlineKeyboardButton(
+                text=("✅ " if mode == current else "") + label,
+                callback_data=f"delivery:{mode.value}",
+            )
+        ]
+        for mode, label in labels.items()
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
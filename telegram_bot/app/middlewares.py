@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.cache import TTLCache
+from app.db import async_session
+from app.handlers.common import is_admin
+from app.tenants import Tenant
+
+
+class LazySession:
+    # One session per update, opened on first use. Handlers call release() before slow
+    # Bot API calls so no connection or SQLite lock is held across network I/O; a later
+    # get() simply opens a fresh session.
+    def __init__(self, factory: async_sessionmaker = async_session):
+        self._factory = factory
+        self._session: AsyncSession | None = None
+
+    async def get(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._factory()
+        return self._session
+
+    async def release(self) -> None:
+        session, self._session = self._session, None
+        if session is None:
+            return
+        try:
+            await session.commit()
+        finally:
+            await session.close()
+
+    async def discard(self) -> None:
+        session, self._session = self._session, None
+        if session is None:
+            return
+        try:
+            await session.rollback()
+        finally:
+            await session.close()
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        db = LazySession()
+        data["db"] = db
+        try:
+            result = await handler(event, data)
+        except Exception:
+            await db.discard()
+            raise
+        await db.release()
+        return result
+
+
+class TenantMiddleware(BaseMiddleware):
+    # Every bot token belongs to one tenant; handlers scope their queries by data["tenant"].
+    def __init__(self, tenants: list[Tenant]):
+        self._by_bot_id = {tenant.bot_id: tenant for tenant in tenants}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        tenant = self._by_bot_id.get(data["bot"].id)
+        if tenant is None:
+            return None
+        data["tenant"] = tenant
+        return await handler(event, data)
+
+
+class CallbackDedupeMiddleware(BaseMiddleware):
+    # A double tap arrives as two callbacks; only the first one within the window does the DB
+    # and Bot API work, whoever tapped. Grading taps of non-admins are never recorded (the
+    # handler refuses them), so they can't swallow an admin's tap on the same button.
+    def __init__(self, window: float = 3.0, admin_prefixes: tuple[str, ...] = ("grade_",)):
+        self._seen = TTLCache(ttl=window, max_size=4096)
+        self._admin_prefixes = admin_prefixes
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: dict[str, Any],
+    ) -> Any:
+        bot = data["bot"]
+        keys = [("id", event.id)]
+        if event.message:
+            recorded = True
+            if (event.data or "").startswith(self._admin_prefixes):
+                recorded = await is_admin(bot, event.message.chat.id, event.from_user.id)
+            if recorded:
+                keys.append(("tap", bot.id, event.message.chat.id, event.message.message_id, event.data))
+        # No await between the lookup and the set: of two admins tapping at once only one gets through.
+        if any(self._seen.get(key) for key in keys):
+            await event.answer()
+            return None
+        for key in keys:
+            self._seen.set(key, True)
+        return await handler(event, data)
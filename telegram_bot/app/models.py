@@ -11,12 +11,16 @@ from sqlalchemy import (
     DateTime,
     Enum as SqlEnum,
     ForeignKey,
+    Index,
     UniqueConstraint,
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.db import Base
 
+# Tenant of rows created before multi-tenant mode and of the single BOT_TOKEN setup.
+DEFAULT_TENANT_ID = "default"
+
 
 class StudentStatus(str, Enum):
     ACTIVE = "ACTIVE"
@@ -36,14 +40,22 @@ class NotificationStatus(str, Enum):
     FAILED = "FAILED"
 
 
+class DeliveryMode(str, Enum):
+    INSTANT = "INSTANT"
+    DIGEST = "DIGEST"
+
+
 class Group(Base):
     __tablename__ = "groups"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    chat_id: Mapped[int] = mapped_column(BigInteger, unique=True, index=True)
+    tenant_id: Mapped[str] = mapped_column(String(64), default=DEFAULT_TENANT_ID, server_default=DEFAULT_TENANT_ID)
+    chat_id: Mapped[int] = mapped_column(BigInteger, index=True)
     title: Mapped[str | None] = mapped_column(String(255), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index("uq_groups_tenant_chat", "tenant_id", "chat_id", unique=True),)
+
     students: Mapped[list[Student]] = relationship("Student", back_populates="group")
     lessons: Mapped[list[Lesson]] = relationship("Lesson", back_populates="group")
     state: Mapped[GroupState | None] = relationship("GroupState", back_populates="group", uselist=False)
@@ -57,10 +69,13 @@ class Student(Base):
     tg_user_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True, index=True)
     tg_username: Mapped[str | None] = mapped_column(String(64), nullable=True, index=True)
     full_name: Mapped[str] = mapped_column(String(255), nullable=False)
+    normalized_name: Mapped[str] = mapped_column(String(255), nullable=False, default="", server_default="", index=True)
     code: Mapped[str] = mapped_column(String(10), unique=True, index=True)
     status: Mapped[StudentStatus] = mapped_column(SqlEnum(StudentStatus), default=StudentStatus.ACTIVE)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index("ix_students_group_normalized_name", "group_id", "normalized_name"),)
+
     group: Mapped[Group] = relationship("Group", back_populates="students")
     grades: Mapped[list[LessonGrade]] = relationship("LessonGrade", back_populates="student")
 
@@ -69,11 +84,17 @@ class Parent(Base):
     __tablename__ = "parents"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    tg_user_id: Mapped[int] = mapped_column(BigInteger, unique=True, index=True)
+    tenant_id: Mapped[str] = mapped_column(String(64), default=DEFAULT_TENANT_ID, server_default=DEFAULT_TENANT_ID)
+    tg_user_id: Mapped[int] = mapped_column(BigInteger, index=True)
     full_name: Mapped[str] = mapped_column(String(255), nullable=False)
     phone: Mapped[str] = mapped_column(String(32), nullable=False)
+    delivery_mode: Mapped[DeliveryMode] = mapped_column(
+        SqlEnum(DeliveryMode), default=DeliveryMode.INSTANT, server_default=DeliveryMode.INSTANT.value
+    )
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index("uq_parents_tenant_tg_user", "tenant_id", "tg_user_id", unique=True),)
+
     students: Mapped[list[ParentStudent]] = relationship("ParentStudent", back_populates="parent")
 
 
@@ -97,6 +118,8 @@ class Lesson(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     group_id: Mapped[int] = mapped_column(ForeignKey("groups.id"), index=True)
     lesson_date: Mapped[date] = mapped_column(Date)
+    # Set by /close or the auto-close; a closed lesson's grades are final.
+    closed_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
 
     __table_args__ = (UniqueConstraint("group_id", "lesson_date", name="uq_group_lesson_date"),)
 
@@ -109,13 +132,17 @@ class LessonGrade(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     lesson_id: Mapped[int] = mapped_column(ForeignKey("lessons.id"), index=True)
-    student_id: Mapped[int] = mapped_column(ForeignKey("students.id"), index=True)
+    student_id: Mapped[int] = mapped_column(ForeignKey("students.id"))
     status: Mapped[LessonGradeStatus] = mapped_column(SqlEnum(LessonGradeStatus), default=LessonGradeStatus.PENDING)
     score: Mapped[int | None] = mapped_column(Integer, nullable=True)
     graded_by_tg_user_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
-    __table_args__ = (UniqueConstraint("lesson_id", "student_id", name="uq_lesson_student"),)
+    __table_args__ = (
+        UniqueConstraint("lesson_id", "student_id", name="uq_lesson_student"),
+        # Every per-student lookup, including a parent's grade history (joined to the lessons by id).
+        Index("ix_lesson_grades_student_lesson", "student_id", "lesson_id"),
+    )
 
     lesson: Mapped[Lesson] = relationship("Lesson", back_populates="grades")
     student: Mapped[Student] = relationship("Student", back_populates="grades")
@@ -142,6 +169,66 @@ class StudentStats(Base):
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
+class StudentDailyStats(Base):
+    # Per-student per-day rollup of lesson_grades, maintained in update_grade; windowed leaderboards read only this.
+    __tablename__ = "student_daily_stats"
+
+    student_id: Mapped[int] = mapped_column(ForeignKey("students.id"), primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id"))
+    total_score: Mapped[int] = mapped_column(Integer, default=0)
+    done_count: Mapped[int] = mapped_column(Integer, default=0)
+    not_done_count: Mapped[int] = mapped_column(Integer, default=0)
+    absent_count: Mapped[int] = mapped_column(Integer, default=0)
+
+    __table_args__ = (Index("ix_student_daily_stats_group_day", "group_id", "day"),)
+
+
+class TermSummary(Base):
+    # Per-student totals of an archived term; the term's lesson_grades, rollups and notifications are deleted.
+    __tablename__ = "term_summaries"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    student_id: Mapped[int] = mapped_column(ForeignKey("students.id"), index=True)
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id"), index=True)
+    term: Mapped[str] = mapped_column(String(64))
+    ends_on: Mapped[date] = mapped_column(Date)
+    lesson_count: Mapped[int] = mapped_column(Integer, default=0)
+    total_score: Mapped[int] = mapped_column(Integer, default=0)
+    done_count: Mapped[int] = mapped_column(Integer, default=0)
+    not_done_count: Mapped[int] = mapped_column(Integer, default=0)
+    absent_count: Mapped[int] = mapped_column(Integer, default=0)
+
+    __table_args__ = (UniqueConstraint("student_id", "group_id", "term", name="uq_term_summary"),)
+
+
+class GradeEvent(Base):
+    # Append-only ledger of grade changes, written in update_grade's transaction. Student, group
+    # and date are copied in so projections replay without joins and events outlive lessons.
+    __tablename__ = "grade_events"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    lesson_grade_id: Mapped[int] = mapped_column(Integer, index=True)
+    student_id: Mapped[int] = mapped_column(Integer, index=True)
+    group_id: Mapped[int] = mapped_column(Integer)
+    lesson_date: Mapped[date] = mapped_column(Date)
+    old_status: Mapped[LessonGradeStatus | None] = mapped_column(SqlEnum(LessonGradeStatus), nullable=True)
+    old_score: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    new_status: Mapped[LessonGradeStatus] = mapped_column(SqlEnum(LessonGradeStatus))
+    new_score: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    actor_tg_user_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class ProjectionCheckpoint(Base):
+    # Last grade_events.id folded into a projection (student_stats, daily_stats).
+    __tablename__ = "projection_checkpoints"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    last_event_id: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
 class GroupState(Base):
     __tablename__ = "group_states"
 
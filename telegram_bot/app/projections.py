@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import logging
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete
+
+from app import crud
+from app.models import GradeEvent, StudentDailyStats
+
+logger = logging.getLogger(__name__)
+
+EVENT_BATCH_SIZE = 5000
+
+
+async def _apply_student_stats(session, events: list[GradeEvent]) -> None:
+    deltas: dict[int, int] = defaultdict(int)
+    for event in events:
+        deltas[event.student_id] += crud.not_done_delta(event.old_status, event.new_status)
+    await crud.apply_not_done_deltas(session, deltas)
+
+
+async def _apply_daily_stats(session, events: list[GradeEvent]) -> None:
+    deltas: dict[tuple, dict[str, int]] = {}
+    for event in events:
+        old = crud.grade_contribution(event.old_status, event.old_score)
+        new = crud.grade_contribution(event.new_status, event.new_score)
+        changes = deltas.setdefault(
+            (event.student_id, event.lesson_date, event.group_id), dict.fromkeys(crud.DAILY_STATS_FIELDS, 0)
+        )
+        for field in crud.DAILY_STATS_FIELDS:
+            changes[field] += new[field] - old[field]
+    await crud.apply_daily_deltas(session, deltas)
+
+
+async def _reset_daily_stats(session) -> None:
+    await session.execute(delete(StudentDailyStats))
+
+
+# name -> (fold a batch of events into the projection, empty the projection before a rebuild)
+PROJECTIONS: dict[str, tuple[Callable[..., Awaitable[None]], Callable[..., Awaitable[None]]]] = {
+    "student_stats": (_apply_student_stats, crud.reset_not_done_stats),
+    "daily_stats": (_apply_daily_stats, _reset_daily_stats),
+}
+
+
+async def catch_up(session, name: str, batch_size: int = EVENT_BATCH_SIZE) -> int:
+    # Streams events after the checkpoint; each batch and the new checkpoint commit together,
+    # so an interrupted run resumes where it stopped.
+    # Events of archived terms are kept but skipped: term_summaries already count them.
+    apply, _ = PROJECTIONS[name]
+    last_event_id = await crud.get_projection_checkpoint(session, name)
+    since = await crud.get_archived_until(session)
+    applied = 0
+    while True:
+        events = await crud.get_grade_events_after(session, last_event_id, batch_size, since)
+        if not events:
+            return applied
+        await apply(session, events)
+        last_event_id = events[-1].id
+        await crud.set_projection_checkpoint(session, name, last_event_id)
+        await session.commit()
+        applied += len(events)
+        session.expunge_all()
+        logger.info("%s: applied %s events (up to #%s)", name, applied, last_event_id)
+
+
+async def apply_live(session, events: list) -> None:
+    # Folds events written outside update_grade into every live projection in the caller's transaction
+    # and moves the checkpoints past them, like a live write: catch-up never sees them again, and a
+    # grade saved meanwhile can't carry the checkpoints past events nobody applied.
+    if not events:
+        return
+    since = await crud.get_archived_until(session)
+    current = [event for event in events if since is None or event.lesson_date >= since]
+    for name in crud.LIVE_PROJECTIONS:
+        apply, _ = PROJECTIONS[name]
+        if current:
+            await apply(session, current)
+    await crud.advance_projection_checkpoints(session, max(event.id for event in events))
+
+
+async def rebuild(session, name: str, batch_size: int = EVENT_BATCH_SIZE) -> int:
+    # Run with the bot stopped: grades saved meanwhile would be counted live and by the replay.
+    _, reset = PROJECTIONS[name]
+    await reset(session)
+    await crud.set_projection_checkpoint(session, name, 0)
+    await session.commit()
+    return await catch_up(session, name, batch_size)
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject, Update
+
+from app.config import SCHEDULER_CONCURRENCY, SCHEDULER_QUEUE_LIMIT, SCHEDULER_USER_LIMIT
+from app.handlers.parent import BTN_CHILDREN, BTN_DELIVERY, BTN_HISTORY, BTN_LINK_CHILD
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two "update scheduler" log lines with the wait-time metrics.
+METRICS_LOG_INTERVAL = 60.0
+
+# Private texts that start or continue a parent flow; anything else in a private chat
+# (admin reports, the menu fallback) is the lowest class.
+REGISTRATION_COMMANDS = {"start", "link", "children", "history", "digest", "cancel"}
+REGISTRATION_TEXTS = {BTN_LINK_CHILD, BTN_CHILDREN, BTN_HISTORY, BTN_DELIVERY}
+
+
+class Priority(IntEnum):
+    GRADING = 0
+    REGISTRATION = 1
+    LOW = 2
+
+
+class _Waiter(NamedTuple):
+    future: asyncio.Future
+    user_id: int | None
+    queued_at: float
+
+
+class PriorityStats:
+    def __init__(self):
+        self.admitted = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, wait: float) -> None:
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict[str, float]:
+        average = self.total_wait / self.admitted if self.admitted else 0.0
+        return {
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "avg_wait_ms": round(average * 1000, 1),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+        }
+
+
+def classify_update(update: Update, data: dict[str, Any]) -> Priority:
+    chat = data.get("event_chat")
+    if chat is None or chat.type != "private":
+        # Group work: grading buttons, /grade, the inline student search, leaderboards.
+        return Priority.GRADING
+    if update.callback_query or data.get("raw_state"):
+        return Priority.REGISTRATION
+    message = update.message
+    text = (message.text or "").strip() if message else ""
+    if text in REGISTRATION_TEXTS:
+        return Priority.REGISTRATION
+    if text.startswith("/"):
+        command = text[1:].split(maxsplit=1)[0].split("@", 1)[0].lower()
+        if command in REGISTRATION_COMMANDS:
+            return Priority.REGISTRATION
+    if message and message.contact:
+        return Priority.REGISTRATION
+    return Priority.LOW
+
+
+class UpdateScheduler:
+    # At most `concurrency` updates run handlers at once; the rest wait in one queue per
+    # priority and a freed slot always goes to the most important waiting update. Grading is
+    # never shed. Lower classes are refused when a user already has `user_limit` updates in
+    # the scheduler, when `queue_limit` updates are waiting, and (for LOW) whenever grading
+    # work itself has to wait.
+    def __init__(self, concurrency: int, queue_limit: int, user_limit: int):
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.user_limit = user_limit
+        self._running = 0
+        self._queues: dict[Priority, deque[_Waiter]] = {priority: deque() for priority in Priority}
+        self._per_user: Counter[int] = Counter()
+        self.stats = {priority: PriorityStats() for priority in Priority}
+        self._last_report = time.monotonic()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _admissible(self, priority: Priority, user_id: int | None) -> bool:
+        if priority is Priority.GRADING:
+            return True
+        if user_id is not None and self._per_user[user_id] >= self.user_limit:
+            return False
+        if self._running < self.concurrency:
+            return True
+        if self.waiting >= self.queue_limit:
+            return False
+        return not (priority is Priority.LOW and self._queues[Priority.GRADING])
+
+    async def acquire(self, priority: Priority, user_id: int | None) -> bool:
+        if not self._admissible(priority, user_id):
+            self.stats[priority].shed += 1
+            return False
+        self._count_user(priority, user_id)
+        if self._running < self.concurrency and not self.waiting:
+            self._running += 1
+            self.stats[priority].record_wait(0.0)
+            return True
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user_id, time.monotonic())
+        self._queues[priority].append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was handed over just before the cancellation; pass it on.
+                self.release(priority, user_id)
+            else:
+                self._queues[priority].remove(waiter)
+                self._forget_user(priority, user_id)
+            raise
+        self.stats[priority].record_wait(time.monotonic() - waiter.queued_at)
+        return True
+
+    def release(self, priority: Priority, user_id: int | None) -> None:
+        self._forget_user(priority, user_id)
+        for priority in Priority:
+            queue = self._queues[priority]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.future.done():
+                    # The slot moves to the waiter without ever being free.
+                    waiter.future.set_result(None)
+                    self._report()
+                    return
+        self._running -= 1
+        self._report()
+
+    def _count_user(self, priority: Priority, user_id: int | None) -> None:
+        # Only the classes that can be shed count towards user_limit: a teacher grading a busy
+        # lesson must not lock themselves out of their own private chat.
+        if user_id is not None and priority is not Priority.GRADING:
+            self._per_user[user_id] += 1
+
+    def _forget_user(self, priority: Priority, user_id: int | None) -> None:
+        if user_id is None or priority is Priority.GRADING:
+            return
+        self._per_user[user_id] -= 1
+        if self._per_user[user_id] <= 0:
+            del self._per_user[user_id]
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "running": self._running,
+            "waiting": {priority.name.lower(): len(queue) for priority, queue in self._queues.items()},
+            "classes": {priority.name.lower(): stats.as_dict() for priority, stats in self.stats.items()},
+        }
+
+    def _report(self) -> None:
+        now = time.monotonic()
+        if now - self._last_report < METRICS_LOG_INTERVAL:
+            return
+        self._last_report = now
+        logger.info("Update scheduler: %s", self.snapshot())
+
+
+scheduler = UpdateScheduler(SCHEDULER_CONCURRENCY, SCHEDULER_QUEUE_LIMIT, SCHEDULER_USER_LIMIT)
+
+
+class SchedulerMiddleware(BaseMiddleware):
+    # Registered on dp.update after the built-in user/FSM middlewares (event_chat, raw_state)
+    # and before the DB session, so waiting updates hold no connection.
+    def __init__(self, update_scheduler: UpdateScheduler = scheduler):
+        self._scheduler = update_scheduler
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        priority = classify_update(event, data)
+        user = data.get("event_from_user")
+        user_id = user.id if user else None
+        if not await self._scheduler.acquire(priority, user_id):
+            logger.debug("Shed %s update %s from user %s", priority.name, event.update_id, user_id)
+            if isinstance(event.event, CallbackQuery):
+                await event.event.answer("Hozir band, birozdan keyin qayta urinib ko'ring.")
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            self._scheduler.release(priority, user_id)
@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import re
+import signal
+import time
+from typing import AsyncIterator, Callable, Iterable, NamedTuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from aiogram.types import Update
+
+from app import background, health, tracing
+from app.autoclose import auto_close_lesson, get_open_lessons, run_auto_close_scheduler
+from app.config import LESSON_AUTO_CLOSE_TIME
+from app.digest import run_digest_scheduler
+from app.tenants import Tenant, load_tenants
+from app.warmup import warm_caches
+
+logger = logging.getLogger(__name__)
+
+# Seconds before polling again after getUpdates (or a whole update stream) failed.
+POLL_RETRY_DELAY = 5
+# Inline queries carry no chat; the /grade search button pre-fills "c<chat_id> ".
+INLINE_CHAT_RE = re.compile(r"^c(-?\d+)\b")
+
+
+class CloseLesson(NamedTuple):
+    # Sent to a worker in place of an update: the auto-close of one of its chats' lessons.
+    group_id: int
+    lesson_id: int
+
+
+def shard_key(update: Update, inline_affinity: dict[int, int]) -> int:
+    # Everything keyed by a chat (FSM, group/lesson caches, per-chat locks) lives on the
+    # worker that owns that chat, so updates of one chat are routed by its id.
+    if update.inline_query:
+        match = INLINE_CHAT_RE.match(update.inline_query.query)
+        if match:
+            return int(match.group(1))
+        user_id = update.inline_query.from_user.id
+        return inline_affinity.get(user_id, user_id)
+
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and update.callback_query and update.callback_query.message:
+        chat = update.callback_query.message.chat
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+def track_inline_affinity(update: Update, inline_affinity: dict[int, int]) -> None:
+    # A bare "@bot ism" query is answered from the admin's last /grade chat, so it has
+    # to reach the worker that owns that chat.
+    message = update.message
+    if (
+        message
+        and message.from_user
+        and message.chat.type in {"group", "supergroup"}
+        and message.text
+        and message.text.startswith("/grade")
+    ):
+        inline_affinity[message.from_user.id] = message.chat.id
+
+
+async def poll_updates(tenant_id: str, bot: Bot, allowed_updates: list[str]) -> AsyncIterator[tuple[str, Update]]:
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except (TelegramNetworkError, TelegramServerError) as exc:
+            logger.warning("get_updates failed: %s", exc)
+            await asyncio.sleep(POLL_RETRY_DELAY)
+            continue
+        except Exception:
+            # Anything else (flood control, a bad response) must not stop this tenant's polling.
+            logger.exception("get_updates failed for tenant %s", tenant_id)
+            await asyncio.sleep(POLL_RETRY_DELAY)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            yield tenant_id, update
+
+
+async def merge_updates(
+    sources: Iterable[Callable[[], AsyncIterator[tuple[str, Update]]]],
+) -> AsyncIterator[tuple[str, Update]]:
+    # Each tenant's bot long-polls on its own; the supervisor consumes one combined stream.
+    # A source is a factory, so a stream that dies is logged and started again.
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(source: Callable[[], AsyncIterator[tuple[str, Update]]]) -> None:
+        while True:
+            try:
+                async for item in source():
+                    await queue.put(item)
+            except Exception:
+                logger.exception("Update stream failed, restarting")
+            await asyncio.sleep(POLL_RETRY_DELAY)
+
+    tasks = [asyncio.create_task(pump(source)) for source in sources]
+    try:
+        while True:
+            yield await queue.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run_supervisor(
+    workers: int,
+    tenants: list[Tenant] | None = None,
+    updates: AsyncIterator[tuple[str, Update]] | None = None,
+) -> None:
+    # Polls (or replays) updates in this process and hands each one to a worker process
+    # chosen by tenant and chat id; every worker runs its own dispatcher (serving all tenants)
+    # and processes each chat in order.
+    tenants = load_tenants() if tenants is None else tenants
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(workers)]
+    # Every worker reports its loop lag here; liveness and the systemd watchdog include it.
+    heartbeats = ctx.Queue()
+    health.workers.listen(heartbeats, workers)
+    processes = [
+        ctx.Process(
+            target=_worker_process, args=(index, queues[index], heartbeats, tenants), name=f"bot-worker-{index}"
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info("Started %s bot workers", workers)
+
+    bots = {tenant.id: Bot(token=tenant.token) for tenant in tenants}
+    scheduler_tasks = []
+    if updates is None:
+        from app.bot import build_dispatcher
+
+        allowed_updates = build_dispatcher(tenants).resolve_used_update_types()
+        for bot in bots.values():
+            health.instrument_bot(bot)
+        updates = merge_updates(
+            functools.partial(poll_updates, tenant_id, bot, allowed_updates) for tenant_id, bot in bots.items()
+        )
+        scheduler_tasks = [asyncio.create_task(run_digest_scheduler(bot, tenant_id)) for tenant_id, bot in bots.items()]
+        scheduler_tasks.append(asyncio.create_task(health.run_health()))
+        if LESSON_AUTO_CLOSE_TIME:
+            # The schedule runs here, but each close runs in the worker that owns the chat, in
+            # order with the chat's updates and against that worker's caches.
+            async def route_auto_close(bot: Bot, tenant_id: str) -> int:
+                lessons = await get_open_lessons(tenant_id)
+                for group_id, lesson_id, chat_id in lessons:
+                    queues[hash((tenant_id, chat_id)) % workers].put(
+                        (tenant_id, chat_id, CloseLesson(group_id, lesson_id))
+                    )
+                logger.info("Auto-close (%s): %s open lessons sent to workers", tenant_id, len(lessons))
+                return len(lessons)
+
+            scheduler_tasks += [
+                asyncio.create_task(run_auto_close_scheduler(bot, tenant_id, route_auto_close))
+                for tenant_id, bot in bots.items()
+            ]
+
+    # SIGTERM (systemd stop) ends the loop below; the workers then finish what they were
+    # given and exit on the stop sentinel instead of being killed mid-update.
+    loop = asyncio.get_running_loop()
+    consumer = asyncio.current_task()
+    stopping = False
+
+    def stop() -> None:
+        nonlocal stopping
+        stopping = True
+        consumer.cancel()
+
+    loop.add_signal_handler(signal.SIGTERM, stop)
+    # tenant_id -> {user_id: chat_id}; chat and user ids only mean something within one bot.
+    inline_affinity: dict[str, dict[int, int]] = {}
+    try:
+        async for tenant_id, update in updates:
+            affinity = inline_affinity.setdefault(tenant_id, {})
+            track_inline_affinity(update, affinity)
+            key = shard_key(update, affinity)
+            queues[hash((tenant_id, key)) % workers].put(
+                (tenant_id, key, update.model_dump_json(exclude_none=True, by_alias=True))
+            )
+    except asyncio.CancelledError:
+        if not stopping:
+            raise
+        consumer.uncancel()
+        logger.info("SIGTERM received, stopping %s bot workers", workers)
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        for task in scheduler_tasks:
+            task.cancel()
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        heartbeats.put(None)
+        for bot in bots.values():
+            await bot.session.close()
+
+
+def _worker_process(index: int, queue, heartbeats, tenants: list[Tenant]) -> None:
+    # systemd and Ctrl-C signal the whole process group; the supervisor decides when a worker
+    # stops, by sending it the None sentinel once its queue is drained.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s worker-{index} %(name)s %(levelname)s %(message)s")
+    asyncio.run(_worker_main(index, queue, heartbeats, tenants))
+
+
+async def _worker_main(index: int, queue, heartbeats, tenants: list[Tenant]) -> None:
+    from app.bot import build_dispatcher, format_timings, log_first_update, timed
+
+    started = time.perf_counter()
+    bots = {tenant.id: tracing.instrument_bot(Bot(token=tenant.token)) for tenant in tenants}
+    dp = build_dispatcher(tenants)
+    dp.update.outer_middleware(log_first_update(started))
+    # Heartbeats start before the warm-up, which can take longer than the staleness limit.
+    health_task = asyncio.create_task(
+        health.run_health(serve=False, on_tick=lambda: heartbeats.put((index, health.monitor.last_lag_ms)))
+    )
+    timings: dict[str, float] = {}
+    with timed(timings, "warm-up"):
+        # Without admin lists: which chats land on this worker is only known to the supervisor.
+        warmed = await warm_caches()
+    logger.info("Worker %s startup: %s; warmed %s", index, format_timings(timings), warmed)
+    loop = asyncio.get_running_loop()
+    chat_queues: dict[tuple[str, int], asyncio.Queue] = {}
+    tasks: set[asyncio.Task] = set()
+
+    async def process_chat(key: tuple[str, int], chat_queue: asyncio.Queue) -> None:
+        bot = bots[key[0]]
+        # One task per busy chat: its updates run strictly in arrival order, other chats
+        # keep running concurrently. The task exits once the chat's backlog is empty.
+        while True:
+            try:
+                raw = chat_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                chat_queues.pop(key, None)
+                return
+            if isinstance(raw, CloseLesson):
+                await auto_close_lesson(bot, raw.group_id, raw.lesson_id)
+                continue
+            update = Update.model_validate_json(raw, context={"bot": bot})
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                logger.exception("Update %s failed", update.update_id)
+
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            tenant_id, chat_key, raw = item
+            key = (tenant_id, chat_key)
+            chat_queue = chat_queues.get(key)
+            if chat_queue is None:
+                chat_queue = chat_queues[key] = asyncio.Queue()
+                task = asyncio.create_task(process_chat(key, chat_queue))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            chat_queue.put_nowait(raw)
+        if tasks:
+            await asyncio.gather(*tasks)
+        await background.drain()
+    finally:
+        health_task.cancel()
+        for bot in bots.values():
+            await bot.session.close()
+        logger.info("Worker %s stopped", index)
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import json
+from typing import NamedTuple
+
+from app.config import ADMIN_TG_USER_IDS, BOT_TOKEN, TENANTS_FILE
+from app.models import DEFAULT_TENANT_ID
+
+
+class Tenant(NamedTuple):
+    id: str
+    token: str
+    admin_ids: frozenset[int]
+
+    @property
+    def bot_id(self) -> int:
+        return int(self.token.split(":", 1)[0])
+
+    def is_admin(self, user_id: int | None) -> bool:
+        return user_id in self.admin_ids
+
+
+def load_tenants() -> list[Tenant]:
+    # Without TENANTS_FILE the process serves one school with BOT_TOKEN, as before.
+    if not TENANTS_FILE:
+        return [Tenant(DEFAULT_TENANT_ID, BOT_TOKEN, ADMIN_TG_USER_IDS)] if BOT_TOKEN else []
+    with open(TENANTS_FILE, encoding="utf-8") as file:
+        items = json.load(file)
+    tenants = [
+        Tenant(str(item["id"]), item["token"], frozenset(int(user_id) for user_id in item.get("admins", [])))
+        for item in items
+    ]
+    if len({tenant.id for tenant in tenants}) != len(tenants):
+        raise ValueError(f"Duplicate tenant ids in {TENANTS_FILE}")
+    return tenants
@@ -1,18 +1,162 @@
+import re
+
 from app.models import LessonGradeStatus
 
+CYR_TO_LAT = {
+    "а": "a",
+    "б": "b",
+    "в": "v",
+    "г": "g",
+    "ғ": "g",
+    "д": "d",
+    "е": "e",
+    "ё": "yo",
+    "ж": "j",
+    "з": "z",
+    "и": "i",
+    "й": "y",
+    "к": "k",
+    "қ": "q",
+    "л": "l",
+    "м": "m",
+    "н": "n",
+    "о": "o",
+    "п": "p",
+    "р": "r",
+    "с": "s",
+    "т": "t",
+    "у": "u",
+    "ф": "f",
+    "х": "x",
+    "ҳ": "h",
+    "ц": "s",
+    "ч": "ch",
+    "ш": "sh",
+    "щ": "sh",
+    "ъ": "",
+    "ь": "",
+    "э": "e",
+    "ю": "yu",
+    "я": "ya",
+    "ў": "o",
+    "ы": "i",
+}
+
+# Uzbek apostrophe variants ("o'", "g'", "oʻ" ...) carry no meaning for matching.
+APOSTROPHES = ("'", "’", "`", "ʻ", "ʼ")
+
+# Compiled once: Cyrillic -> Latin (multi-character outputs allowed) and apostrophes dropped.
+NAME_TRANSLATION = str.maketrans({**CYR_TO_LAT, **{ch: "" for ch in APOSTROPHES}})
+NON_LATIN_RE = re.compile(r"[^a-z]+")
+
+
+def normalize_name(value: str) -> str:
+    return NON_LATIN_RE.sub("", value.strip().lower().translate(NAME_TRANSLATION))
+
+
+# Stored in Student.normalized_name; tokens are kept so prefix search works per word.
+def normalize_full_name(value: str) -> str:
+    tokens = (normalize_name(token) for token in value.split())
+    return " ".join(token for token in tokens if token)
+
+
+STATUS_TEXT = {
+    LessonGradeStatus.DONE: "Bajarildi",
+    LessonGradeStatus.NOT_DONE: "Bajarmadi",
+    LessonGradeStatus.ABSENT: "Darsga kelmadi",
+    LessonGradeStatus.PENDING: "Baholanmagan",
+}
+
 
 def format_grade_message(group_title: str, student_name: str, lesson_date: str, status: LessonGradeStatus, score: int | None) -> str:
-    status_map = {
-        LessonGradeStatus.DONE: "Bajarildi",
-        LessonGradeStatus.NOT_DONE: "Bajarmadi",
-        LessonGradeStatus.ABSENT: "Darsga kelmadi",
-        LessonGradeStatus.PENDING: "Baholanmagan",
-    }
     score_text = str(score) if score is not None else "—"
     return (
         f"Guruh: {group_title}\n"
         f"O‘quvchi: {student_name}\n"
         f"Sana: {lesson_date}\n"
-        f"Holat: {status_map.get(status, status)}\n"
+        f"Holat: {STATUS_TEXT.get(status, status)}\n"
         f"Ball: {score_text}"
     )
+
+
+def format_lesson_summary(
+    group_title: str,
+    lesson_date: str,
+    summary: dict[LessonGradeStatus, tuple[int, int]],
+    converted: int,
+    close_status: LessonGradeStatus,
+) -> str:
+    # summary: status -> (grade count, score sum), as returned by crud.get_lesson_summary.
+    done_count, done_score = summary.get(LessonGradeStatus.DONE, (0, 0))
+    average = f"{done_score / done_count:.2f}" if done_count else "—"
+    lines = [
+        f"Dars yopildi: {group_title}, {lesson_date}",
+        "",
+        f"{STATUS_TEXT[LessonGradeStatus.DONE]}: {done_count} (o'rtacha ball: {average})",
+        f"{STATUS_TEXT[LessonGradeStatus.NOT_DONE]}: {summary.get(LessonGradeStatus.NOT_DONE, (0, 0))[0]}",
+        f"{STATUS_TEXT[LessonGradeStatus.ABSENT]}: {summary.get(LessonGradeStatus.ABSENT, (0, 0))[0]}",
+    ]
+    if converted:
+        lines.append(f"Baholanmagan {converted} o‘quvchi: {STATUS_TEXT[close_status]}")
+    return "\n".join(lines)
+
+
+def format_digest_message(day: str, rows: list[tuple[str, str | None, str, LessonGradeStatus, int | None]]) -> str:
+    # rows: (student_name, group_title, lesson_date, status, score), already sorted by student.
+    lines = [f"Kunlik hisobot: {day}"]
+    current_student = None
+    for student_name, group_title, lesson_date, status, score in rows:
+        if student_name != current_student:
+            current_student = student_name
+            lines.append("")
+            lines.append(f"O‘quvchi: {student_name}")
+        score_text = f", ball: {score}" if score is not None else ""
+        lines.append(f"- {lesson_date} | {group_title or 'Guruh'} | {STATUS_TEXT.get(status, status)}{score_text}")
+    return "\n".join(lines)
+
+
+def format_grade_history(student_name: str, summary, rows) -> str:
+    # summary: cache.GradeSummary; rows: (lesson_date, lesson_id, group_title, status, score), newest first.
+    average = f"{summary.average:.2f}" if summary.average is not None else "—"
+    lines = [
+        f"Baholar tarixi: {student_name}",
+        f"Darslar: {summary.lesson_count} | Jami ball: {summary.total_score} | O'rtacha: {average}",
+        f"Bajarildi: {summary.done_count} | Bajarmadi: {summary.not_done_count} | Kelmadi: {summary.absent_count}",
+        "",
+    ]
+    if not rows:
+        lines.append("Hozircha baholar yo'q.")
+    for lesson_date, _, group_title, status, score in rows:
+        score_text = f", ball: {score}" if score is not None else ""
+        lines.append(f"- {lesson_date} | {group_title or 'Guruh'} | {STATUS_TEXT.get(status, status)}{score_text}")
+    return "\n".join(lines)
+
+
+def format_term_summaries(student_name: str, summaries) -> str:
+    lines = [f"Yopilgan choraklar: {student_name}"]
+    for summary in summaries:
+        lines.append(
+            f"- {summary.term}: {summary.lesson_count} dars, "
+            f"bajarildi {summary.done_count}, bajarmadi {summary.not_done_count}, "
+            f"kelmadi {summary.absent_count}, jami ball {summary.total_score}"
+        )
+    return "\n".join(lines)
+
+
+def split_text(text: str, chunk_size: int = 3500) -> list[str]:
+    # Splits on line boundaries so every chunk fits in one Telegram message.
+    chunks = []
+    current = []
+    current_len = 0
+    for line in text.splitlines():
+        line_len = len(line) + 1
+        if current_len + line_len > chunk_size and current:
+            chunks.append("\n".join(current))
+            current = [line]
+            current_len = line_len
+        else:
+            current.append(line)
+            current_len += line_len
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
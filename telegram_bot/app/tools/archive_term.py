@@ -0,0 +1,43 @@
+import argparse
+import asyncio
+import logging
+from datetime import date, datetime
+
+from app import crud
+from app.config import LOCAL_TZ
+from app.db import async_session, init_db, vacuum_analyze
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Close a term: fold its lessons into term summaries.")
+    parser.add_argument("term", help='Term name shown to parents, e.g. "2025-2026 1-chorak"')
+    parser.add_argument("until", type=date.fromisoformat, help="First day of the next term (YYYY-MM-DD)")
+    parser.add_argument("--batch-size", type=int, default=crud.ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--no-vacuum", action="store_true", help="Skip VACUUM/ANALYZE")
+    return parser.parse_args()
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.until > datetime.now(LOCAL_TZ).date():
+        raise SystemExit("until must not be in the future")
+    await init_db()
+    async with async_session() as session:
+        counts = await crud.archive_term(session, args.term, args.until, args.batch_size)
+    logging.info(
+        "Archived %s: %s summaries, deleted %s rollups, %s notifications, %s grades, %s lessons",
+        args.term,
+        counts["summaries"],
+        counts["rollups"],
+        counts["notifications"],
+        counts["grades"],
+        counts["lessons"],
+    )
+    if not args.no_vacuum:
+        await vacuum_analyze()
+        logging.info("VACUUM/ANALYZE done")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
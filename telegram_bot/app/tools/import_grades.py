@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import csv
+import logging
+import time
+from collections import Counter
+from datetime import date, datetime
+
+from app import crud, projections
+from app.bot import prepare_database
+from app.config import LOCAL_TZ
+from app.db import async_session
+from app.models import DEFAULT_TENANT_ID, LessonGradeStatus
+
+COLUMNS = ("group", "student_code", "date", "status", "score")
+IMPORTED_STATUSES = {status.value: status for status in LessonGradeStatus if status != LessonGradeStatus.PENDING}
+SCORES = range(1, 6)
+# Rejected rows logged with their line number; the rest are only counted.
+MAX_LOGGED_ERRORS = 20
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Load past lessons and grades from a CSV (stop the bot first; parents are not notified)."
+    )
+    parser.add_argument("csv_file", help=f"CSV with a header: {','.join(COLUMNS)}; group is the group's chat id")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT_ID, help="Tenant the groups belong to")
+    parser.add_argument("--batch-size", type=int, default=crud.IMPORT_BATCH_SIZE)
+    return parser.parse_args()
+
+
+class RowError(ValueError):
+    pass
+
+
+def parse_row(row: dict, groups: dict[int, int], students: dict[str, tuple[int, int]], today: date):
+    try:
+        group_id = groups[int(row["group"])]
+    except (KeyError, TypeError, ValueError):
+        # csv.DictReader fills the fields missing from a short row with None.
+        raise RowError("unknown group")
+    student = students.get((row["student_code"] or "").strip().lstrip("#").upper())
+    if student is None:
+        raise RowError("unknown student code")
+    student_id, student_group_id = student
+    if student_group_id != group_id:
+        raise RowError("student is in another group")
+    try:
+        lesson_date = date.fromisoformat((row["date"] or "").strip())
+    except ValueError:
+        raise RowError("bad date")
+    if lesson_date >= today:
+        raise RowError("date is not in the past")
+    status = IMPORTED_STATUSES.get((row["status"] or "").strip().upper())
+    if status is None:
+        raise RowError("bad status")
+    score = None
+    if status == LessonGradeStatus.DONE:
+        try:
+            score = int(row["score"])
+        except (TypeError, ValueError):
+            raise RowError("DONE without a score")
+        if score not in SCORES:
+            raise RowError("score out of range")
+    return (group_id, lesson_date, student_id), (status, score)
+
+
+async def import_batch(session, batch: dict, lesson_ids: dict) -> int:
+    # The batch's own events reach the counters in its transaction: catch-up can't be relied on, since
+    # a grade saved meanwhile moves the checkpoints past them.
+    events = await crud.import_grade_batch(session, batch, lesson_ids)
+    await projections.apply_live(session, events)
+    await session.commit()
+    session.expunge_all()
+    return len(events)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    # The same schema migration and backfills as a bot start: an import into a database the bot never
+    # opened since the ledger appeared would otherwise be the ledger's first events, and the backfill
+    # would then skip every grade already there.
+    await prepare_database()
+    today = datetime.now(LOCAL_TZ).date()
+    started = time.perf_counter()
+    read = imported = changed = 0
+    errors: Counter[str] = Counter()
+
+    async with async_session() as session:
+        # Anything the counters are still missing goes first: the checkpoints then move past each batch.
+        for name in projections.PROJECTIONS:
+            await projections.catch_up(session, name)
+        groups = await crud.get_group_ids_by_chat(session, args.tenant)
+        students = await crud.get_students_by_code(session, groups.values())
+        lesson_ids = await crud.get_lesson_ids_for_groups(session, groups.values())
+        logging.info("Loaded %s groups, %s students, %s lessons", len(groups), len(students), len(lesson_ids))
+
+        with open(args.csv_file, newline="", encoding="utf-8-sig") as file:
+            reader = csv.DictReader(file)
+            missing = set(COLUMNS) - set(reader.fieldnames or ())
+            if missing:
+                raise SystemExit(f"CSV is missing columns: {', '.join(sorted(missing))}")
+            batch: dict = {}
+            for row in reader:
+                read += 1
+                try:
+                    key, grade = parse_row(row, groups, students, today)
+                except RowError as exc:
+                    errors[str(exc)] += 1
+                    if sum(errors.values()) <= MAX_LOGGED_ERRORS:
+                        logging.warning("Line %s skipped: %s", reader.line_num, exc)
+                    continue
+                # A later row for the same lesson and student wins.
+                batch[key] = grade
+                if len(batch) >= args.batch_size:
+                    changed += await import_batch(session, batch, lesson_ids)
+                    imported += len(batch)
+                    batch = {}
+                    elapsed = time.perf_counter() - started
+                    logging.info("%s rows imported (%.0f rows/s)", imported, imported / elapsed)
+            if batch:
+                changed += await import_batch(session, batch, lesson_ids)
+                imported += len(batch)
+
+    elapsed = time.perf_counter() - started
+    logging.info(
+        "Read %s rows, imported %s (%s changed grades), skipped %s in %.1f s: %.0f rows/s",
+        read,
+        imported,
+        changed,
+        sum(errors.values()),
+        elapsed,
+        read / elapsed if elapsed else 0,
+    )
+    for reason, count in errors.most_common():
+        logging.info("  skipped %s: %s", reason, count)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
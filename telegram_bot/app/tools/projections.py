@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import logging
+
+from app import projections
+from app import crud
+from app.db import async_session, init_db, read_session
+from app.text import STATUS_TEXT
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay the grade event ledger into its projections.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in (
+        ("rebuild", "Empty the projections and replay the whole ledger (stop the bot first)"),
+        ("catch-up", "Apply only the events after each projection's checkpoint"),
+    ):
+        sub = commands.add_parser(command, help=help_text)
+        sub.add_argument("names", nargs="*", help=f"Projections (default: all of {', '.join(projections.PROJECTIONS)})")
+        sub.add_argument("--batch-size", type=int, default=projections.EVENT_BATCH_SIZE)
+    history = commands.add_parser("history", help="Show who changed a student's grades")
+    history.add_argument("student_id", type=int)
+    history.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+    unknown = set(getattr(args, "names", [])) - set(projections.PROJECTIONS)
+    if unknown:
+        parser.error(f"unknown projections: {', '.join(sorted(unknown))}")
+    return args
+
+
+def _grade_text(status, score) -> str:
+    if status is None:
+        return "—"
+    text = STATUS_TEXT.get(status, str(status))
+    return f"{text} ({score})" if score is not None else text
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    await init_db()
+    if args.command == "history":
+        async with read_session() as session:
+            events = await crud.get_grade_events_for_student(session, args.student_id, args.limit)
+        for event in events:
+            print(
+                f"{event.created_at:%Y-%m-%d %H:%M:%S}  dars {event.lesson_date}  "
+                f"{_grade_text(event.old_status, event.old_score)} -> {_grade_text(event.new_status, event.new_score)}  "
+                f"admin {event.actor_tg_user_id or '—'}"
+            )
+        return
+
+    async with async_session() as session:
+        run = projections.rebuild if args.command == "rebuild" else projections.catch_up
+        for name in args.names or list(projections.PROJECTIONS):
+            applied = await run(session, name, args.batch_size)
+            logging.info("%s: %s %s events", name, args.command, applied)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
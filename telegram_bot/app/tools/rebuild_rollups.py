@@ -0,0 +1,17 @@
+import asyncio
+import logging
+
+from app import crud
+from app.db import async_session, init_db
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    await init_db()
+    async with async_session() as session:
+        rows = await crud.rebuild_daily_stats(session)
+    logging.info("Rebuilt %s daily rollup rows", rows)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
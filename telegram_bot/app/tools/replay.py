@@ -0,0 +1,42 @@
+import argparse
+import asyncio
+import logging
+
+from aiogram.types import Update
+
+from app.bot import prepare_database
+from app.config import WORKERS
+from app.sharding import run_supervisor
+from app.tenants import load_tenants
+
+
+async def read_updates(path: str, tenant_id: str):
+    # One Telegram Update object (as returned by getUpdates) per line, all from one tenant's bot.
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield tenant_id, Update.model_validate_json(line)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates through the sharded worker pool")
+    parser.add_argument("path", help="JSONL file with one Telegram update per line")
+    parser.add_argument("--workers", type=int, default=max(WORKERS, 2))
+    parser.add_argument("--tenant", help="tenant id the updates were recorded for (default: the first tenant)")
+    args = parser.parse_args()
+
+    tenants = load_tenants()
+    if not tenants:
+        parser.error("BOT_TOKEN or TENANTS_FILE is not configured")
+    tenant_id = args.tenant or tenants[0].id
+    if tenant_id not in {tenant.id for tenant in tenants}:
+        parser.error(f"unknown tenant: {tenant_id}")
+
+    logging.basicConfig(level=logging.INFO)
+    await prepare_database()
+    await run_supervisor(args.workers, tenants, updates=read_updates(args.path, tenant_id))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
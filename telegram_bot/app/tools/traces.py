@@ -0,0 +1,101 @@
+import argparse
+import glob
+import json
+import sys
+
+from app.config import TRACE_FILE
+
+# Width of the waterfall bar column.
+BAR_WIDTH = 40
+NAME_WIDTH = 60
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Print the slowest recorded update traces as waterfalls.")
+    parser.add_argument("--file", default=TRACE_FILE, help="Trace file (default: TRACE_FILE); rotated copies are read too")
+    parser.add_argument("--top", type=int, default=5, help="How many traces to show")
+    parser.add_argument("--min-ms", type=float, default=0, help="Skip traces faster than this")
+    parser.add_argument("--name", help="Only traces of this update type, e.g. callback_query")
+    parser.add_argument("--trace-id", help="Show one trace by id")
+    args = parser.parse_args()
+    if not args.file:
+        parser.error("TRACE_FILE is not set; pass --file")
+    return args
+
+
+def read_traces(path: str):
+    for file_path in sorted(glob.glob(glob.escape(path) + "*")):
+        with open(file_path, encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a file being written can be incomplete.
+                    continue
+
+
+def _ordered_spans(spans: list[dict]) -> list[tuple[int, dict]]:
+    children: dict[int | None, list[dict]] = {}
+    for span in spans:
+        children.setdefault(span["parent"], []).append(span)
+    ordered = []
+
+    def walk(parent_id, depth):
+        for span in sorted(children.get(parent_id, []), key=lambda item: (item["start_ms"], item["id"])):
+            ordered.append((depth, span))
+            walk(span["id"], depth + 1)
+
+    walk(None, 0)
+    return ordered
+
+
+def _bar(start_ms: float, duration_ms: float, total_ms: float) -> str:
+    if total_ms <= 0:
+        return " " * BAR_WIDTH
+    begin = min(BAR_WIDTH - 1, int(start_ms / total_ms * BAR_WIDTH))
+    length = max(1, round(duration_ms / total_ms * BAR_WIDTH))
+    length = min(length, BAR_WIDTH - begin)
+    return " " * begin + "█" * length + " " * (BAR_WIDTH - begin - length)
+
+
+def print_waterfall(trace: dict) -> None:
+    total = trace["duration_ms"]
+    attrs = " ".join(f"{key}={value}" for key, value in trace.get("attrs", {}).items() if value is not None)
+    error = f"  ERROR {trace['error']}" if trace.get("error") else ""
+    print(f"trace {trace['trace_id']}  {trace['name']}  {total:.1f} ms  {trace['started_at']}  {attrs}{error}")
+    for depth, span in _ordered_spans(trace["spans"]):
+        label = "  " * depth + span["name"]
+        sql = span.get("attrs", {}).get("sql")
+        if sql:
+            label += f"  {sql}"
+        if span.get("attrs", {}).get("error"):
+            label += f"  !{span['attrs']['error']}"
+        print(
+            f"  {span['start_ms']:9.1f} {span['duration_ms']:9.1f}  |{_bar(span['start_ms'], span['duration_ms'], total)}|  "
+            f"{label[:NAME_WIDTH]}"
+        )
+    print()
+
+
+def main():
+    args = parse_args()
+    traces = [
+        trace
+        for trace in read_traces(args.file)
+        if trace["duration_ms"] >= args.min_ms
+        and (args.name is None or trace["name"] == args.name)
+        and (args.trace_id is None or trace["trace_id"] == args.trace_id)
+    ]
+    if not traces:
+        print("No traces found.", file=sys.stderr)
+        return
+    traces.sort(key=lambda trace: trace["duration_ms"], reverse=True)
+    for trace in traces[: args.top]:
+        print_waterfall(trace)
+
+
+if __name__ == "__main__":
+    main()
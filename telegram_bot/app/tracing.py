@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import functools
+import inspect
+import json
+import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from types import ModuleType
+from typing import Any, Awaitable, Callable, Iterator
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+from sqlalchemy import event
+
+from app.config import TRACE_BACKUP_COUNT, TRACE_FILE, TRACE_MAX_BYTES, TRACE_SAMPLE_RATE, TRACE_SLOW_MS
+
+logger = logging.getLogger(__name__)
+# One JSON object per kept trace; a separate logger so traces never reach the console.
+_exporter = logging.getLogger("app.tracing.export")
+_exporter.propagate = False
+
+# Longest SQL text stored on a span.
+SQL_TEXT_LIMIT = 300
+
+
+class Trace:
+    def __init__(self, name: str, attrs: dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.spans: list[dict[str, Any]] = []
+        self.closed = False
+        self._next_id = 0
+
+    def next_span_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def add(self, span_id: int, parent_id: int | None, name: str, start: float, end: float, attrs: dict) -> None:
+        if self.closed:
+            # Background work (parent DMs after a grade) can outlive the update's trace.
+            return
+        self.spans.append(
+            {
+                "id": span_id,
+                "parent": parent_id,
+                "name": name,
+                "start_ms": round((start - self.start) * 1000, 2),
+                "duration_ms": round((end - start) * 1000, 2),
+                **({"attrs": attrs} if attrs else {}),
+            }
+        )
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_span: ContextVar[int | None] = ContextVar("trace_span", default=None)
+_installed = False
+
+
+def enabled() -> bool:
+    return bool(TRACE_FILE)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[None]:
+    trace = _trace.get()
+    if trace is None or trace.closed:
+        yield
+        return
+    span_id = trace.next_span_id()
+    parent_id = _span.get()
+    token = _span.set(span_id)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as exc:
+        attrs["error"] = type(exc).__name__
+        raise
+    finally:
+        _span.reset(token)
+        trace.add(span_id, parent_id, name, start, time.perf_counter(), attrs)
+
+
+def _export(trace: Trace, duration_ms: float, error: str | None) -> None:
+    record = {
+        "trace_id": trace.id,
+        "name": trace.name,
+        "started_at": trace.started_at.isoformat(),
+        "duration_ms": round(duration_ms, 2),
+        "attrs": trace.attrs,
+        "spans": trace.spans,
+    }
+    if error:
+        record["error"] = error
+    _exporter.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+class TraceMiddleware(BaseMiddleware):
+    # Outermost dp.update middleware: the root span covers scheduling, the DB session and
+    # the handler. Every trace slower than TRACE_SLOW_MS or failing is kept, the rest are sampled.
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        trace = Trace(
+            event.event_type,
+            {
+                "update_id": event.update_id,
+                "bot_id": data["bot"].id,
+                "chat_id": chat.id if chat else None,
+                "user_id": user.id if user else None,
+            },
+        )
+        trace_token = _trace.set(trace)
+        span_token = _span.set(None)
+        error = None
+        try:
+            return await handler(event, data)
+        except BaseException as exc:
+            error = type(exc).__name__
+            raise
+        finally:
+            duration_ms = (time.perf_counter() - trace.start) * 1000
+            trace.closed = True
+            _span.reset(span_token)
+            _trace.reset(trace_token)
+            if error or duration_ms >= TRACE_SLOW_MS or random.random() < TRACE_SAMPLE_RATE:
+                _export(trace, duration_ms, error)
+
+
+class HandlerSpanMiddleware(BaseMiddleware):
+    # Inner middleware on the dispatcher's observers, so it wraps the handler that matched
+    # in any included router.
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__qualname__", "handler")
+        with span(f"handler {name}"):
+            return await handler(event, data)
+
+
+class BotApiSpanMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot: Bot, method):
+        with span(f"bot {type(method).__name__}"):
+            return await make_request(bot, method)
+
+
+def _traced(name: str, function: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    @functools.wraps(function)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with span(name):
+            return await function(*args, **kwargs)
+
+    wrapper.__traced__ = True
+    return wrapper
+
+
+def instrument_module(module: ModuleType, prefix: str) -> None:
+    # Callers look functions up on the module (crud.update_grade), and so do calls inside
+    # it, so replacing the attributes is enough.
+    for name, function in list(vars(module).items()):
+        if (
+            not name.startswith("_")
+            and inspect.iscoroutinefunction(function)
+            and function.__module__ == module.__name__
+            and not getattr(function, "__traced__", False)
+        ):
+            setattr(module, name, _traced(f"{prefix}.{name}", function))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    if context is not None:
+        context._trace_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    trace = _trace.get()
+    start = getattr(context, "_trace_start", None)
+    if trace is None or start is None:
+        return
+    attrs: dict[str, Any] = {"sql": " ".join(statement.split())[:SQL_TEXT_LIMIT]}
+    if executemany:
+        attrs["rows"] = len(parameters)
+    # Runs in SQLAlchemy's greenlet, which shares the update's context but must not set it.
+    trace.add(trace.next_span_id(), _span.get(), "sql", start, time.perf_counter(), attrs)
+
+
+def install(dp: Dispatcher) -> None:
+    # No-op unless TRACE_FILE is set; module and engine hooks are installed once per process.
+    global _installed
+    if not enabled():
+        return
+    if not _installed:
+        from app import crud
+        from app.db import engine
+
+        handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _exporter.addHandler(handler)
+        _exporter.setLevel(logging.INFO)
+        instrument_module(crud, "crud")
+        event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+        _installed = True
+        logger.info(
+            "Tracing to %s (sample rate %s, always kept above %s ms)", TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW_MS
+        )
+
+    dp.update.outer_middleware(TraceMiddleware())
+    for name, observer in dp.observers.items():
+        if name not in {"update", "error"}:
+            observer.middleware(HandlerSpanMiddleware())
+
+
+def instrument_bot(bot: Bot) -> Bot:
+    if enabled():
+        bot.session.middleware(BotApiSpanMiddleware())
+    return bot
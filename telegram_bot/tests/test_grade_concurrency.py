@@ -0,0 +1,154 @@
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# The engine is created from DATABASE_URL when app.db is imported.
+_db_dir = tempfile.mkdtemp(prefix="grade-concurrency-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_dir}/bot.db"
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import EditMessageText, GetChatMember, SendMessage, TelegramMethod  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, ChatMemberOwner, Message, Update, User  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+
+from app import background, crud  # noqa: E402
+from app.bot import build_dispatcher, prepare_database  # noqa: E402
+from app.db import async_session, engine  # noqa: E402
+from app.models import LessonGrade, LessonGradeStatus, Lesson, StudentDailyStats, StudentStats  # noqa: E402
+from app.tenants import Tenant  # noqa: E402
+
+TOKEN = "42:TEST"
+TEACHER_ID = 7
+CALLS = 200
+GROUPS = 4
+STUDENTS = 5
+# Score buttons set DONE directly; the other statuses are saved from the status buttons.
+TAPS = [f"grade_score:{{}}:{score}" for score in range(1, 6)] + [
+    f"grade_status:{{}}:{LessonGradeStatus.NOT_DONE.value}",
+    f"grade_status:{{}}:{LessonGradeStatus.ABSENT.value}",
+]
+
+_ids = itertools.count(1000)
+
+
+class MockSession(BaseSession):
+    # Answers every Bot API call locally; the teacher is the owner of every group.
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        await asyncio.sleep(0)
+        if isinstance(method, GetChatMember):
+            return ChatMemberOwner(user=User(id=method.user_id, is_bot=False, first_name="T"), is_anonymous=False)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            chat = Chat(id=method.chat_id or 0, type="supergroup")
+            return Message(message_id=next(_ids), date=datetime.now(), chat=chat, text=method.text)
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+def _tap(chat_id: int, data: str) -> Update:
+    # Every tap is on its own message, so the double-tap filter lets all of them through.
+    message = Message(
+        message_id=next(_ids), date=datetime.now(), chat=Chat(id=chat_id, type="supergroup", title="Stress"), text="x"
+    )
+    callback = CallbackQuery(
+        id=str(next(_ids)),
+        from_user=User(id=TEACHER_ID, is_bot=False, first_name="T"),
+        chat_instance="stress",
+        message=message,
+        data=data,
+    )
+    return Update(update_id=next(_ids), callback_query=callback)
+
+
+async def _setup() -> list[tuple[int, int]]:
+    # (group chat id, student id) pairs.
+    await prepare_database()
+    pairs = []
+    async with async_session() as session:
+        for group_index in range(GROUPS):
+            chat_id = -100 - group_index
+            group = await crud.resolve_group(session, chat_id, "Stress", "default")
+            for index in range(STUDENTS):
+                student = await crud.create_or_update_student(session, group.id, None, None, f"Student {index}")
+                pairs.append((chat_id, student.id))
+    return pairs
+
+
+async def _recount() -> tuple[dict, dict]:
+    async with async_session() as session:
+        rows = (
+            await session.execute(
+                select(LessonGrade.student_id, Lesson.lesson_date, LessonGrade.status, LessonGrade.score).join(
+                    Lesson, Lesson.id == LessonGrade.lesson_id
+                )
+            )
+        ).all()
+    not_done: Counter = Counter()
+    daily: dict = defaultdict(lambda: [0, 0, 0, 0])
+    for student_id, day, status, score in rows:
+        if status == LessonGradeStatus.NOT_DONE:
+            not_done[student_id] += 1
+        totals = daily[(student_id, day)]
+        if status == LessonGradeStatus.DONE:
+            totals[0] += score
+            totals[1] += 1
+        elif status == LessonGradeStatus.NOT_DONE:
+            totals[2] += 1
+        elif status == LessonGradeStatus.ABSENT:
+            totals[3] += 1
+    return dict(not_done), {key: tuple(totals) for key, totals in daily.items() if any(totals)}
+
+
+async def _stored() -> tuple[dict, dict]:
+    async with async_session() as session:
+        stats = (await session.execute(select(StudentStats.student_id, StudentStats.not_done_count))).all()
+        daily = (
+            await session.execute(
+                select(
+                    StudentDailyStats.student_id,
+                    StudentDailyStats.day,
+                    StudentDailyStats.total_score,
+                    StudentDailyStats.done_count,
+                    StudentDailyStats.not_done_count,
+                    StudentDailyStats.absent_count,
+                )
+            )
+        ).all()
+    return (
+        {student_id: count for student_id, count in stats if count},
+        {(row[0], row[1]): tuple(row[2:]) for row in daily if any(row[2:])},
+    )
+
+
+async def _run() -> None:
+    pairs = await _setup()
+    bot = Bot(token=TOKEN, session=MockSession())
+    dp = build_dispatcher([Tenant("default", TOKEN, frozenset())])
+    rng = random.Random(2026)
+    taps = []
+    for _ in range(CALLS):
+        chat_id, student_id = rng.choice(pairs)
+        taps.append(_tap(chat_id, rng.choice(TAPS).format(student_id)))
+    results = await asyncio.gather(*(dp.feed_update(bot, update) for update in taps), return_exceptions=True)
+    try:
+        await background.drain()
+        errors = [result for result in results if isinstance(result, BaseException)]
+        assert not errors, errors[:3]
+        stored, recount = await _stored(), await _recount()
+        assert recount[1], "no grade was saved"
+        assert stored == recount
+    finally:
+        await engine.dispose()
+
+
+def test_concurrent_grade_taps_keep_stats_equal_to_a_recount():
+    asyncio.run(_run())